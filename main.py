@@ -1,10 +1,26 @@
+import argparse
+import datetime
+import importlib
 import logging
 import logging.config
 import os
 import sys
+import time
 
 from mtp_transaction_uploader import settings
-from mtp_transaction_uploader.upload import main as transaction_uploader
+
+# heavy dependencies in the order the uploader loads them; they are only imported once
+# configuration has been checked so that disabled or misconfigured runs exit quickly
+HEAVY_MODULES = [
+    'requests_oauthlib',
+    'slumber',
+    'bankline_parser.data_services',
+    'mtp_common.bank_accounts',
+    'paramiko',
+    'mtp_transaction_uploader.upload',
+    'mtp_transaction_uploader.daemon',
+]
+STAGES = ['fetch', 'transform', 'upload']
 
 
 def setup_monitoring():
@@ -58,29 +74,188 @@ def setup_monitoring():
     return logger, sentry
 
 
-def main():
-    logger, sentry = setup_monitoring()
+def timed_import(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    return module, time.perf_counter() - start
 
-    if settings.UPLOADER_DISABLED:
-        logger.info('Transaction uploader is disabled')
-        sys.exit(0)
 
-    # ensure all required parameters are set
+def report_import_times(logger):
+    """
+    Logs how long each heavy dependency adds to start-up, similar to `python -X importtime`
+    """
+    total = 0
+    for name in HEAVY_MODULES:
+        if name in sys.modules:
+            continue
+        _, duration = timed_import(name)
+        total += duration
+        logger.info('Imported %s in %.1fms' % (name, duration * 1000), extra={
+            'elk_fields': {
+                '@fields.module': name,
+                '@fields.import_ms': round(duration * 1000, 1),
+            }
+        })
+    logger.info('Imported all dependencies in %.1fms' % (total * 1000), extra={
+        'elk_fields': {
+            '@fields.import_ms': round(total * 1000, 1),
+        }
+    })
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Dates must be in YYYY-MM-DD format')
+
+
+def run_stage(stage, logger):
+    from mtp_transaction_uploader import batches
+    from mtp_transaction_uploader.sources import get_statement_source
+    from mtp_transaction_uploader.timings import stage_timings
+
+    stage_timings.reset()
+    if stage == 'fetch':
+        source = get_statement_source()
+        try:
+            files = batches.fetch_files(source=source)
+        finally:
+            source.close()
+        logger.info('Fetched %d new files' % len(files), extra={
+            'elk_fields': {
+                '@fields.file_count': len(files),
+            }
+        })
+    else:
+        if stage == 'transform':
+            transaction_count = batches.transform_files()
+            message = 'Transformed %d transactions'
+        else:
+            transaction_count = batches.upload_batches()
+            message = 'Upload of %d transactions complete'
+        logger.info(message % transaction_count, extra={
+            'elk_fields': {
+                '@fields.transaction_count': transaction_count,
+            }
+        })
+    stage_timings.log_report()
+
+
+def run_uploader(options, logger):
+    daemon, import_duration = timed_import('mtp_transaction_uploader.daemon')
+    logger.info('Loaded transaction uploader in %.1fms' % (import_duration * 1000), extra={
+        'elk_fields': {
+            '@fields.import_ms': round(import_duration * 1000, 1),
+        }
+    })
+    from mtp_transaction_uploader.api_client import set_sink
+    from mtp_transaction_uploader.sinks import get_sink
+    from mtp_transaction_uploader.sources import get_statement_source
+    from mtp_transaction_uploader.upload import main as transaction_uploader
+
+    sink = get_sink(options.sink, options.sink_path)
+    set_sink(sink)
+    try:
+        if options.stage:
+            run_stage(options.stage, logger)
+            return
+
+        if options.daemon:
+            daemon.UploaderDaemon().run()
+            return
+
+        if options.seed_fingerprints:
+            from mtp_transaction_uploader.api_client import get_authenticated_connection
+            from mtp_transaction_uploader.fingerprints import get_fingerprint_index, seed_fingerprint_index
+
+            seed_fingerprint_index(get_authenticated_connection(), get_fingerprint_index(), *options.seed_fingerprints)
+            return
+
+        source = get_statement_source()
+        try:
+            if options.backfill:
+                from mtp_transaction_uploader.backfill import backfill
+
+                backfill(*options.backfill, source=source)
+            else:
+                transaction_uploader(source=source)
+        finally:
+            source.close()
+    finally:
+        if sink is not None:
+            sink.close()
+
+
+def get_missing_params(options):
     missing_params = []
-    required_params = {'SFTP_HOST', 'SFTP_USER', 'SFTP_PRIVATE_KEY', 'ACCOUNT_CODE',
+    required_params = {'ACCOUNT_CODE',
                        'API_URL', 'API_CLIENT_ID', 'API_CLIENT_SECRET',
                        'API_USERNAME', 'API_PASSWORD'}
+    if options.stage in ('transform', 'upload') or options.seed_fingerprints:
+        # statements are not read from their source
+        pass
+    elif settings.STATEMENT_SOURCE == 'local':
+        required_params |= {'LOCAL_STATEMENT_DIR'}
+    else:
+        required_params |= {'SFTP_HOST', 'SFTP_USER', 'SFTP_PRIVATE_KEY'}
+    if any(account[0] != settings.ACCOUNT_CODE for account in settings.ACCOUNTS):
+        # the API only keeps closing balances for ACCOUNT_CODE
+        required_params |= {'ACCOUNT_BALANCES_DIR'}
     for param in dir(settings):
         if param in required_params and not getattr(settings, param):
             missing_params.append(param)
+    return missing_params
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Uploads transactions from data services files')
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--daemon', action='store_true',
+                       help='stay resident and poll for new files instead of running once')
+    modes.add_argument('--backfill', nargs=2, type=parse_date, metavar=('START_DATE', 'END_DATE'),
+                       help='re-ingest statements dated within this range, inclusive')
+    modes.add_argument('--seed-fingerprints', nargs=2, type=parse_date, metavar=('START_DATE', 'END_DATE'),
+                       help='add transactions the API received within this range, inclusive, '
+                            'to the fingerprint index and exit')
+    parser.add_argument('--sink', choices=['api', 'noop', 'ndjson'], default='api',
+                        help='where transactions and balances are sent, anything but "api" is a dry run')
+    parser.add_argument('--sink-path', help='output file for the ndjson sink')
+    parser.add_argument('--dry-run', action='store_const', dest='sink', const='noop',
+                        help='run without posting anything to the API, same as --sink noop')
+    parser.add_argument('--import-times', action='store_true',
+                        help='report the time taken to import each heavy dependency and exit')
+    stages = parser.add_subparsers(dest='stage', metavar='{%s}' % ','.join(STAGES),
+                                   help='run a single stage, exchanging files with the other stages; '
+                                        'by default all stages run together')
+    stages.add_parser('fetch', help='retrieve new data services files into DS_NEW_FILES_DIR')
+    stages.add_parser('transform', help='convert fetched files into batches of transactions in BATCH_DIR')
+    stages.add_parser('upload', help='upload batches of transactions from BATCH_DIR and update balances')
+    options = parser.parse_args()
+    if options.stage and (options.daemon or options.backfill or options.seed_fingerprints):
+        parser.error('--daemon, --backfill and --seed-fingerprints cannot be used with a single stage')
+    if options.seed_fingerprints and not settings.FINGERPRINT_INDEX_PATH:
+        parser.error('FINGERPRINT_INDEX_PATH must be set to seed the fingerprint index')
+
+    logger, sentry = setup_monitoring()
+
+    if options.import_times:
+        report_import_times(logger)
+        sys.exit(0)
+
+    if settings.UPLOADER_DISABLED:
+        logger.info('Transaction uploader is disabled')
+        sys.exit(0)
+
+    # ensure all required parameters are set
+    missing_params = get_missing_params(options)
     if missing_params:
         logger.error('Missing environment variables: ' +
                      ', '.join(missing_params))
         sys.exit(1)
 
     try:
-        # run the transaction uploader
-        transaction_uploader()
+        run_uploader(options, logger)
     except:  # noqa
         if sentry:
             sentry.captureException()
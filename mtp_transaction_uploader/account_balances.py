@@ -0,0 +1,66 @@
+"""
+Local stores of closing balances for accounts other than the one configured with ACCOUNT_CODE
+
+The API keeps a single series of closing balances, one for each date, which belongs to the account configured with
+ACCOUNT_CODE. Other accounts listed in ACCOUNTS keep their closing balances in a SQLite database for each account
+in ACCOUNT_BALANCES_DIR, which is read and written like the API's balances endpoint.
+"""
+import os
+import sqlite3
+import threading
+
+from mtp_transaction_uploader import settings
+
+_account_balance_stores = {}
+_account_balance_stores_lock = threading.Lock()
+
+
+class AccountBalanceStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS balances '
+                '(date TEXT PRIMARY KEY, closing_balance INTEGER NOT NULL) WITHOUT ROWID'
+            )
+
+    def get(self, limit=None, date__lt=None) -> dict:
+        """
+        Returns closing balances, latest first, in the form of an API response
+        """
+        query = 'SELECT date, closing_balance FROM balances'
+        params = []
+        if date__lt is not None:
+            query += ' WHERE date < ?'
+            params.append(date__lt)
+        query += ' ORDER BY date DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            results = [
+                {'date': date, 'closing_balance': closing_balance}
+                for date, closing_balance in self.db.execute(query, params)
+            ]
+        return {'count': len(results), 'results': results}
+
+    def post(self, data: dict):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO balances (date, closing_balance) VALUES (?, ?)',
+                (data['date'], data['closing_balance'])
+            )
+
+    def close(self):
+        self.db.close()
+
+
+def get_account_balance_store(account_code) -> AccountBalanceStore:
+    with _account_balance_stores_lock:
+        if account_code not in _account_balance_stores:
+            os.makedirs(settings.ACCOUNT_BALANCES_DIR, exist_ok=True)
+            _account_balance_stores[account_code] = AccountBalanceStore(
+                os.path.join(settings.ACCOUNT_BALANCES_DIR, '%s.db' % account_code)
+            )
+        return _account_balance_stores[account_code]
@@ -0,0 +1,131 @@
+"""
+On-disk read-through cache for API lookups of reference data which rarely changes once written
+
+Only endpoints given a time-to-live in API_CACHE_TTLS are cached. Cached responses for an endpoint are dropped
+whenever the uploader posts to it so that its own changes are seen straight away; changes made by others are
+seen once cached responses expire. Balances are not cached when several instances share files through leases
+as each instance commits balances which the others need to see straight away. Empty result sets are not cached
+as the looked-up record, such as a batch for a settlement, may just not have been created yet. Responses are
+cached by their full lookup parameters.
+"""
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from mtp_transaction_uploader import settings
+
+logger = logging.getLogger('mtp')
+
+_api_cache = None
+_api_cache_lock = threading.Lock()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def reset(self):
+        self.hits.clear()
+        self.misses.clear()
+
+    def log_report(self):
+        for endpoint in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[endpoint], self.misses[endpoint]
+            logger.info('API cache served %d of %d %s lookups' % (hits, hits + misses, endpoint), extra={
+                'elk_fields': {
+                    '@fields.endpoint': endpoint,
+                    '@fields.cache_hits': hits,
+                    '@fields.cache_misses': misses,
+                }
+            })
+
+
+api_cache_stats = CacheStats()
+
+
+class APICache:
+    def __init__(self, path, ttls: dict):
+        self.pid = os.getpid()
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(endpoint TEXT, params TEXT, response TEXT NOT NULL, expires_at REAL NOT NULL, '
+                'PRIMARY KEY (endpoint, params)) WITHOUT ROWID'
+            )
+            self.db.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+
+    def get(self, conn, endpoint, params: dict) -> dict:
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return getattr(conn, endpoint).get(**params)
+
+        key = json.dumps(params, sort_keys=True)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT response FROM responses WHERE endpoint = ? AND params = ? AND expires_at > ?',
+                (endpoint, key, time.time())
+            ).fetchone()
+        if row is not None:
+            api_cache_stats.hits[endpoint] += 1
+            return json.loads(row[0])
+
+        api_cache_stats.misses[endpoint] += 1
+        response = getattr(conn, endpoint).get(**params)
+        if not response.get('results'):
+            return response
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (endpoint, params, response, expires_at) VALUES (?, ?, ?, ?)',
+                (endpoint, key, json.dumps(response), time.time() + ttl)
+            )
+        return response
+
+    def invalidate(self, endpoint):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+
+    def close(self):
+        self.db.close()
+
+
+def get_api_cache():
+    """
+    Returns this process's cache if API_CACHE_PATH is set
+    """
+    global _api_cache
+
+    if not settings.API_CACHE_PATH:
+        return None
+    with _api_cache_lock:
+        # worker processes open their own connection to the database
+        if _api_cache is None or _api_cache.pid != os.getpid():
+            _api_cache = APICache(settings.API_CACHE_PATH, get_cache_ttls())
+        return _api_cache
+
+
+def get_cache_ttls() -> dict:
+    ttls = dict(settings.API_CACHE_TTLS)
+    if settings.LEASE_DIR:
+        ttls.pop('balances', None)
+    return ttls
+
+
+def cached_get(conn, endpoint, **params) -> dict:
+    api_cache = get_api_cache()
+    if api_cache is None:
+        return getattr(conn, endpoint).get(**params)
+    return api_cache.get(conn, endpoint, params)
+
+
+def invalidate(endpoint):
+    api_cache = get_api_cache()
+    if api_cache is not None:
+        api_cache.invalidate(endpoint)
@@ -1,13 +1,231 @@
+import contextlib
+import gzip
+import json
+import logging
+import threading
+import time
 from urllib.parse import urljoin
+import zlib
 
 from oauthlib.oauth2 import LegacyApplicationClient
 from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session
 import slumber
+from slumber.exceptions import HttpClientError, HttpNotFoundError, HttpServerError
 
 from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.sinks import SinkConnection
+
+logger = logging.getLogger('mtp')
 
 REQUEST_TOKEN_URL = urljoin(settings.API_URL, '/oauth2/token/')
+STREAM_BUFFER_BYTES = 64 * 1024
+# shared connections are replaced this long before their access token expires
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+_shared_connection = None
+_shared_connection_lock = threading.Lock()
+_reuse_connection = False
+_sink = None
+
+
+class CompressionStats:
+    def __init__(self):
+        self.request_count = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def reset(self):
+        self.request_count = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def record(self, uncompressed_bytes, compressed_bytes):
+        self.request_count += 1
+        self.uncompressed_bytes += uncompressed_bytes
+        self.compressed_bytes += compressed_bytes
+
+    def log_report(self):
+        if not self.request_count:
+            return
+        logger.info(
+            'Compressed %d request bodies from %d to %d bytes' % (
+                self.request_count, self.uncompressed_bytes, self.compressed_bytes,
+            ),
+            extra={
+                'elk_fields': {
+                    '@fields.uncompressed_bytes': self.uncompressed_bytes,
+                    '@fields.compressed_bytes': self.compressed_bytes,
+                }
+            }
+        )
+
+
+compression_stats = CompressionStats()
+
+
+class RateLimiter:
+    """
+    Spaces out requests, across threads, so that no more than API_RATE_LIMIT start each second
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_request_time = 0
+
+    def wait(self):
+        if settings.API_RATE_LIMIT <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + 1 / settings.API_RATE_LIMIT
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+rate_limiter = RateLimiter()
+
+
+class APIConnection(slumber.API):
+    """
+    slumber API connection keeping hold of its HTTP session, which slumber only stores privately
+    """
+
+    def __init__(self, base_url, session):
+        super().__init__(base_url=base_url, session=session)
+        self.http_session = session
+
+
+class GzipOAuth2Session(OAuth2Session):
+    """
+    OAuth2 session that gzip-encodes serialised request bodies
+    """
+
+    def __init__(self, *args, compression_level=6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression_level = compression_level
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        if isinstance(data, (str, bytes)):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            compressed_data = gzip.compress(data, compresslevel=self.compression_level)
+            compression_stats.record(len(data), len(compressed_data))
+            data = compressed_data
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        elif hasattr(data, '__next__'):
+            data = self.compress_stream(data)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        return super().request(method, url, data=data, headers=headers, **kwargs)
+
+    def compress_stream(self, data):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        uncompressed_bytes = 0
+        compressed_bytes = 0
+        for block in data:
+            uncompressed_bytes += len(block)
+            compressed_block = compressor.compress(block)
+            if compressed_block:
+                compressed_bytes += len(compressed_block)
+                yield compressed_block
+        compressed_block = compressor.flush()
+        compressed_bytes += len(compressed_block)
+        compression_stats.record(uncompressed_bytes, compressed_bytes)
+        yield compressed_block
+
+
+def serialise_stream(items, ndjson=False):
+    """
+    Serialises items one at a time as either newline-delimited JSON or a JSON array,
+    yielding encoded blocks of roughly STREAM_BUFFER_BYTES
+    """
+    buffer = []
+    buffer_size = 0
+    if not ndjson:
+        buffer.append('[')
+    for index, item in enumerate(items):
+        if ndjson:
+            serialised_item = json.dumps(item) + '\n'
+        elif index:
+            serialised_item = ',' + json.dumps(item)
+        else:
+            serialised_item = json.dumps(item)
+        buffer.append(serialised_item)
+        buffer_size += len(serialised_item)
+        if buffer_size >= STREAM_BUFFER_BYTES:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            buffer_size = 0
+    if not ndjson:
+        buffer.append(']')
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def post_streamed(conn: APIConnection, endpoint, items, ndjson=False):
+    """
+    POSTs items to an API endpoint as a generator-backed body sent with chunked transfer encoding
+    so that the full request is never serialised in memory
+    """
+    url = getattr(conn, endpoint).url()
+    response = conn.http_session.request(
+        'POST', url,
+        data=serialise_stream(items, ndjson=ndjson),
+        headers={
+            'accept': 'application/json',
+            'content-type': 'application/x-ndjson' if ndjson else 'application/json',
+        },
+    )
+    if 400 <= response.status_code <= 499:
+        exception_class = HttpNotFoundError if response.status_code == 404 else HttpClientError
+        raise exception_class('Client Error %s: %s' % (response.status_code, url),
+                              response=response, content=response.content)
+    elif 500 <= response.status_code <= 599:
+        raise HttpServerError('Server Error %s: %s' % (response.status_code, url),
+                              response=response, content=response.content)
+    return response
+
+
+@contextlib.contextmanager
+def reuse_connection():
+    """
+    Within the block, makes get_authenticated_connection return the same connection, and hence the same
+    HTTP connection pool and access token, until the token is close to expiry or the connection is reset
+    """
+    global _reuse_connection
+
+    already_reused = _reuse_connection
+    _reuse_connection = True
+    try:
+        yield
+    finally:
+        if not already_reused:
+            _reuse_connection = False
+            reset_connection()
+
+
+def reset_connection():
+    global _shared_connection
+
+    _shared_connection = None
+
+
+def stop_reusing_connection():
+    """
+    Used by worker processes forked within a `reuse_connection` block so that they neither use
+    the parent process's connection nor a lock which another of its threads may have held
+    """
+    global _reuse_connection, _shared_connection_lock
+
+    _reuse_connection = False
+    _shared_connection_lock = threading.Lock()
+    reset_connection()
+
+
+def connection_expired(conn):
+    expires_at = conn.http_session.token.get('expires_at')
+    return expires_at is not None and expires_at - TOKEN_EXPIRY_MARGIN_SECONDS < time.time()
 
 
 def get_authenticated_connection():
@@ -15,11 +233,41 @@ def get_authenticated_connection():
     Returns:
         an authenticated slumber connection
     """
-    session = OAuth2Session(
-        client=LegacyApplicationClient(
-            client_id=settings.API_CLIENT_ID
-        )
+    global _shared_connection
+
+    if not _reuse_connection:
+        conn = create_authenticated_connection()
+    else:
+        with _shared_connection_lock:
+            if _shared_connection is None or connection_expired(_shared_connection):
+                _shared_connection = create_authenticated_connection()
+            conn = _shared_connection
+    if _sink is not None:
+        return SinkConnection(conn, _sink)
+    return conn
+
+
+def set_sink(sink):
+    """
+    Sends what would be posted to the API to `sink` instead, or to the API again if None
+    """
+    global _sink
+
+    _sink = sink
+
+
+def is_dry_run() -> bool:
+    return _sink is not None
+
+
+def create_authenticated_connection():
+    client = LegacyApplicationClient(
+        client_id=settings.API_CLIENT_ID
     )
+    if settings.GZIP_REQUESTS:
+        session = GzipOAuth2Session(client=client, compression_level=settings.GZIP_COMPRESSION_LEVEL)
+    else:
+        session = OAuth2Session(client=client)
 
     session.fetch_token(
         token_url=REQUEST_TOKEN_URL,
@@ -28,6 +276,6 @@ def get_authenticated_connection():
         auth=HTTPBasicAuth(settings.API_CLIENT_ID, settings.API_CLIENT_SECRET)
     )
 
-    return slumber.API(
+    return APIConnection(
         base_url=settings.API_URL, session=session
     )
@@ -0,0 +1,117 @@
+"""
+Re-ingests statements for a past date range, e.g. after an API data restore
+
+Statements are uploaded concurrently by BACKFILL_WORKERS threads within the global API_RATE_LIMIT;
+closing balances are only committed afterwards, in date order, up to the first statement that failed.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
+import logging
+import time
+
+from slumber.exceptions import SlumberHttpBaseException
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.api_client import get_authenticated_connection
+from mtp_transaction_uploader.upload import (
+    calculate_closing_balance, clear_new_files_dir, get_worker_count, load_statements, log_failed_statement,
+    post_statement, update_new_balances,
+)
+from mtp_transaction_uploader.workers import run_worker_pool
+
+logger = logging.getLogger('mtp')
+
+
+class BackfillProgress:
+    def __init__(self, file_count):
+        self.file_count = file_count
+        self.completed_files = 0
+        self.transaction_count = 0
+        self.start_time = time.monotonic()
+
+    def statement_completed(self, transaction_count):
+        self.completed_files += 1
+        self.transaction_count += transaction_count
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        logger.info(
+            'Backfilled %d of %d files: %.2f files/s, %.0f transactions/s' % (
+                self.completed_files, self.file_count,
+                self.completed_files / elapsed, self.transaction_count / elapsed,
+            ),
+            extra={
+                'elk_fields': {
+                    '@fields.file_count': self.completed_files,
+                    '@fields.transaction_count': self.transaction_count,
+                }
+            }
+        )
+
+
+class BackfillUploader:
+    """
+    Uploads statements concurrently, keeping only what is needed to update closing balances afterwards
+    """
+
+    def __init__(self, conn, file_count, workers):
+        self.conn = conn
+        self.workers = workers
+        self.progress = BackfillProgress(file_count)
+        self.uploaded_statements = []
+        self.failed_dates = []
+        self.pending = {}
+
+    def upload(self, statements):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for statement in statements:
+                # bound the number of parsed statements held in memory
+                while len(self.pending) >= self.workers * 2:
+                    self.wait_for_uploads()
+                self.pending[executor.submit(post_statement, self.conn, statement)] = statement
+            while self.pending:
+                self.wait_for_uploads()
+
+    def wait_for_uploads(self):
+        done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            statement = self.pending.pop(future)
+            try:
+                future.result()
+            except SlumberHttpBaseException as e:
+                log_failed_statement(statement, e)
+                self.failed_dates.append(statement.date)
+                continue
+            # only the net amount is needed to roll balances forward so transactions are released
+            net_amount = calculate_closing_balance(0, statement.transactions, net_amount=statement.net_amount)
+            self.uploaded_statements.append(statement._replace(transactions=[], net_amount=net_amount))
+            self.progress.statement_completed(len(statement.transactions))
+
+    def update_balances(self):
+        statements = self.uploaded_statements
+        if self.failed_dates:
+            first_failed_date = min(self.failed_dates)
+            logger.error('Closing balances from %s onwards were not updated as %d files failed to upload' % (
+                first_failed_date, len(self.failed_dates)
+            ))
+            statements = [statement for statement in statements if statement.date < first_failed_date]
+        if statements:
+            update_new_balances(statements)
+
+
+def backfill(start_date: datetime.date, end_date: datetime.date, source, workers=None) -> int:
+    """
+    Uploads transactions from all statements dated from `start_date` to `end_date` inclusive
+    and then updates their closing balances; returns the number of transactions uploaded
+    """
+    if source.downloads_files:
+        clear_new_files_dir()
+    _, files = source.retrieve_new_files(start_date - datetime.timedelta(days=1), end_date=end_date)
+    if not files:
+        logger.info('No files available to backfill between %s and %s' % (start_date, end_date))
+        return 0
+    logger.info('Backfilling %d files between %s and %s' % (len(files), start_date, end_date))
+
+    with run_worker_pool(get_worker_count()):
+        uploader = BackfillUploader(get_authenticated_connection(), len(files), workers or settings.BACKFILL_WORKERS)
+        uploader.upload(load_statements(files))
+    uploader.update_balances()
+    return uploader.progress.transaction_count
@@ -0,0 +1,231 @@
+"""
+Pipeline stages which can be run, scaled and retried separately, exchanging batches on disk
+
+`fetch` retrieves new data services files into DS_NEW_FILES_DIR, `transform` turns each file into a batch of
+cleaned transactions in BATCH_DIR along with the balance metadata needed to update closing balances, and `upload`
+posts the batches in date order, stopping at the first that fails so that balances are updated in order.
+Uploaded batches are renamed so that retrying the upload stage skips them, and a batch which failed part-way
+is resumed after the last chunk of its transactions posted. Uploaded batches are kept for BATCH_RETENTION_DAYS.
+Stages only process the account configured with ACCOUNT_CODE.
+
+A batch is a gzipped file whose first line is a JSON header identifying the format and its version;
+each following line is a JSON array of one transaction's values in the order listed in the header.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+import typing
+
+from slumber.exceptions import SlumberHttpBaseException
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.budget import StatementProgress
+from mtp_transaction_uploader.sinks import SinkConnection
+from mtp_transaction_uploader.timings import stage_timings
+from mtp_transaction_uploader.transaction import FIELDS, Transaction
+from mtp_transaction_uploader.upload import (
+    BalanceUpdater, BankAccount, DownloadedFile, StatementTransactions, calculate_closing_balance,
+    clear_new_files_dir, get_authenticated_connection, get_default_bank_account, get_worker_count, load_statements,
+    log_failed_statement, parse_filename, post_statement, retrieve_data_services_files,
+)
+from mtp_transaction_uploader.workers import run_worker_pool
+
+logger = logging.getLogger('mtp')
+
+BATCH_FORMAT = 'mtp-transaction-batch'
+BATCH_VERSION = 1
+BATCH_SUFFIX = '.batch.gz'
+UPLOADED_SUFFIX = '.uploaded'
+PROGRESS_SUFFIX = '.progress'
+
+
+def fetch_files(source=None) -> typing.List[str]:
+    """
+    Retrieves new files into DS_NEW_FILES_DIR, writing out any that were downloaded into memory
+    """
+    if source is not None and not source.downloads_files:
+        clear_new_files_dir()
+    bank_account = get_default_bank_account()
+    _, files = retrieve_data_services_files(source=source, account_codes=[bank_account.code])
+    fetched_files = []
+    for filename in files:
+        path = os.path.join(settings.DS_NEW_FILES_DIR, os.path.basename(filename))
+        if isinstance(filename, DownloadedFile):
+            with open(path, 'wb') as f:
+                f.write(filename.content)
+        elif os.path.abspath(filename) != os.path.abspath(path):
+            shutil.copy(filename, path)
+        fetched_files.append(path)
+    return fetched_files
+
+
+def list_dated_files(directory, account_code, suffix=''):
+    """
+    Lists files in `directory` named for the account's statements, in date order
+    """
+    dated_files = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        date = parse_filename(name[:len(name) - len(suffix)], account_code)
+        if date:
+            dated_files.append((date, os.path.join(directory, name)))
+    return [path for _, path in sorted(dated_files)]
+
+
+def get_batch_path(batch_dir, filename):
+    return os.path.join(batch_dir, os.path.basename(filename) + BATCH_SUFFIX)
+
+
+def write_batch(statement: StatementTransactions, path):
+    header = {
+        'format': BATCH_FORMAT,
+        'version': BATCH_VERSION,
+        'filename': os.path.basename(statement.filename),
+        'date': statement.date.isoformat(),
+        'file_balance': statement.file_balance,
+        'net_amount': calculate_closing_balance(0, statement.transactions, net_amount=statement.net_amount),
+        'fields': FIELDS,
+        'count': len(statement.transactions),
+    }
+    temporary_path = '%s.%s.tmp' % (path, os.getpid())
+    with gzip.open(temporary_path, 'wt') as f:
+        f.write(json.dumps(header, separators=(',', ':')))
+        f.write('\n')
+        for transaction in statement.transactions:
+            f.write(json.dumps([transaction.get(field) for field in FIELDS], separators=(',', ':')))
+            f.write('\n')
+    os.replace(temporary_path, path)
+
+
+def read_batch(path) -> StatementTransactions:
+    with gzip.open(path, 'rt') as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('format') != BATCH_FORMAT or header.get('version') != BATCH_VERSION:
+            raise ValueError('%s is not a version %d transaction batch' % (path, BATCH_VERSION))
+        fields = header['fields']
+        transactions = [
+            Transaction(**{field: value for field, value in zip(fields, json.loads(line)) if value is not None})
+            for line in f
+        ]
+    if len(transactions) != header['count']:
+        raise ValueError('%s is incomplete, expected %d transactions but found %d' % (
+            path, header['count'], len(transactions)
+        ))
+    return StatementTransactions(
+        header['filename'], datetime.date.fromisoformat(header['date']), transactions,
+        header['file_balance'], header['net_amount'],
+    )
+
+
+def transform_files(files=None, bank_account: BankAccount = None, batch_dir=None) -> int:
+    """
+    Writes a batch for each date-ordered file, defaulting to those fetched into DS_NEW_FILES_DIR;
+    files whose batch has already been uploaded are skipped
+    """
+    bank_account = bank_account or get_default_bank_account()
+    batch_dir = batch_dir or settings.BATCH_DIR
+    os.makedirs(batch_dir, exist_ok=True)
+    if files is None:
+        files = list_dated_files(settings.DS_NEW_FILES_DIR, bank_account.code)
+    files = [
+        filename for filename in files
+        if not os.path.exists(get_batch_path(batch_dir, filename) + UPLOADED_SUFFIX)
+    ]
+
+    transaction_count = 0
+    with run_worker_pool(get_worker_count()):
+        statements = stage_timings.measure_iterator(
+            'transform', load_statements(files, bank_account=bank_account),
+            count=lambda statement: len(statement.transactions),
+        )
+        for statement in statements:
+            write_batch(statement, get_batch_path(batch_dir, statement.filename))
+            transaction_count += len(statement.transactions)
+    return transaction_count
+
+
+def read_batch_progress(path) -> int:
+    try:
+        with open(path + PROGRESS_SUFFIX) as f:
+            return json.load(f)['uploaded_count']
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_batch_progress(path, uploaded_count):
+    temporary_path = '%s%s.%s.tmp' % (path, PROGRESS_SUFFIX, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump({'uploaded_count': uploaded_count}, f)
+    os.replace(temporary_path, path + PROGRESS_SUFFIX)
+
+
+def upload_batches(batch_dir=None, should_stop=None) -> int:
+    """
+    Uploads batches in date order, updating closing balances as for files, until one fails
+    """
+    bank_account = get_default_bank_account()
+    batch_dir = batch_dir or settings.BATCH_DIR
+    if not os.path.isdir(batch_dir):
+        return 0
+
+    conn = get_authenticated_connection()
+    balance_updater = BalanceUpdater()
+    successful_transaction_count = 0
+    for path in list_dated_files(batch_dir, bank_account.code, suffix=BATCH_SUFFIX):
+        if should_stop and should_stop():
+            break
+        statement = read_batch(path)
+        transaction_count = len(statement.transactions)
+        # dry runs leave batches to be uploaded for real
+        dry_run = isinstance(conn, SinkConnection)
+        progress = None if dry_run else StatementProgress(
+            statement, read_batch_progress(path),
+            lambda uploaded_count: write_batch_progress(path, uploaded_count),
+        )
+        try:
+            post_statement(conn, statement, budget=progress)
+            if not dry_run:
+                # a retry after the balance update fails only updates the balance
+                write_batch_progress(path, transaction_count)
+            balance_updater.statement_uploaded(statement)
+        except SlumberHttpBaseException as e:
+            log_failed_statement(statement, e)
+            break
+        if not dry_run:
+            os.replace(path, path + UPLOADED_SUFFIX)
+            # retention counts from when the batch was uploaded rather than written
+            os.utime(path + UPLOADED_SUFFIX)
+            os.remove(path + PROGRESS_SUFFIX)
+        logger.info('Uploaded %d transactions from %s' % (transaction_count, statement.filename))
+        successful_transaction_count += transaction_count
+    balance_updater.finish()
+    if settings.BATCH_RETENTION_DAYS and not isinstance(conn, SinkConnection):
+        remove_uploaded_batches(batch_dir, bank_account, settings.BATCH_RETENTION_DAYS)
+    return successful_transaction_count
+
+
+def remove_uploaded_batches(batch_dir, bank_account: BankAccount, days) -> int:
+    """
+    Removes batches uploaded more than `days` ago along with their fetched files,
+    which would otherwise be transformed again once their batch is gone
+    """
+    removed_count = 0
+    uploaded_before = time.time() - days * 24 * 60 * 60
+    for path in list_dated_files(batch_dir, bank_account.code, suffix=BATCH_SUFFIX + UPLOADED_SUFFIX):
+        if os.path.getmtime(path) >= uploaded_before:
+            continue
+        filename = os.path.basename(path)[:-len(BATCH_SUFFIX + UPLOADED_SUFFIX)]
+        for removed_path in (path, os.path.join(settings.DS_NEW_FILES_DIR, filename)):
+            try:
+                os.remove(removed_path)
+            except FileNotFoundError:
+                pass
+        removed_count += 1
+    if removed_count:
+        logger.info('Removed %d batches uploaded more than %d days ago' % (removed_count, days))
+    return removed_count
@@ -0,0 +1,214 @@
+"""
+Benchmarks for the transaction uploader's processing stages using synthetic statements
+
+Run with `python -m mtp_transaction_uploader.benchmark --help`
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import time
+import tracemalloc
+
+from bankline_parser.data_services.models import DataRecord
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.workers import run_worker_pool
+
+# record templates covering the common transaction shapes without needing API lookups
+RECORD_TEMPLATES = [
+    '%(sort_code)s%(account_number)s00300000000000000000000000288615NW-CHASE  PSC-0302Payment refund    '
+    '                  %(date)s                      ',
+    '%(sort_code)s%(account_number)s09960800629696666000000000008939NORTHERN DIY   E  A1234BY 09/12/86  '
+    '                  %(date)s                      ',
+    '%(sort_code)s%(account_number)s09324543278990056000000000009802NW-EDINBURGH -0302B4321XZ 8/11/1992 '
+    '                  %(date)s                      ',
+    '%(sort_code)s%(account_number)s09909000000050005000000000001000A12345678SMI      A1234BY 09/12/86  '
+    '                  %(date)s                      ',
+    '%(sort_code)s%(account_number)s0930700933333333400000000000100012-123456-12345   A1234BY 09/12/86  '
+    '                  %(date)s                      ',
+]
+
+
+def generate_lines(count, date=None):
+    """
+    Generates `count` data record lines for our account cycling through the record templates
+    """
+    date = date or datetime.date.today()
+    values = {
+        'sort_code': settings.NOMS_AGENCY_SORT_CODE,
+        'account_number': settings.NOMS_AGENCY_ACCOUNT_NUMBER,
+        'date': date.strftime(' %y%j'),
+    }
+    lines = [template % values for template in RECORD_TEMPLATES]
+    return list(itertools.islice(itertools.cycle(lines), count))
+
+
+def generate_records(count, date=None):
+    return [DataRecord(line) for line in generate_lines(count, date)]
+
+
+@contextlib.contextmanager
+def override_settings(**values):
+    """
+    Temporarily replaces settings read by the code being benchmarked
+    """
+    original_values = {name: getattr(settings, name) for name in values}
+    for name, value in values.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original_values.items():
+            setattr(settings, name, value)
+
+
+def time_call(func, *args, repeat=3):
+    """
+    Returns the best wall-clock time of `repeat` calls along with the last result
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def benchmark_classification(options):
+    lines = generate_lines(options.records)
+    print('Classifying %d records' % len(lines))
+
+    with override_settings(CLASSIFY_WORKERS=1):
+        serial_time, serial_transactions = time_call(upload.classify_record_lines, lines, repeat=options.repeat)
+    print('  serial:  %.3fs (%d records/s)' % (serial_time, len(lines) / serial_time))
+
+    # as in a run, worker processes are started once rather than for each file
+    with override_settings(CLASSIFY_WORKERS=options.workers, CLASSIFY_SHARD_SIZE=options.shard_size), \
+            run_worker_pool(options.workers):
+        sharded_time, sharded_transactions = time_call(upload.classify_record_lines, lines, repeat=options.repeat)
+    print('  sharded: %.3fs (%d records/s) with %d workers and shards of %d records' % (
+        sharded_time, len(lines) / sharded_time, options.workers, options.shard_size
+    ))
+
+    serial_output = json.dumps(upload.clean_request_data(serial_transactions))
+    sharded_output = json.dumps(upload.clean_request_data(sharded_transactions))
+    if serial_output != sharded_output:
+        raise SystemExit('Sharded classification output does not match serial output')
+    print('  speed-up: %.2fx' % (serial_time / sharded_time))
+
+
+def measure_memory(func, *args):
+    """
+    Returns the memory retained by the result of a call and the peak allocated during it
+    """
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        result = func(*args)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return retained, peak, result
+
+
+def benchmark_memory(options):
+    records = generate_records(options.records)
+    print('Memory used by %d transactions' % len(records))
+
+    def dict_pipeline():
+        dict_transactions = [transaction.as_dict() for transaction in upload.classify_records(records)]
+        return dict_transactions, upload.clean_request_data(dict_transactions[:settings.UPLOAD_REQUEST_SIZE])
+
+    def slotted_pipeline():
+        slotted_transactions = upload.classify_records(records)
+        return slotted_transactions, upload.clean_request_data(slotted_transactions[:settings.UPLOAD_REQUEST_SIZE])
+
+    dict_retained, dict_peak, _ = measure_memory(dict_pipeline)
+    slotted_retained, slotted_peak, _ = measure_memory(slotted_pipeline)
+    print('  dicts:   %.1f MB retained, %.1f MB peak (%d bytes per transaction)' % (
+        dict_retained / 1e6, dict_peak / 1e6, dict_retained / len(records)
+    ))
+    print('  slotted: %.1f MB retained, %.1f MB peak (%d bytes per transaction)' % (
+        slotted_retained / 1e6, slotted_peak / 1e6, slotted_retained / len(records)
+    ))
+    print('  saving: %.0f%%' % (100 * (1 - slotted_retained / dict_retained)))
+
+
+def measure_transfer(remote_file, repeat):
+    """
+    Returns the best download rate in MB/s of `remote_file` using a new connection with the current SFTP settings
+    """
+    with upload.open_sftp_connection() as conn:
+        best = None
+        size = 0
+        for _ in range(repeat):
+            buffer = io.BytesIO()
+            start = time.perf_counter()
+            conn.sftp_client.getfo(
+                remote_file, buffer,
+                prefetch=settings.SFTP_PREFETCH,
+                max_concurrent_prefetch_requests=settings.SFTP_MAX_PREFETCH_REQUESTS or None,
+            )
+            duration = time.perf_counter() - start
+            size = buffer.tell()
+            if best is None or duration < best:
+                best = duration
+    return size / best / 1e6, size
+
+
+def benchmark_sftp(options):
+    print('Downloading %s from %s' % (options.remote_file, settings.SFTP_HOST))
+    combinations = itertools.product(
+        [False, True], [True, False], options.window_sizes, options.packet_sizes,
+    )
+    for compression, prefetch, window_size, packet_size in combinations:
+        with override_settings(SFTP_COMPRESSION=compression, SFTP_PREFETCH=prefetch,
+                               SFTP_WINDOW_SIZE=window_size, SFTP_MAX_PACKET_SIZE=packet_size):
+            rate, size = measure_transfer(options.remote_file, options.repeat)
+        print('  compression=%-5s prefetch=%-5s window=%-9s packet=%-7s %.2f MB/s (%d bytes)' % (
+            compression, prefetch, window_size or 'default', packet_size or 'default', rate, size
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks transaction uploader processing stages')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed repetitions')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    classification_parser = subparsers.add_parser(
+        'classification', help='serial vs sharded conversion of records into transactions'
+    )
+    classification_parser.add_argument('--records', type=int, default=100000)
+    classification_parser.add_argument('--workers', type=int, default=4)
+    classification_parser.add_argument('--shard-size', type=int, default=settings.CLASSIFY_SHARD_SIZE)
+    classification_parser.set_defaults(func=benchmark_classification)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='memory used by slotted transactions vs the equivalent dicts'
+    )
+    memory_parser.add_argument('--records', type=int, default=100000)
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    sftp_parser = subparsers.add_parser(
+        'sftp', help='download rate of a file on the SFTP server for combinations of transfer settings'
+    )
+    sftp_parser.add_argument('remote_file', help='path of the test file on the SFTP server')
+    sftp_parser.add_argument('--window-sizes', type=int, nargs='+', default=[0, 8 * 1024 * 1024],
+                             help='SFTP window sizes in bytes, 0 for the default')
+    sftp_parser.add_argument('--packet-sizes', type=int, nargs='+', default=[0, 256 * 1024],
+                             help='maximum SFTP packet sizes in bytes, 0 for the default')
+    sftp_parser.set_defaults(func=benchmark_sftp)
+
+    options = parser.parse_args()
+    options.func(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Wall-clock budget for a run so that scheduled runs finish before the next one is due
+
+No more files, or chunks of a file already started, are uploaded once the chunk latency measured so far suggests
+that they would not be finished within the budget. Where the run stopped is written to a checkpoint: the next run
+retrieves a partly uploaded file again and skips the transactions that were already posted from it.
+"""
+from collections import namedtuple
+import datetime
+import json
+import logging
+import math
+import os
+import time
+import typing
+
+from mtp_transaction_uploader import settings
+
+logger = logging.getLogger('mtp')
+
+# `uploaded_count` transactions from the start of the named file have been posted
+Checkpoint = namedtuple('Checkpoint', ['filename', 'date', 'uploaded_count'])
+
+
+def read_checkpoint() -> typing.Optional[Checkpoint]:
+    try:
+        with open(settings.RUN_CHECKPOINT_PATH) as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return Checkpoint(
+        checkpoint['filename'], datetime.date.fromisoformat(checkpoint['date']), checkpoint['uploaded_count'],
+    )
+
+
+def write_checkpoint(checkpoint: Checkpoint):
+    temporary_path = '%s.%s.tmp' % (settings.RUN_CHECKPOINT_PATH, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump({
+            'filename': checkpoint.filename,
+            'date': checkpoint.date.isoformat(),
+            'uploaded_count': checkpoint.uploaded_count,
+        }, f)
+    os.replace(temporary_path, settings.RUN_CHECKPOINT_PATH)
+
+
+def clear_checkpoint():
+    try:
+        os.remove(settings.RUN_CHECKPOINT_PATH)
+    except FileNotFoundError:
+        pass
+
+
+class RunBudget:
+    def __init__(self, seconds=None, checkpoint: Checkpoint = None, record_checkpoints=True):
+        self.start = time.monotonic()
+        self.deadline = self.start + seconds if seconds else None
+        self.checkpoint = checkpoint
+        self.record_checkpoints = record_checkpoints
+        self.chunk_count = 0
+        self.chunk_seconds = 0
+        self.statements_started = 0
+        self.stopped = False
+
+    def resume_count(self, statement) -> int:
+        """
+        Returns the number of the statement's transactions posted by the run which wrote the checkpoint
+        """
+        if self.checkpoint and os.path.basename(statement.filename) == self.checkpoint.filename:
+            return self.checkpoint.uploaded_count
+        return 0
+
+    def record_chunk(self, duration):
+        self.chunk_count += 1
+        self.chunk_seconds += duration
+
+    def has_time_for(self, chunk_count) -> bool:
+        if self.deadline is None or not self.chunk_count:
+            return True
+        chunk_latency = self.chunk_seconds / self.chunk_count
+        return time.monotonic() + chunk_count * chunk_latency <= self.deadline
+
+    def can_start_statement(self, statement, chunk_size) -> bool:
+        resume_count = self.resume_count(statement)
+        chunk_count = math.ceil((len(statement.transactions) - resume_count) / chunk_size)
+        # the first statement is always started so that every run makes progress
+        if self.statements_started and not self.has_time_for(chunk_count):
+            self.stop(statement, resume_count)
+            return False
+        self.statements_started += 1
+        return True
+
+    def can_start_chunk(self, statement, uploaded_count) -> bool:
+        if self.has_time_for(1):
+            return True
+        self.stop(statement, uploaded_count)
+        return False
+
+    def stop(self, statement, uploaded_count):
+        self.stopped = True
+        if self.record_checkpoints:
+            write_checkpoint(
+                Checkpoint(os.path.basename(statement.filename), statement.date, uploaded_count)
+            )
+        logger.warning(
+            'Run budget would be exceeded after %.1fs, stopping at %s with %d transactions uploaded' % (
+                time.monotonic() - self.start, statement.filename, uploaded_count
+            ),
+            extra={
+                'elk_fields': {
+                    '@fields.filename': os.path.basename(statement.filename),
+                    '@fields.uploaded_count': uploaded_count,
+                }
+            }
+        )
+
+    def finish(self):
+        if not self.stopped and self.checkpoint and self.record_checkpoints:
+            clear_checkpoint()
+
+
+class StatementProgress(RunBudget):
+    """
+    Resumes a statement which failed part-way from the last chunk posted, rather than posting its earlier chunks
+    again, by calling `record_progress` with the number of its transactions posted before each further chunk
+    """
+
+    def __init__(self, statement, uploaded_count, record_progress: typing.Callable[[int], None]):
+        checkpoint = Checkpoint(
+            os.path.basename(statement.filename), statement.date, uploaded_count
+        ) if uploaded_count else None
+        super().__init__(checkpoint=checkpoint, record_checkpoints=False)
+        self.record_progress = record_progress
+
+    def can_start_chunk(self, statement, uploaded_count):
+        if uploaded_count > self.resume_count(statement):
+            self.record_progress(uploaded_count)
+        return super().can_start_chunk(statement, uploaded_count)
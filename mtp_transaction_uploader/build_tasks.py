@@ -15,7 +15,7 @@ def build(_: Context):
 
 
 @tasks.register('build')
-def test(context: Context, functional_tests=False):
+def test(context: Context, functional_tests=False, performance_tests=False):
     """
     Tests the app
     """
@@ -25,6 +25,8 @@ def test(context: Context, functional_tests=False):
             'RUN_FUNCTIONAL_TESTS': '1',
             'OAUTHLIB_INSECURE_TRANSPORT': '1',
         })
+    if performance_tests:
+        environment['RUN_PERFORMANCE_TESTS'] = '1'
     return context.shell('nosetests', environment=environment)
 
 
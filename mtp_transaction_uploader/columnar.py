@@ -0,0 +1,168 @@
+"""
+Optional columnar representation of a data services file's records using NumPy
+
+Fixed-width fields are decoded from the raw lines into arrays so that validation against account trailers,
+account filtering and credit/debit totals are vectorised; bankline records are only built for the relevant
+transaction and balance lines. NumPy is an optional dependency which is only imported
+when COLUMNAR_RECORDS is enabled.
+"""
+from bankline_parser.data_services import models
+from bankline_parser.data_services.enums import TransactionCode
+from bankline_parser.data_services.exceptions import ParseError
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError('COLUMNAR_RECORDS requires NumPy, installed with requirements/columnar.txt') from e
+
+LABEL_IDENTIFIERS = [b'VOL1', b'HDR1', b'UHL1', b'UTL1']
+TRANSACTION_CODES = [code.value.encode() for code in TransactionCode]
+CREDIT_CODES = [
+    code.value.encode() for code in TransactionCode
+    if code.name.startswith('credit') and code != TransactionCode.credit_total
+]
+DEBIT_CODES = [
+    code.value.encode() for code in TransactionCode
+    if code.name.startswith('debit') and code != TransactionCode.debit_total
+]
+BALANCE_CODE = TransactionCode.balance_record.value.encode()
+CREDIT_TOTAL_CODE = TransactionCode.credit_total.value.encode()
+DEBIT_TOTAL_CODE = TransactionCode.debit_total.value.encode()
+AMOUNT_DIGIT_VALUES = 10 ** np.arange(10, -1, -1, dtype=np.int64)
+# account trailer fields checked against the account's records, as bankline_parser validates them
+TRAILER_FIELDS = [
+    ('monetary_total_debit_items', 'Monetary total of debit items'),
+    ('count_debit_items', 'Count of debit items'),
+    ('monetary_total_credit_items', 'Monetary total of credit items'),
+    ('count_credit_items', 'Count of credit items'),
+    ('count_balance_records', 'Count of balance records'),
+]
+
+
+def decode_digits(chars):
+    digits = chars.view(np.uint8).astype(np.int64) - ord('0')
+    # blank fields are read as 0
+    return np.where(chars == b' ', 0, digits)
+
+
+class RecordColumns:
+    """
+    Columns of sort code, account number, transaction code and amount
+    for every record line of a data services file, in file order
+    """
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        if not self.lines:
+            raise ParseError('File ended unexpectedly')
+        models.VolumeHeaderLabel(self.lines[0])
+
+        encoded_lines = [line.rstrip('\r\n').encode('latin-1', errors='replace') for line in self.lines]
+        width = max(map(len, encoded_lines))
+        chars = np.array(encoded_lines, dtype='S%d' % max(width, 106)).view('S1').reshape(len(encoded_lines), -1)
+
+        labels = chars[:, 0:4].copy().view('S4').ravel()
+        header_rows = np.flatnonzero(labels == b'UHL1')
+        trailer_rows = np.flatnonzero(labels == b'UTL1')
+        self.record_rows = np.flatnonzero(~np.isin(labels, LABEL_IDENTIFIERS))
+        self.user_header_labels = [models.UserHeaderLabel(self.lines[row]) for row in header_rows]
+        self.user_trailer_labels = [models.UserTrailerLabel(self.lines[row]) for row in trailer_rows]
+        if not self.user_trailer_labels:
+            raise ParseError('No accounts found in data services file')
+        # each record belongs to the account whose trailer follows it
+        self.accounts = np.searchsorted(trailer_rows, self.record_rows)
+        if len(header_rows) != len(trailer_rows) or (len(self.record_rows) and self.accounts[-1] == len(trailer_rows)):
+            raise ParseError('File ended unexpectedly')
+
+        chars = chars[self.record_rows]
+        self.sort_codes = chars[:, 0:6].copy().view('S6').ravel()
+        self.account_numbers = chars[:, 6:14].copy().view('S8').ravel()
+        self.transaction_codes = chars[:, 15:17].copy().view('S2').ravel()
+        unknown_codes = set(self.transaction_codes[~np.isin(self.transaction_codes, TRANSACTION_CODES)].tolist())
+        if unknown_codes:
+            raise ParseError('transaction_code: unknown codes %s' % sorted(code.decode() for code in unknown_codes))
+        self.credits = np.isin(self.transaction_codes, CREDIT_CODES)
+        self.debits = np.isin(self.transaction_codes, DEBIT_CODES)
+        self.balances = self.transaction_codes == BALANCE_CODE
+        self.credit_totals = self.transaction_codes == CREDIT_TOTAL_CODE
+        self.debit_totals = self.transaction_codes == DEBIT_TOTAL_CODE
+
+        amount_rows = self.credits | self.debits | self.credit_totals | self.debit_totals
+        self.amounts = np.where(amount_rows, decode_digits(chars[:, 35:46]) @ AMOUNT_DIGIT_VALUES, 0)
+
+        self.errors = self.validate()
+
+    def __len__(self):
+        return len(self.transaction_codes)
+
+    def is_valid(self):
+        return not self.errors
+
+    def account_totals(self, rows, values=None):
+        totals = np.zeros(len(self.user_trailer_labels), dtype=np.int64)
+        np.add.at(totals, self.accounts[rows], 1 if values is None else values[rows])
+        return totals
+
+    def validate(self):
+        """
+        Returns errors keyed by account where records do not match the account's trailer
+        """
+        debits = self.debits | self.debit_totals
+        credits = self.credits | self.credit_totals
+        counted = {
+            'monetary_total_debit_items': self.account_totals(debits, self.amounts),
+            'count_debit_items': self.account_totals(debits),
+            'monetary_total_credit_items': self.account_totals(credits, self.amounts),
+            'count_credit_items': self.account_totals(credits),
+            'count_balance_records': self.account_totals(self.balances),
+        }
+        errors = {}
+        for account, user_trailer_label in enumerate(self.user_trailer_labels):
+            account_errors = []
+            for field, description in TRAILER_FIELDS:
+                counted_value = int(counted[field][account])
+                expected_value = getattr(user_trailer_label, field)
+                if field == 'count_balance_records' and expected_value is None and not counted_value:
+                    continue
+                if counted_value != expected_value:
+                    account_errors.append('%s does not match expected: counted %s, expected %s' % (
+                        description, counted_value, expected_value
+                    ))
+            if account_errors:
+                errors['account %s' % account] = account_errors
+        return errors
+
+    def account_mask(self, sort_code, account_number):
+        return (
+            (self.sort_codes == sort_code.rjust(6).encode()) &
+            (self.account_numbers == account_number.rjust(8).encode())
+        )
+
+    def transaction_lines(self, sort_code, account_number):
+        """
+        Returns the lines of the records for the given account that are credits or debits,
+        i.e. excluding totals and balances
+        """
+        mask = self.account_mask(sort_code, account_number) & (self.credits | self.debits)
+        return [self.lines[row] for row in self.record_rows[mask]]
+
+    def balance_records(self, sort_code, account_number):
+        mask = self.account_mask(sort_code, account_number) & self.balances
+        return [models.BalanceRecord(self.lines[row]) for row in self.record_rows[mask]]
+
+    def totals(self, sort_code, account_number):
+        """
+        Returns the count and sum of credits and of debits for the given account
+        """
+        account_mask = self.account_mask(sort_code, account_number)
+        credits = account_mask & self.credits
+        debits = account_mask & self.debits
+        return {
+            'credit_count': int(credits.sum()),
+            'credit_total': int(self.amounts[credits].sum()),
+            'debit_count': int(debits.sum()),
+            'debit_total': int(self.amounts[debits].sum()),
+        }
+
+    def net_amount(self, sort_code, account_number):
+        totals = self.totals(sort_code, account_number)
+        return totals['credit_total'] - totals['debit_total']
@@ -0,0 +1,71 @@
+import logging
+import random
+import signal
+import threading
+
+from mtp_transaction_uploader import api_client, settings, upload
+from mtp_transaction_uploader.sources import get_statement_source
+
+logger = logging.getLogger('mtp')
+
+
+class UploaderDaemon:
+    """
+    Stays resident and runs the uploader on a schedule, keeping SFTP and API connections
+    open between polls; stops between files when sent SIGTERM or SIGINT.
+    Sources that can detect new files (e.g. a local drop directory) cut the wait short
+    """
+
+    def __init__(self, poll_interval=None, poll_jitter=None, max_backoff=None, source=None):
+        self.poll_interval = settings.DAEMON_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.poll_jitter = settings.DAEMON_POLL_JITTER if poll_jitter is None else poll_jitter
+        self.max_backoff = settings.DAEMON_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.stop_event = threading.Event()
+        self.source = source or get_statement_source()
+        self.consecutive_failures = 0
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        logger.info('Received signal %d, stopping once current file is complete' % signum)
+        self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def should_stop(self):
+        return self.stop_event.is_set()
+
+    def run(self):
+        logger.info('Transaction uploader daemon started, polling every %ds' % self.poll_interval)
+        self.install_signal_handlers()
+        with api_client.reuse_connection():
+            try:
+                while not self.should_stop():
+                    self.poll()
+                    self.source.wait_for_changes(self.next_delay(), self.stop_event)
+            finally:
+                self.close_connections()
+        logger.info('Transaction uploader daemon stopped')
+
+    def poll(self):
+        try:
+            upload.main(source=self.source, should_stop=self.should_stop)
+        except Exception:
+            self.consecutive_failures += 1
+            logger.exception('Transaction upload failed, reconnecting before next poll')
+            self.close_connections()
+        else:
+            self.consecutive_failures = 0
+
+    def next_delay(self):
+        delay = self.poll_interval
+        if self.consecutive_failures:
+            delay = min(delay * 2 ** self.consecutive_failures, self.max_backoff)
+        return delay + random.uniform(0, self.poll_jitter)
+
+    def close_connections(self):
+        self.source.close()
+        api_client.reset_connection()
@@ -0,0 +1,147 @@
+"""
+Local index of uploaded transactions so that reprocessed files only post transactions which are new
+
+Transactions are identified by a fingerprint of their amount, sender sort code and account number, reference,
+received date and processor type code. Identical transactions can legitimately arrive on the same day so the
+index counts how many transactions with each fingerprint have been uploaded and only skips that many.
+"""
+import collections
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+
+from mtp_transaction_uploader import settings
+
+logger = logging.getLogger('mtp')
+
+FINGERPRINT_FIELDS = (
+    'amount', 'sender_sort_code', 'sender_account_number', 'reference', 'received_at', 'processor_type_code',
+)
+# fingerprints looked up per query, within SQLite's limit on bound parameters
+LOOKUP_BATCH_SIZE = 500
+SEED_PAGE_SIZE = 500
+
+_fingerprint_index = None
+_fingerprint_index_lock = threading.Lock()
+
+
+def get_fingerprint(transaction) -> str:
+    values = [transaction.get(field) for field in FINGERPRINT_FIELDS]
+    # transactions are received at noon on their statement's date, but the API may format the time differently
+    received_at = FINGERPRINT_FIELDS.index('received_at')
+    values[received_at] = values[received_at][:10] if values[received_at] else None
+    return json.dumps(values, separators=(',', ':'))
+
+
+class FingerprintIndex:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS uploaded_transactions '
+                '(fingerprint TEXT PRIMARY KEY, upload_count INTEGER NOT NULL) WITHOUT ROWID'
+            )
+
+    def get_upload_counts(self, fingerprints) -> dict:
+        fingerprints = list(set(fingerprints))
+        upload_counts = {}
+        with self.lock:
+            for i in range(0, len(fingerprints), LOOKUP_BATCH_SIZE):
+                batch = fingerprints[i:i + LOOKUP_BATCH_SIZE]
+                upload_counts.update(self.db.execute(
+                    'SELECT fingerprint, upload_count FROM uploaded_transactions WHERE fingerprint IN (%s)' %
+                    ','.join('?' * len(batch)),
+                    batch
+                ))
+        return upload_counts
+
+    def new_transactions(self, transactions) -> list:
+        """
+        Returns the transactions not already uploaded, keeping their order
+        """
+        return [transactions[position] for position in self.new_positions(transactions)]
+
+    def new_positions(self, transactions) -> list:
+        """
+        Returns the positions of the transactions not already uploaded, in order
+        """
+        fingerprints = list(map(get_fingerprint, transactions))
+        upload_counts = self.get_upload_counts(fingerprints)
+        seen = collections.Counter()
+        new_positions = []
+        for position, fingerprint in enumerate(fingerprints):
+            seen[fingerprint] += 1
+            if seen[fingerprint] > upload_counts.get(fingerprint, 0):
+                new_positions.append(position)
+        return new_positions
+
+    def record(self, transactions):
+        """
+        Records transactions which have just been uploaded
+        """
+        self.update(
+            collections.Counter(map(get_fingerprint, transactions)),
+            'upload_count = upload_count + excluded.upload_count'
+        )
+
+    def seed(self, upload_counts: collections.Counter):
+        """
+        Records transactions known to the API, keeping any higher counts already in the index
+        """
+        self.update(upload_counts, 'upload_count = MAX(upload_count, excluded.upload_count)')
+
+    def update(self, upload_counts, conflict_update):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO uploaded_transactions (fingerprint, upload_count) VALUES (?, ?) '
+                'ON CONFLICT (fingerprint) DO UPDATE SET %s' % conflict_update,
+                upload_counts.items()
+            )
+
+    def close(self):
+        self.db.close()
+
+
+def get_fingerprint_index():
+    """
+    Returns the shared index if FINGERPRINT_INDEX_PATH is set
+    """
+    global _fingerprint_index
+
+    if not settings.FINGERPRINT_INDEX_PATH:
+        return None
+    with _fingerprint_index_lock:
+        if _fingerprint_index is None:
+            _fingerprint_index = FingerprintIndex(settings.FINGERPRINT_INDEX_PATH)
+        return _fingerprint_index
+
+
+def seed_fingerprint_index(conn, index: FingerprintIndex, start_date: datetime.date, end_date: datetime.date) -> int:
+    """
+    Adds transactions received by the API within the date range, inclusive, to the index
+    """
+    upload_counts = collections.Counter()
+    offset = 0
+    while True:
+        response = conn.transactions.get(
+            received_at__gte=start_date.isoformat(),
+            received_at__lt=(end_date + datetime.timedelta(days=1)).isoformat(),
+            ordering='received_at', offset=offset, limit=SEED_PAGE_SIZE,
+        )
+        results = response.get('results') or []
+        upload_counts.update(map(get_fingerprint, results))
+        offset += len(results)
+        if not results or offset >= response.get('count', 0):
+            break
+    index.seed(upload_counts)
+    logger.info('Seeded fingerprint index with %d transactions from %s to %s' % (
+        offset, start_date.isoformat(), end_date.isoformat()
+    ), extra={
+        'elk_fields': {
+            '@fields.transaction_count': offset,
+        }
+    })
+    return offset
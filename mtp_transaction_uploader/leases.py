@@ -0,0 +1,347 @@
+"""
+Lease-based claiming of statement files so that several uploader instances can share the work
+
+Each instance claims a file before processing it and holds the claim as a lease which expires unless renewed
+by the instance's heartbeat, so files claimed by an instance that dies are picked up again. Completed files are
+recorded with their net amount so that any instance can commit closing balances, in date order, once all earlier
+files are complete; files are retrieved from after the last committed balance rather than the last transaction.
+How far through a file uploads have got is also recorded so that a file which fails part-way is resumed.
+"""
+import abc
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+from slumber.exceptions import SlumberHttpBaseException
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.budget import StatementProgress
+from mtp_transaction_uploader.sinks import SinkConnection
+from mtp_transaction_uploader.upload import (
+    BankAccount, StatementTransactions, calculate_closing_balance, get_authenticated_connection, get_last_balance_date,
+    load_statement, log_failed_statement, parse_filename_for_accounts, post_statement, update_new_balances,
+)
+
+logger = logging.getLogger('mtp')
+
+BALANCES_LEASE = 'closing-balances'
+
+
+class LeaseBackend(abc.ABC):
+    """
+    Shared storage for leases and for records of completed files
+    """
+
+    @abc.abstractmethod
+    def acquire(self, name, owner, duration) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def renew(self, name, owner, duration) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def release(self, name, owner):
+        pass
+
+    @abc.abstractmethod
+    def mark_completed(self, name, details: dict):
+        pass
+
+    @abc.abstractmethod
+    def get_completed(self, name) -> typing.Optional[dict]:
+        pass
+
+    @abc.abstractmethod
+    def remove_completed_before(self, date: datetime.date) -> int:
+        pass
+
+    @abc.abstractmethod
+    def record_progress(self, name, uploaded_count):
+        pass
+
+    @abc.abstractmethod
+    def get_progress(self, name) -> int:
+        pass
+
+
+class DirectoryLeaseBackend(LeaseBackend):
+    """
+    Keeps leases as files in a directory on storage shared by all instances, relying on hard links failing
+    if the lease file already exists; lease expiry uses wall-clock time so instances' clocks need to be kept in sync
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def lease_path(self, name):
+        return os.path.join(self.path, '%s.lease' % name)
+
+    def completed_path(self, name):
+        return os.path.join(self.path, '%s.done' % name)
+
+    def progress_path(self, name):
+        return os.path.join(self.path, '%s.progress' % name)
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, path, contents):
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(contents, f)
+        os.replace(temporary_path, path)
+
+    def acquire(self, name, owner, duration):
+        path = self.lease_path(name)
+        lease = {'owner': owner, 'expires_at': time.time() + duration}
+        # the lease is written in full before it is linked into place so that other instances never read it partly
+        # written, which they would take to be an expired lease
+        temporary_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temporary_path, 'w') as f:
+            json.dump(lease, f)
+        try:
+            os.link(temporary_path, path)
+        except FileExistsError:
+            return self.take_over_expired(name, lease, duration)
+        finally:
+            os.remove(temporary_path)
+        return True
+
+    def take_over_expired(self, name, lease, duration):
+        path = self.lease_path(name)
+        current_lease = self.read(path)
+        if current_lease and current_lease['expires_at'] > time.time():
+            return False
+
+        # only one instance at a time can take over an expired lease
+        takeover_path = '%s.takeover' % path
+        try:
+            os.close(os.open(takeover_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # clear up after an instance that died while taking over
+            if time.time() - os.stat(takeover_path).st_mtime > duration:
+                os.remove(takeover_path)
+            return False
+        try:
+            current_lease = self.read(path)
+            if current_lease and current_lease['expires_at'] > time.time():
+                return False
+            self.write(path, lease)
+            return True
+        finally:
+            os.remove(takeover_path)
+
+    def renew(self, name, owner, duration):
+        path = self.lease_path(name)
+        current_lease = self.read(path)
+        if not current_lease or current_lease['owner'] != owner:
+            return False
+        self.write(path, {'owner': owner, 'expires_at': time.time() + duration})
+        return True
+
+    def release(self, name, owner):
+        path = self.lease_path(name)
+        current_lease = self.read(path)
+        if current_lease and current_lease['owner'] == owner:
+            os.remove(path)
+
+    def mark_completed(self, name, details):
+        self.write(self.completed_path(name), details)
+        try:
+            os.remove(self.progress_path(name))
+        except FileNotFoundError:
+            pass
+
+    def get_completed(self, name):
+        return self.read(self.completed_path(name))
+
+    def remove_completed_before(self, date):
+        removed_count = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.done'):
+                continue
+            completed = self.read(entry.path)
+            if completed is None or datetime.date.fromisoformat(completed['date']) >= date:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            removed_count += 1
+        return removed_count
+
+    def record_progress(self, name, uploaded_count):
+        self.write(self.progress_path(name), {'uploaded_count': uploaded_count})
+
+    def get_progress(self, name):
+        progress = self.read(self.progress_path(name))
+        return progress['uploaded_count'] if progress else 0
+
+
+def get_lease_backend() -> LeaseBackend:
+    if settings.LEASE_BACKEND == 'directory':
+        return DirectoryLeaseBackend(settings.LEASE_DIR)
+    raise ValueError('Unknown lease backend "%s"' % settings.LEASE_BACKEND)
+
+
+class Leases:
+    """
+    Leases held by this instance, renewed by a heartbeat thread until released
+    """
+
+    def __init__(self, backend: LeaseBackend, owner=None, duration=None):
+        self.backend = backend
+        self.owner = owner or settings.INSTANCE_ID or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.duration = duration or settings.LEASE_SECONDS
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+
+    def __enter__(self):
+        self.stop_event.clear()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        for name in list(self.held):
+            self.release(name)
+
+    def claim(self, name) -> bool:
+        if not self.backend.acquire(name, self.owner, self.duration):
+            return False
+        with self.lock:
+            self.held.add(name)
+        return True
+
+    def release(self, name):
+        with self.lock:
+            self.held.discard(name)
+        self.backend.release(name, self.owner)
+
+    def heartbeat(self):
+        while not self.stop_event.wait(self.duration / 3):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                if not self.backend.renew(name, self.owner, self.duration):
+                    logger.warning('Lease on %s was lost' % name)
+                    with self.lock:
+                        self.held.discard(name)
+
+
+def upload_claimed_files(files, should_stop=None, bank_account: BankAccount = None, backend: LeaseBackend = None):
+    """
+    Uploads the date-ordered files which this instance can claim and which no instance has completed,
+    then commits closing balances for completed files if no other instance is doing so
+    """
+    backend = backend or get_lease_backend()
+    conn = get_authenticated_connection()
+    successful_transaction_count = 0
+    with Leases(backend) as leases:
+        for filename in files:
+            if should_stop and should_stop():
+                break
+            name = os.path.basename(filename)
+            if backend.get_completed(name) is not None or not leases.claim(name):
+                continue
+            try:
+                # another instance may have completed the file just before it was claimed
+                if backend.get_completed(name) is None:
+                    successful_transaction_count += upload_claimed_file(conn, backend, filename, bank_account)
+            finally:
+                leases.release(name)
+        commit_balances(conn, files, backend, leases)
+    return successful_transaction_count
+
+
+def upload_claimed_file(conn, backend: LeaseBackend, filename, bank_account: BankAccount = None) -> int:
+    name = os.path.basename(filename)
+    # dry runs leave files for real runs to complete
+    dry_run = isinstance(conn, SinkConnection)
+    statement = load_statement(filename, bank_account=bank_account)
+    if statement is None:
+        if dry_run:
+            return 0
+        backend.mark_completed(name, {
+            'date': parse_filename_for_accounts(name, [bank_account.code] if bank_account else None).isoformat(),
+            'net_amount': None,
+            'file_balance': None,
+        })
+        return 0
+
+    transaction_count = len(statement.transactions)
+    progress = None if dry_run else StatementProgress(
+        statement, backend.get_progress(name), lambda uploaded_count: backend.record_progress(name, uploaded_count),
+    )
+    try:
+        post_statement(conn, statement, budget=progress)
+    except SlumberHttpBaseException as e:
+        # left incomplete so that the next instance to claim it resumes after the last chunk posted
+        log_failed_statement(statement, e)
+        return 0
+    logger.info('Uploaded %d transactions from %s' % (transaction_count, statement.filename))
+    if dry_run:
+        return transaction_count
+    backend.mark_completed(name, {
+        'date': statement.date.isoformat(),
+        'net_amount': calculate_closing_balance(0, statement.transactions, net_amount=statement.net_amount),
+        'file_balance': statement.file_balance,
+    })
+    return transaction_count
+
+
+def commit_balances(conn, files, backend: LeaseBackend, leases: Leases):
+    """
+    Commits closing balances for the completed files preceding the first file that is not yet complete
+    """
+    if not leases.claim(BALANCES_LEASE):
+        return
+    statements = []
+    try:
+        # another instance may have committed balances since the files were listed
+        last_balance_date = get_last_balance_date(conn)
+        for filename in files:
+            completed = backend.get_completed(os.path.basename(filename))
+            if completed is None:
+                break
+            date = datetime.date.fromisoformat(completed['date'])
+            if completed['net_amount'] is not None and (last_balance_date is None or date > last_balance_date):
+                statements.append(StatementTransactions(
+                    filename, date, [], completed['file_balance'], completed['net_amount'],
+                ))
+        if statements:
+            update_new_balances(statements)
+            last_balance_date = statements[-1].date
+        if last_balance_date and settings.LEASE_RETENTION_DAYS:
+            remove_completed_files(backend, last_balance_date - datetime.timedelta(days=settings.LEASE_RETENTION_DAYS))
+    except SlumberHttpBaseException as e:
+        logger.error('Failed to update balances for %d statements.\n%s' % (
+            len(statements), getattr(e, 'content', e)
+        ))
+    finally:
+        leases.release(BALANCES_LEASE)
+
+
+def remove_completed_files(backend: LeaseBackend, date):
+    """
+    Removes records of files completed before the given date, whose balances have already been committed
+    so they are no longer retrieved
+    """
+    removed_count = backend.remove_completed_before(date)
+    if removed_count:
+        logger.info('Removed %d records of files completed before %s' % (removed_count, date.isoformat()))
@@ -0,0 +1,126 @@
+"""
+Tracking of the process's memory use against MEMORY_BUDGET_BYTES
+
+When resident memory nears the budget, the run applies back-pressure: upload chunks are made smaller, downloads
+are written to disk instead of being kept in memory and files are parsed one at a time instead of ahead of uploads.
+Only this process is measured, not parse worker processes. Python allocations can also be traced to find where
+memory goes, at the cost of slowing the run down.
+"""
+import logging
+import resource
+import sys
+import tracemalloc
+
+from mtp_transaction_uploader import settings
+
+logger = logging.getLogger('mtp')
+
+PAGE_SIZE = resource.getpagesize()
+# upload chunks are cut to this fraction of UPLOAD_REQUEST_SIZE under memory pressure
+PRESSURE_CHUNK_DIVISOR = 4
+# number of source lines with the largest traced allocations which are reported
+TRACED_ALLOCATION_SITES = 10
+
+
+def get_rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        # peak rather than current usage where /proc is unavailable
+        return get_peak_rss()
+
+
+def get_peak_rss() -> int:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def reset_peak_rss():
+    # lets the peak of each run be measured in long-lived daemon processes; not possible outside Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class MemoryMonitor:
+    def __init__(self):
+        # number of times memory came under pressure, rather than the number of probes which found it so
+        self.pressure_count = 0
+        self.pressured = False
+
+    def reset(self):
+        self.pressure_count = 0
+        self.pressured = False
+        reset_peak_rss()
+        if settings.MEMORY_TRACE_ALLOCATIONS:
+            if tracemalloc.is_tracing():
+                tracemalloc.clear_traces()
+            else:
+                tracemalloc.start()
+
+    def under_pressure(self) -> bool:
+        if not settings.MEMORY_BUDGET_BYTES:
+            return False
+        pressured = get_rss() >= settings.MEMORY_BUDGET_BYTES * settings.MEMORY_PRESSURE_THRESHOLD
+        if pressured and not self.pressured:
+            self.pressure_count += 1
+        self.pressured = pressured
+        return pressured
+
+    def chunk_size(self, size) -> int:
+        if self.under_pressure():
+            return max(1, size // PRESSURE_CHUNK_DIVISOR)
+        return size
+
+    def log_report(self):
+        if tracemalloc.is_tracing():
+            self.log_traced_allocations()
+        peak_rss = get_peak_rss()
+        elk_fields = {
+            '@fields.peak_rss_bytes': peak_rss,
+            '@fields.memory_pressure_count': self.pressure_count,
+        }
+        if not settings.MEMORY_BUDGET_BYTES:
+            logger.info('Peak memory use was %.1fMB' % (peak_rss / 1000000), extra={'elk_fields': elk_fields})
+            return
+
+        budget_used = peak_rss / settings.MEMORY_BUDGET_BYTES
+        elk_fields['@fields.memory_budget_used'] = round(budget_used, 3)
+        logger.log(
+            logging.WARNING if budget_used > 1 else logging.INFO,
+            'Peak memory use was %.1fMB, %.0f%% of the %.1fMB budget; back-pressure was applied %d times' % (
+                peak_rss / 1000000, budget_used * 100, settings.MEMORY_BUDGET_BYTES / 1000000, self.pressure_count
+            ),
+            extra={'elk_fields': elk_fields}
+        )
+
+    def log_traced_allocations(self):
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        allocation_sites = '\n'.join(
+            '%s: %.1fMB in %d blocks' % (statistic.traceback[0], statistic.size / 1000000, statistic.count)
+            for statistic in snapshot.statistics('lineno')[:TRACED_ALLOCATION_SITES]
+        )
+        logger.info('Traced Python allocations were %.1fMB, peaking at %.1fMB; largest by line:\n%s' % (
+            traced / 1000000, traced_peak / 1000000, allocation_sites
+        ), extra={
+            'elk_fields': {
+                '@fields.traced_bytes': traced,
+                '@fields.traced_peak_bytes': traced_peak,
+            }
+        })
+
+
+memory_monitor = MemoryMonitor()
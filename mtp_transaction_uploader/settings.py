@@ -14,9 +14,96 @@ SFTP_HOST = os.environ.get('SFTP_HOST', '')
 SFTP_USER = os.environ.get('SFTP_USER', '')
 SFTP_PRIVATE_KEY = os.environ.get('SFTP_PRIVATE_KEY', '~/.ssh/id_rsa')
 SFTP_DIR = os.environ.get('SFTP_DIR', '')
+# SSH transport compression; fixed-width statements compress well over slow links
+SFTP_COMPRESSION = os.environ.get('SFTP_COMPRESSION', '').lower() in ('1', 'true')
+# SFTP channel window and maximum packet size in bytes; 0 uses paramiko's defaults
+SFTP_WINDOW_SIZE = int(os.environ.get('SFTP_WINDOW_SIZE', '0'))
+SFTP_MAX_PACKET_SIZE = int(os.environ.get('SFTP_MAX_PACKET_SIZE', '0'))
+# pipelined reads when downloading, optionally limiting the number of outstanding read requests (0 is unlimited)
+SFTP_PREFETCH = os.environ.get('SFTP_PREFETCH', 'true').lower() in ('1', 'true')
+SFTP_MAX_PREFETCH_REQUESTS = int(os.environ.get('SFTP_MAX_PREFETCH_REQUESTS', '0'))
 ACCOUNT_CODE = os.environ.get('ACCOUNT_CODE', '444444')
 
 UPLOAD_REQUEST_SIZE = int(os.environ.get('UPLOAD_REQUEST_SIZE', '1000'))
+# number of worker processes used to parse and transform files in parallel; uploads still happen in date order
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', '1'))
+# number of worker processes used to convert a single file's records into transactions,
+# only used for files with more records than the shard size. parsing and classification share one pool of
+# the larger of the two numbers of processes; files parsed in workers have their records classified serially
+CLASSIFY_WORKERS = int(os.environ.get('CLASSIFY_WORKERS', '1'))
+CLASSIFY_SHARD_SIZE = int(os.environ.get('CLASSIFY_SHARD_SIZE', '5000'))
+# when enabled, record fields are decoded straight from the file's lines into NumPy columns so that validation,
+# account filtering and balance totals are vectorised and records are only built for relevant lines.
+# requires NumPy, an optional dependency installed with requirements/columnar.txt
+COLUMNAR_RECORDS = os.environ.get('COLUMNAR_RECORDS', '').lower() in ('1', 'true')
+# when enabled, transactions from consecutive files are packed together into full-size upload requests
+PACK_UPLOAD_CHUNKS = os.environ.get('PACK_UPLOAD_CHUNKS', '').lower() in ('1', 'true')
+# when enabled, API request bodies are sent gzip-encoded at the given compression level (1-9)
+GZIP_REQUESTS = os.environ.get('GZIP_REQUESTS', '').lower() in ('1', 'true')
+GZIP_COMPRESSION_LEVEL = int(os.environ.get('GZIP_COMPRESSION_LEVEL', '6'))
+# when enabled, transactions are serialised one at a time into a streamed request body
+# either as a JSON array ("json") or as newline-delimited JSON ("ndjson")
+STREAM_UPLOADS = os.environ.get('STREAM_UPLOADS', '').lower() in ('1', 'true')
+STREAM_UPLOAD_FORMAT = os.environ.get('STREAM_UPLOAD_FORMAT', 'json')
+
+# maximum transaction upload requests started per second across all threads; 0 is unlimited
+API_RATE_LIMIT = float(os.environ.get('API_RATE_LIMIT', '0'))
+# number of statements uploaded concurrently when backfilling a date range
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', '4'))
+
+# when set, instances sharing this directory claim statement files through expiring leases so that
+# they process disjoint files; leases are renewed by a heartbeat and expire if an instance dies.
+# only applies to single-account runs
+LEASE_DIR = os.environ.get('LEASE_DIR', '')
+LEASE_BACKEND = os.environ.get('LEASE_BACKEND', 'directory')
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', '300'))
+# records of completed files dated this many days before the last committed closing balance are removed, 0 keeps them
+LEASE_RETENTION_DAYS = int(os.environ.get('LEASE_RETENTION_DAYS', '7'))
+# identifies this instance as a lease holder, defaults to hostname and process id
+INSTANCE_ID = os.environ.get('INSTANCE_ID', '')
+
+# wall-clock budget for each run in seconds, 0 is unlimited; no more files or upload chunks are started once
+# they would be expected to finish after the budget, and the next run resumes from the checkpoint
+RUN_BUDGET_SECONDS = float(os.environ.get('RUN_BUDGET_SECONDS', '0'))
+RUN_CHECKPOINT_PATH = os.environ.get('RUN_CHECKPOINT_PATH', '/tmp/mtp_run_checkpoint.json')
+
+# resident memory limit for the uploader process in bytes, 0 is unlimited; once memory use passes the threshold
+# fraction of the budget, upload chunks are made smaller, downloads are written to disk and files are parsed
+# one at a time. each run logs its peak memory use
+MEMORY_BUDGET_BYTES = int(os.environ.get('MEMORY_BUDGET_BYTES', '0'))
+MEMORY_PRESSURE_THRESHOLD = float(os.environ.get('MEMORY_PRESSURE_THRESHOLD', '0.8'))
+# when enabled, Python allocations are traced with tracemalloc and each run logs the lines which allocated
+# the most memory still held at the end of the run; tracing slows runs down so is meant for investigations
+MEMORY_TRACE_ALLOCATIONS = os.environ.get('MEMORY_TRACE_ALLOCATIONS', '').lower() in ('1', 'true')
+
+# when set, API lookups of settlement batches and previous closing balances are cached in this SQLite database;
+# comma-separated `endpoint:seconds` pairs set how long each endpoint's responses are kept.
+# cached responses are dropped when the uploader posts to the endpoint; balances are never cached when LEASE_DIR is set
+API_CACHE_PATH = os.environ.get('API_CACHE_PATH', '')
+API_CACHE_TTLS = {
+    endpoint: float(ttl)
+    for endpoint, ttl in (
+        pair.split(':') for pair in os.environ.get('API_CACHE_TTLS', 'batches:86400,balances:3600').split(',') if pair
+    )
+}
+
+# when set, fingerprints of uploaded transactions are kept in this SQLite database and transactions
+# already uploaded are skipped when a file is processed again
+FINGERPRINT_INDEX_PATH = os.environ.get('FINGERPRINT_INDEX_PATH', '')
+
+# when enabled, the opening balance is fetched once per run and closing balances are rolled forward locally
+# through the date-ordered files, each being posted as soon as its file has been uploaded
+CHAIN_BALANCES = os.environ.get('CHAIN_BALANCES', '').lower() in ('1', 'true')
+
+# when enabled, the ledger balance carried by the data services file for our account is checked against
+# the calculated closing balance; once a balance has been confirmed this way, the next file in the run
+# does not need to look up its previous balance
+USE_FILE_BALANCES = os.environ.get('USE_FILE_BALANCES', '').lower() in ('1', 'true')
+
+# daemon mode polling schedule in seconds; failed polls back off exponentially up to the maximum
+DAEMON_POLL_INTERVAL = int(os.environ.get('DAEMON_POLL_INTERVAL', '60'))
+DAEMON_POLL_JITTER = int(os.environ.get('DAEMON_POLL_JITTER', '10'))
+DAEMON_MAX_BACKOFF = int(os.environ.get('DAEMON_MAX_BACKOFF', '900'))
 
 START_PAGE_URL = os.environ.get('START_PAGE_URL', 'https://www.gov.uk/send-prisoner-money')
 CASHBOOK_URL = (
@@ -49,10 +136,41 @@ API_URL = os.environ.get('API_URL', 'http://localhost:8000')
 PUBLIC_STATIC_URL = urljoin(SEND_MONEY_URL, '/static/')
 
 DS_NEW_FILES_DIR = os.environ.get('DS_NEW_FILES_DIR', '/tmp/ds_new_files')
+# downloaded files are kept in memory and parsed from there instead of being written to DS_NEW_FILES_DIR;
+# files larger than the spill threshold, or that would take the run over its memory limit, are still written to disk.
+# leave disabled if the copies in DS_NEW_FILES_DIR are wanted
+DOWNLOAD_TO_MEMORY = os.environ.get('DOWNLOAD_TO_MEMORY', '').lower() in ('1', 'true')
+DOWNLOAD_MEMORY_LIMIT_BYTES = int(os.environ.get('DOWNLOAD_MEMORY_LIMIT_BYTES', str(200 * 1000 * 1000)))
+DOWNLOAD_SPILL_BYTES = int(os.environ.get('DOWNLOAD_SPILL_BYTES', str(20 * 1000 * 1000)))
+
+# where the `transform` stage writes batches of cleaned transactions for the `upload` stage to post
+BATCH_DIR = os.environ.get('BATCH_DIR', '/tmp/ds_batches')
+# uploaded batches are removed this many days after upload along with their file in DS_NEW_FILES_DIR, 0 keeps them
+BATCH_RETENTION_DAYS = int(os.environ.get('BATCH_RETENTION_DAYS', '7'))
+
+# where data services files are retrieved from: `sftp` downloads them into DS_NEW_FILES_DIR,
+# `local` reads them in place from LOCAL_STATEMENT_DIR (e.g. a mounted drop directory)
+STATEMENT_SOURCE = os.environ.get('STATEMENT_SOURCE', 'sftp').lower()
+LOCAL_STATEMENT_DIR = os.environ.get('LOCAL_STATEMENT_DIR', '')
+# local files are only picked up once unmodified for this many seconds so that partial writes are skipped
+LOCAL_STATEMENT_SETTLE_SECONDS = float(os.environ.get('LOCAL_STATEMENT_SETTLE_SECONDS', '5'))
+# how often the local drop directory is checked for changes if `watchdog` is not installed
+LOCAL_STATEMENT_POLL_INTERVAL = float(os.environ.get('LOCAL_STATEMENT_POLL_INTERVAL', '1'))
 
 # fallback account is for tests
 NOMS_AGENCY_ACCOUNT_NUMBER = os.environ.get('NOMS_AGENCY_ACCOUNT_NUMBER', '67175315')
 NOMS_AGENCY_SORT_CODE = os.environ.get('NOMS_AGENCY_SORT_CODE', '123456')
+# comma-separated bank accounts to process in the same run, each as `account_code:sort_code:account_number`;
+# when empty, only the account configured with ACCOUNT_CODE and the settings above is processed.
+# the API only keeps closing balances for the account configured with ACCOUNT_CODE, so other accounts keep theirs
+# in a local database for each account in ACCOUNT_BALANCES_DIR, which must persist between runs.
+# each account's files are retrieved from after its own last closing balance, and accounts are uploaded concurrently
+ACCOUNTS = [
+    tuple(account.split(':'))
+    for account in os.environ.get('ACCOUNTS', '').split(',')
+    if account
+]
+ACCOUNT_BALANCES_DIR = os.environ.get('ACCOUNT_BALANCES_DIR', '')
 
 # WorldPay settlements can be in the form:
 # - "PREFIX0101" with the last 4 digits being a day/month
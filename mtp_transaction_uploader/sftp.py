@@ -0,0 +1,54 @@
+"""
+SFTP connections made with paramiko's public API so that the SFTP channel's window and packet sizes can be tuned
+"""
+import contextlib
+import os
+
+
+class SFTPConnection:
+    """
+    Connection authenticated with a private key; the server's host key is not verified
+    """
+
+    def __init__(self, host, username=None, private_key=None, port=22, compression=False,
+                 window_size=None, max_packet_size=None):
+        # paramiko pulls in cryptography so is only imported when a connection is needed
+        import paramiko
+
+        self.transport = paramiko.Transport((host, port))
+        try:
+            self.transport.use_compression(compression)
+            self.transport.connect(
+                username=username, pkey=paramiko.PKey.from_path(os.path.expanduser(private_key)),
+            )
+            self.sftp_client = paramiko.SFTPClient.from_transport(
+                self.transport, window_size=window_size, max_packet_size=max_packet_size,
+            )
+        except Exception:
+            self.transport.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def cd(self, path):
+        previous_path = self.sftp_client.getcwd()
+        self.sftp_client.chdir(path)
+        try:
+            yield
+        finally:
+            self.sftp_client.chdir(previous_path)
+
+    def listdir(self, path='.'):
+        return self.sftp_client.listdir(path)
+
+    def stat(self, path):
+        return self.sftp_client.stat(path)
+
+    def close(self):
+        self.sftp_client.close()
+        self.transport.close()
@@ -0,0 +1,102 @@
+"""
+Destinations for the transactions and closing balances a run would post to the API
+
+A sink is installed with `api_client.set_sink`, after which authenticated connections pass
+reads through to the API as normal but hand everything they would post to the sink instead.
+"""
+import abc
+import collections
+import json
+import logging
+
+logger = logging.getLogger('mtp')
+
+
+class Sink(abc.ABC):
+    def __init__(self):
+        self.record_counts = collections.Counter()
+
+    def post(self, resource_name, data):
+        items = data if isinstance(data, list) else [data]
+        self.record_counts[resource_name] += len(items)
+        self.write(resource_name, items)
+
+    @abc.abstractmethod
+    def write(self, resource_name, items):
+        pass
+
+    def close(self):
+        for resource_name, count in sorted(self.record_counts.items()):
+            logger.info('%s received %d %s records' % (type(self).__name__, count, resource_name))
+
+
+class NullSink(Sink):
+    """
+    Discards everything, only counting records
+    """
+
+    def write(self, resource_name, items):
+        pass
+
+
+class NDJSONFileSink(Sink):
+    """
+    Writes each record as a line of JSON tagged with the API resource it was destined for
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'w')
+
+    def write(self, resource_name, items):
+        for item in items:
+            self.file.write(json.dumps({'resource': resource_name, 'data': item}))
+            self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class SinkResource:
+    def __init__(self, resource, resource_name, sink: Sink):
+        self.resource = resource
+        self.resource_name = resource_name
+        self.sink = sink
+
+    def __call__(self, *args, **kwargs):
+        return SinkResource(self.resource(*args, **kwargs), self.resource_name, self.sink)
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def post(self, data=None, **kwargs):
+        self.sink.post(self.resource_name, data)
+
+
+class SinkConnection:
+    """
+    Wraps an API connection so that posts go to a sink
+    """
+
+    def __init__(self, conn, sink: Sink):
+        self.conn = conn
+        self.sink = sink
+
+    def __getattr__(self, name):
+        return SinkResource(getattr(self.conn, name), name, self.sink)
+
+
+def get_sink(name, path=None):
+    """
+    Returns the named sink or None if posts should go to the API
+    """
+    if name == 'api':
+        return None
+    if name == 'noop':
+        return NullSink()
+    if name == 'ndjson':
+        if not path:
+            raise ValueError('An output path is needed for the NDJSON sink')
+        return NDJSONFileSink(path)
+    raise ValueError('Unknown sink "%s"' % name)
@@ -0,0 +1,189 @@
+import abc
+import logging
+import os
+import threading
+import time
+import typing
+
+from mtp_transaction_uploader import settings
+
+if typing.TYPE_CHECKING:
+    from mtp_transaction_uploader.upload import NewFiles
+
+logger = logging.getLogger('mtp')
+
+
+class StatementSource(abc.ABC):
+    """
+    Somewhere data services files are retrieved from
+    """
+    # whether files are copied into DS_NEW_FILES_DIR rather than read in place
+    downloads_files = True
+
+    @abc.abstractmethod
+    def retrieve_new_files(self, last_date, end_date=None, account_codes=None) -> 'NewFiles':
+        """
+        Returns files for the given account codes (by default ACCOUNT_CODE) dated after `last_date`
+        and, if given, up to and including `end_date`
+        """
+
+    def wait_for_changes(self, timeout, stop_event):
+        """
+        Blocks until new files may be available, the timeout passes or `stop_event` is set
+        """
+        stop_event.wait(timeout)
+
+    def close(self):
+        pass
+
+
+class SFTPStatementSource(StatementSource):
+    """
+    Downloads new files over SFTP, keeping the connection open between retrievals
+    """
+
+    def __init__(self):
+        self.sftp_conn = None
+
+    def retrieve_new_files(self, last_date, end_date=None, account_codes=None) -> 'NewFiles':
+        # the uploader and its dependencies are only imported when files are first retrieved
+        from mtp_transaction_uploader.upload import download_new_files
+
+        return download_new_files(
+            last_date, sftp_conn=self.get_sftp_connection(), end_date=end_date, account_codes=account_codes
+        )
+
+    def get_sftp_connection(self):
+        if self.sftp_conn is not None and not sftp_connection_active(self.sftp_conn):
+            self.close()
+        if self.sftp_conn is None:
+            from mtp_transaction_uploader.upload import open_sftp_connection
+
+            self.sftp_conn = open_sftp_connection()
+        return self.sftp_conn
+
+    def close(self):
+        if self.sftp_conn is not None:
+            try:
+                self.sftp_conn.close()
+            except Exception:
+                logger.warning('Error closing SFTP connection', exc_info=True)
+            self.sftp_conn = None
+
+
+class LocalDirectoryStatementSource(StatementSource):
+    """
+    Reads files in place from a local or mounted drop directory; a file is only picked up
+    once it has not been modified for the settle time so that partially-written files are skipped.
+    Changes are detected with filesystem notifications if `watchdog` is installed, otherwise by polling
+    """
+    downloads_files = False
+
+    def __init__(self, path=None, settle_seconds=None):
+        self.path = path or settings.LOCAL_STATEMENT_DIR
+        self.settle_seconds = settings.LOCAL_STATEMENT_SETTLE_SECONDS if settle_seconds is None else settle_seconds
+        self.has_unsettled_files = False
+        self.changed = threading.Event()
+        self.observer = None
+        self.snapshot = None
+
+    def retrieve_new_files(self, last_date, end_date=None, account_codes=None) -> 'NewFiles':
+        from mtp_transaction_uploader.upload import NewFiles, parse_filename_for_accounts, SIZE_LIMIT_BYTES
+
+        ready_files = []
+        earliest_unsettled_date = None
+        self.has_unsettled_files = False
+        now = time.time()
+        for filename, stat in self.list_files():
+            date = parse_filename_for_accounts(filename, account_codes)
+            if not date or (last_date is not None and date <= last_date):
+                continue
+            if end_date is not None and date > end_date:
+                continue
+            if stat.st_size > SIZE_LIMIT_BYTES:
+                logger.error('%s is too large (%s), skipped.' % (filename, stat.st_size))
+                continue
+            if now - stat.st_mtime < self.settle_seconds:
+                self.has_unsettled_files = True
+                if earliest_unsettled_date is None or date < earliest_unsettled_date:
+                    earliest_unsettled_date = date
+                continue
+            ready_files.append((date, os.path.join(self.path, filename)))
+
+        # files must be processed in date order so later files wait for earlier ones still being written
+        ready_files = sorted(
+            (date, path) for date, path in ready_files
+            if earliest_unsettled_date is None or date < earliest_unsettled_date
+        )
+        return NewFiles([date for date, _ in ready_files], [path for _, path in ready_files])
+
+    def list_files(self):
+        with os.scandir(self.path) as entries:
+            return [(entry.name, entry.stat()) for entry in entries if entry.is_file()]
+
+    def take_snapshot(self):
+        return {filename: (stat.st_size, stat.st_mtime_ns) for filename, stat in self.list_files()}
+
+    def start_observer(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return False
+
+        changed = self.changed
+
+        class ChangeHandler(FileSystemEventHandler):
+            # files being read by uploads also raise events, which must not start another poll
+            def on_created(self, event):
+                changed.set()
+
+            on_modified = on_moved = on_closed = on_created
+
+        self.observer = Observer()
+        self.observer.schedule(ChangeHandler(), self.path)
+        self.observer.start()
+        return True
+
+    def wait_for_changes(self, timeout, stop_event):
+        if self.observer is None and self.snapshot is None and not self.start_observer():
+            self.snapshot = self.take_snapshot()
+        if self.has_unsettled_files:
+            timeout = min(timeout, self.settle_seconds)
+
+        deadline = time.monotonic() + timeout
+        while not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self.observer is not None:
+                if self.changed.wait(min(settings.LOCAL_STATEMENT_POLL_INTERVAL, remaining)):
+                    self.changed.clear()
+                    return
+            elif not stop_event.wait(min(settings.LOCAL_STATEMENT_POLL_INTERVAL, remaining)):
+                snapshot = self.take_snapshot()
+                if snapshot != self.snapshot:
+                    self.snapshot = snapshot
+                    return
+
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+
+def sftp_connection_active(sftp_conn):
+    try:
+        return sftp_conn.sftp_client.get_channel().get_transport().is_active()
+    except Exception:
+        return False
+
+
+def get_statement_source(source_type=None) -> StatementSource:
+    source_type = source_type or settings.STATEMENT_SOURCE
+    if source_type == 'local':
+        return LocalDirectoryStatementSource()
+    if source_type == 'sftp':
+        return SFTPStatementSource()
+    raise ValueError('Unknown statement source "%s"' % source_type)
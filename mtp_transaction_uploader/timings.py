@@ -0,0 +1,69 @@
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger('mtp')
+
+
+class StageTimings:
+    """
+    Wall-clock time spent in, and records handled by, each stage of a run
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.record_counts = {}
+        # stages are recorded by several threads when accounts or backfilled statements are uploaded concurrently
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.durations.clear()
+        self.record_counts.clear()
+
+    def record(self, stage, duration, record_count=0):
+        with self.lock:
+            self.durations[stage] = self.durations.get(stage, 0) + duration
+            self.record_counts[stage] = self.record_counts.get(stage, 0) + record_count
+
+    @contextlib.contextmanager
+    def measure(self, stage, record_count=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, record_count)
+
+    def measure_iterator(self, stage, iterable, count=len):
+        """
+        Yields from `iterable` counting only the time taken to produce each item
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(stage, time.perf_counter() - start)
+                return
+            self.record(stage, time.perf_counter() - start, count(item))
+            yield item
+
+    def log_report(self):
+        for stage, duration in self.durations.items():
+            record_count = self.record_counts[stage]
+            logger.info(
+                'Stage %s took %.3fs for %d records (%.0f records/s)' % (
+                    stage, duration, record_count, record_count / duration if duration else 0
+                ),
+                extra={
+                    'elk_fields': {
+                        '@fields.stage': stage,
+                        '@fields.stage_seconds': round(duration, 3),
+                        '@fields.stage_records': record_count,
+                    }
+                }
+            )
+
+
+stage_timings = StageTimings()
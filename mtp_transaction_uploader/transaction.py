@@ -0,0 +1,92 @@
+import datetime
+import functools
+import sys
+
+from pytz import utc
+
+FIELDS = (
+    'amount',
+    'category',
+    'source',
+    'sender_sort_code',
+    'sender_account_number',
+    'sender_roll_number',
+    'sender_name',
+    'blocked',
+    'incomplete_sender_info',
+    'reference',
+    'received_at',
+    'processor_type_code',
+    'prisoner_number',
+    'prisoner_dob',
+    'reference_in_sender_field',
+    'batch',
+)
+
+
+class Transaction:
+    """
+    Compact transaction record supporting dict-style access to its fields;
+    unset fields and those set to None are omitted from the request data
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FIELDS and hasattr(self, key)
+
+    def __iter__(self):
+        return (key for key in FIELDS if hasattr(self, key))
+
+    def __eq__(self, other):
+        if isinstance(other, (Transaction, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return '<Transaction %r>' % self.as_dict()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FIELDS else default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def to_request_data(self):
+        return {
+            key: value
+            for key, value in self.items()
+            if value is not None
+        }
+
+
+@functools.lru_cache(maxsize=64)
+def format_received_at(date: datetime.datetime) -> str:
+    received_at = datetime.datetime.combine(date, datetime.time(12, 0, 0, tzinfo=utc))
+    return received_at.isoformat()
+
+
+def intern_value(value):
+    return sys.intern(value) if value is not None else None
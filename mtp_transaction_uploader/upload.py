@@ -1,24 +1,37 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import io
 import itertools
 import logging
-import math
 import os
 import re
 import shutil
+import time
 import typing
 
-from bankline_parser.data_services import parse
-from bankline_parser.data_services.enums import TransactionCode
+from bankline_parser.data_services import models, parse
+from bankline_parser.data_services.enums import BalanceType, TransactionCode
+from bankline_parser.data_services.exceptions import ParseError
 from mtp_common.bank_accounts import (
     is_correspondence_account, roll_number_required, roll_number_valid_for_account
 )
-from pysftp import Connection, CnOpts
-from pytz import utc
 from slumber.exceptions import SlumberHttpBaseException
 
 from mtp_transaction_uploader import settings
-from mtp_transaction_uploader.api_client import get_authenticated_connection
+from mtp_transaction_uploader.account_balances import get_account_balance_store
+from mtp_transaction_uploader.api_cache import api_cache_stats, cached_get, invalidate
+from mtp_transaction_uploader.budget import read_checkpoint, RunBudget
+from mtp_transaction_uploader.fingerprints import get_fingerprint_index
+from mtp_transaction_uploader.memory import memory_monitor
+from mtp_transaction_uploader.sftp import SFTPConnection
+from mtp_transaction_uploader.sinks import SinkConnection, SinkResource
+from mtp_transaction_uploader.timings import stage_timings
+from mtp_transaction_uploader.api_client import (
+    compression_stats, get_authenticated_connection, is_dry_run, post_streamed, rate_limiter, reuse_connection,
+)
+from mtp_transaction_uploader.transaction import format_received_at, intern_value, Transaction
+from mtp_transaction_uploader.workers import get_worker_pool, run_worker_pool
 from mtp_transaction_uploader.patterns import (
     CREDIT_REF_PATTERN, CREDIT_REF_PATTERN_REVERSED, FILE_PATTERN_STR,
     ADMINISTRATIVE_IDENTIFIERS, WORLDPAY_SETTLEMENT_REFERENCE_PATTERN,
@@ -30,7 +43,13 @@ DATE_FORMAT = '%d%m%y'
 SIZE_LIMIT_BYTES = 50 * 1000 * 1000  # 50MB
 
 NewFiles = namedtuple('NewFiles', ['new_dates', 'new_filenames'])
+# `code` identifies the account's data services files, records are filtered by sort code and account number
+BankAccount = namedtuple('BankAccount', ['code', 'sort_code', 'account_number'])
 RetrievedFiles = namedtuple('RetrievedFiles', ['new_last_date', 'new_filenames'])
+StatementTransactions = namedtuple(
+    'StatementTransactions',
+    ['filename', 'date', 'transactions', 'file_balance', 'net_amount']
+)
 PrisonerDetails = namedtuple('PrisonerDetails', ['prisoner_number', 'prisoner_dob', 'from_description_field'])
 ParsedReference = namedtuple('ParsedReference', ['prisoner_number', 'prisoner_dob'])
 SenderInformation = namedtuple(
@@ -39,31 +58,94 @@ SenderInformation = namedtuple(
 )
 
 
-def download_new_files(last_date: typing.Optional[datetime.date]):
+class DownloadedFile(str):
+    """
+    Path a data services file would have been downloaded to, carrying its content in memory instead
+    """
+
+    def __new__(cls, path, content: bytes):
+        downloaded_file = super().__new__(cls, path)
+        downloaded_file.content = content
+        return downloaded_file
+
+    def __reduce__(self):
+        return DownloadedFile, (str(self), self.content)
+
+
+def open_statement(filename):
+    if isinstance(filename, DownloadedFile):
+        return io.TextIOWrapper(io.BytesIO(filename.content))
+    return open(filename)
+
+
+def open_sftp_connection():
+    return SFTPConnection(
+        settings.SFTP_HOST, username=settings.SFTP_USER, private_key=settings.SFTP_PRIVATE_KEY,
+        compression=settings.SFTP_COMPRESSION,
+        window_size=settings.SFTP_WINDOW_SIZE or None, max_packet_size=settings.SFTP_MAX_PACKET_SIZE or None,
+    )
+
+
+def fetch_file(sftp_conn, filename, local_path):
+    sftp_conn.sftp_client.get(
+        filename, local_path,
+        prefetch=settings.SFTP_PREFETCH,
+        max_concurrent_prefetch_requests=settings.SFTP_MAX_PREFETCH_REQUESTS or None,
+    )
+    return local_path
+
+
+def fetch_file_into_memory(sftp_conn, filename, local_path):
+    buffer = io.BytesIO()
+    sftp_conn.sftp_client.getfo(
+        filename, buffer,
+        prefetch=settings.SFTP_PREFETCH,
+        max_concurrent_prefetch_requests=settings.SFTP_MAX_PREFETCH_REQUESTS or None,
+    )
+    return DownloadedFile(local_path, buffer.getvalue())
+
+
+def get_default_bank_account() -> BankAccount:
+    return BankAccount(settings.ACCOUNT_CODE, settings.NOMS_AGENCY_SORT_CODE, settings.NOMS_AGENCY_ACCOUNT_NUMBER)
+
+
+def get_bank_accounts() -> typing.List[BankAccount]:
+    if settings.ACCOUNTS:
+        return [BankAccount(*account) for account in settings.ACCOUNTS]
+    return [get_default_bank_account()]
+
+
+def download_new_files(last_date: typing.Optional[datetime.date], sftp_conn=None,
+                       end_date: typing.Optional[datetime.date] = None, account_codes=None):
+    if sftp_conn is None:
+        with open_sftp_connection() as conn:
+            return download_new_files(last_date, sftp_conn=conn, end_date=end_date, account_codes=account_codes)
+
     new_dates = []
     new_filenames = []
-    opts = CnOpts()
-    opts.hostkeys = None
-    with Connection(settings.SFTP_HOST, username=settings.SFTP_USER,
-                    private_key=settings.SFTP_PRIVATE_KEY, cnopts=opts) as conn:
-        with conn.cd(settings.SFTP_DIR):
-            dir_listing = conn.listdir()
-            for filename in dir_listing:
-                date = parse_filename(filename, settings.ACCOUNT_CODE)
-
-                if date:
-                    stat = conn.stat(filename)
-                    if stat.st_size > SIZE_LIMIT_BYTES:
-                        logger.error('%s is too large (%s), download skipped.'
-                                     % (filename, stat.st_size))
-                        continue
-
-                    if last_date is None or date > last_date:
-                        local_path = os.path.join(settings.DS_NEW_FILES_DIR,
-                                                  filename)
-                        new_filenames.append(local_path)
-                        new_dates.append(date)
-                        conn.get(filename, localpath=local_path)
+    memory_available = settings.DOWNLOAD_MEMORY_LIMIT_BYTES if settings.DOWNLOAD_TO_MEMORY else 0
+    with sftp_conn.cd(settings.SFTP_DIR):
+        dir_listing = sftp_conn.listdir()
+        for filename in dir_listing:
+            date = parse_filename_for_accounts(filename, account_codes)
+
+            if date:
+                stat = sftp_conn.stat(filename)
+                if stat.st_size > SIZE_LIMIT_BYTES:
+                    logger.error('%s is too large (%s), download skipped.'
+                                 % (filename, stat.st_size))
+                    continue
+
+                if (last_date is None or date > last_date) and (end_date is None or date <= end_date):
+                    local_path = os.path.join(settings.DS_NEW_FILES_DIR,
+                                              filename)
+                    new_dates.append(date)
+                    if stat.st_size <= memory_available and stat.st_size <= settings.DOWNLOAD_SPILL_BYTES and \
+                            not memory_monitor.under_pressure():
+                        new_filenames.append(fetch_file_into_memory(sftp_conn, filename, local_path))
+                        memory_available -= stat.st_size
+                    else:
+                        new_filenames.append(fetch_file(sftp_conn, filename, local_path))
 
     if new_dates and new_filenames:
         sorted_dates, sorted_files = zip(*sorted(zip(new_dates, new_filenames)))
@@ -82,21 +164,52 @@ def parse_filename(filename, account_code) -> typing.Optional[datetime.date]:
     return None
 
 
-def retrieve_data_services_files():
+def clear_new_files_dir():
     # check for existing downloaded files and remove if found
     if os.path.exists(settings.DS_NEW_FILES_DIR):
         shutil.rmtree(settings.DS_NEW_FILES_DIR)
     os.mkdir(settings.DS_NEW_FILES_DIR)
 
-    # check date of most recent transactions uploaded
-    last_date = None
+
+def parse_filename_for_accounts(filename, account_codes=None) -> typing.Optional[datetime.date]:
+    for account_code in account_codes or [settings.ACCOUNT_CODE]:
+        date = parse_filename(filename, account_code)
+        if date:
+            return date
+    return None
+
+
+def route_files(files, accounts: typing.List[BankAccount]):
+    """
+    Splits date-ordered files between the accounts whose code they were named with
+    """
+    files_by_account = {account: [] for account in accounts}
+    for filename in files:
+        for account in accounts:
+            if parse_filename(filename, account.code):
+                files_by_account[account].append(filename)
+                break
+    return files_by_account
+
+
+def retrieve_data_services_files(sftp_conn=None, source=None, account_codes=None, after_last_balance=False,
+                                 resume_date: typing.Optional[datetime.date] = None):
+    if source is None or source.downloads_files:
+        clear_new_files_dir()
+
     conn = get_authenticated_connection()
-    response = conn.transactions.get(ordering='-received_at', limit=1)
-    if response.get('results'):
-        last_date = response['results'][0]['received_at'][:10]
-        last_date = datetime.datetime.strptime(last_date, '%Y-%m-%d').date()
+    if after_last_balance:
+        last_date = get_last_balance_date(conn)
+    else:
+        last_date = get_last_transaction_date(conn)
+    if resume_date is not None and last_date is not None and resume_date <= last_date:
+        # retrieve the file which a previous run stopped part-way through again
+        last_date = resume_date - datetime.timedelta(days=1)
 
-    new_dates, new_filenames = download_new_files(last_date)
+    if source is None:
+        new_dates, new_filenames = download_new_files(last_date, sftp_conn=sftp_conn, account_codes=account_codes)
+    else:
+        new_dates, new_filenames = source.retrieve_new_files(last_date, account_codes=account_codes)
 
     new_last_date = None
     # find last dated file
@@ -106,126 +219,654 @@ def retrieve_data_services_files():
     return RetrievedFiles(new_last_date, new_filenames)
 
 
-def upload_transactions_from_files(files):
+def get_last_transaction_date(conn) -> typing.Optional[datetime.date]:
+    # check date of most recent transactions uploaded
+    last_date = None
+    response = conn.transactions.get(ordering='-received_at', limit=1)
+    if response.get('results'):
+        last_date = response['results'][0]['received_at'][:10]
+        last_date = datetime.datetime.strptime(last_date, '%Y-%m-%d').date()
+    return last_date
+
+
+def get_last_balance_date(conn, bank_account: BankAccount = None) -> typing.Optional[datetime.date]:
+    # check date of most recent closing balance, which are committed in date order
+    response = get_balances(conn, bank_account).get(limit=1)
+    if response.get('results'):
+        return datetime.datetime.strptime(response['results'][0]['date'], '%Y-%m-%d').date()
+    return None
+
+
+def has_api_balances(bank_account: BankAccount = None) -> bool:
+    # the API keeps a single series of closing balances, for the account configured with ACCOUNT_CODE
+    return bank_account is None or bank_account.code == settings.ACCOUNT_CODE
+
+
+def get_balances(conn, bank_account: BankAccount = None):
+    """
+    Returns the API's balances resource for the account configured with ACCOUNT_CODE and
+    otherwise the account's local store; in dry runs, posts still go to the sink
+    """
+    if has_api_balances(bank_account):
+        return conn.balances
+    account_balance_store = get_account_balance_store(bank_account.code)
+    if isinstance(conn, SinkConnection):
+        return SinkResource(account_balance_store, 'balances', conn.sink)
+    return account_balance_store
+
+
+def retrieve_files_for_accounts(bank_accounts: typing.List[BankAccount], sftp_conn=None,
+                                source=None) -> RetrievedFiles:
+    """
+    Retrieves each account's files dated after its own last closing balance so that
+    one account's progress does not cause another account's late files to be passed over
+    """
+    if source is None and sftp_conn is None:
+        with open_sftp_connection() as sftp_conn:
+            return retrieve_files_for_accounts(bank_accounts, sftp_conn=sftp_conn)
+    if source is None or source.downloads_files:
+        clear_new_files_dir()
+
     conn = get_authenticated_connection()
+    new_files = []
+    for bank_account in bank_accounts:
+        last_date = get_last_balance_date(conn, bank_account=bank_account)
+        if source is None:
+            new_dates, new_filenames = download_new_files(
+                last_date, sftp_conn=sftp_conn, account_codes=[bank_account.code]
+            )
+        else:
+            new_dates, new_filenames = source.retrieve_new_files(last_date, account_codes=[bank_account.code])
+        new_files.extend(zip(new_dates, new_filenames))
+
+    new_files.sort()
+    return RetrievedFiles(
+        new_files[-1][0] if new_files else None,
+        [filename for _, filename in new_files],
+    )
+
+
+def upload_transactions_for_accounts(files, bank_accounts: typing.List[BankAccount], should_stop=None):
+    """
+    Uploads accounts' files concurrently over a shared API connection and the run's worker processes;
+    each account's closing balances are kept separately and updated in date order
+    """
+    files_by_account = route_files(files, bank_accounts)
+    with reuse_connection(), ThreadPoolExecutor(max_workers=len(bank_accounts)) as executor:
+        transaction_counts = executor.map(
+            lambda bank_account: upload_transactions_from_files(
+                files_by_account[bank_account], should_stop=should_stop, bank_account=bank_account
+            ),
+            bank_accounts
+        )
+        return sum(transaction_counts)
+
+
+def upload_transactions_from_files(files, should_stop=None, bank_account: BankAccount = None,
+                                   budget: RunBudget = None):
+    conn = get_authenticated_connection()
+    balance_updater = BalanceUpdater(bank_account=bank_account)
+    statements = stage_timings.measure_iterator(
+        'transform', load_statements(files, bank_account=bank_account),
+        count=lambda statement: len(statement.transactions),
+    )
+    if should_stop is not None:
+        # stop between files so that no file is left partially uploaded
+        statements = itertools.takewhile(lambda _: not should_stop(), statements)
+    if settings.PACK_UPLOAD_CHUNKS:
+        successful_transaction_count = upload_packed_statements(conn, statements, balance_updater, budget=budget)
+    else:
+        successful_transaction_count = upload_statements(conn, statements, balance_updater, budget=budget)
+    balance_updater.finish()
+    return successful_transaction_count
+
+
+def load_statements(files, bank_account: BankAccount = None):
+    """
+    Parses and transforms date-ordered files, in parallel worker processes if configured,
+    yielding statements in the same order
+    """
+    bank_accounts = itertools.repeat(bank_account or get_default_bank_account())
+    if settings.PARSE_WORKERS > 1 and len(files) > 1:
+        with run_worker_pool(get_worker_count()) as worker_pool:
+            if worker_pool is not None:
+                yield from filter(None, map_with_back_pressure(
+                    worker_pool, load_statement, files, bank_accounts, max_pending=settings.PARSE_WORKERS * 2
+                ))
+                return
+    yield from filter(None, map(load_statement, files, bank_accounts))
+
+
+def get_worker_count():
+    # parsing and classification share a run's worker processes
+    return max(settings.PARSE_WORKERS, settings.CLASSIFY_WORKERS)
+
+
+def map_with_back_pressure(executor, func, *iterables, max_pending):
+    """
+    Like `executor.map` but only keeps `max_pending` calls ahead of the results consumed,
+    waiting for all of them to be consumed while memory is under pressure
+    """
+    pending = deque()
+    for args in zip(*iterables):
+        while pending and (len(pending) >= max_pending or memory_monitor.under_pressure()):
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, *args))
+    while pending:
+        yield pending.popleft().result()
+
+
+def load_statement(filename, bank_account: BankAccount = None) -> typing.Optional[StatementTransactions]:
+    bank_account = bank_account or get_default_bank_account()
+    logger.info('Processing %s...' % filename)
+    with open_statement(filename) as f:
+        lines = filter_account_sections(f, bank_account)
+    if not lines:
+        logger.info('No records found.')
+        return None
+    if settings.COLUMNAR_RECORDS:
+        from mtp_transaction_uploader.columnar import RecordColumns
+
+        columns = RecordColumns(lines)
+        transactions = get_transactions_from_columns(columns, bank_account=bank_account)
+        if not transactions:
+            return None
+        file_balance = get_closing_balance_from_records(
+            columns.balance_records(bank_account.sort_code, bank_account.account_number)
+        ) if settings.USE_FILE_BALANCES else None
+        net_amount = columns.net_amount(bank_account.sort_code, bank_account.account_number)
+    else:
+        data_services_file = parse(lines)
+        transactions = get_transactions_from_file(data_services_file, bank_account=bank_account, lines=lines)
+        if not transactions:
+            return None
+        file_balance = (
+            get_closing_balance_from_file(data_services_file, bank_account=bank_account)
+            if settings.USE_FILE_BALANCES else None
+        )
+        net_amount = None
+    stmt_date = parse_filename(filename, bank_account.code)
+    return StatementTransactions(filename, stmt_date, transactions, file_balance, net_amount)
+
+
+def upload_statements(conn, statements, balance_updater, budget: RunBudget = None):
     successful_transaction_count = 0
-    for filename in files:
-        logger.info('Processing %s...' % filename)
-        with open(filename) as f:
-            data_services_file = parse(f)
-        transactions = get_transactions_from_file(data_services_file)
-        if transactions:
-            transaction_count = len(transactions)
+    for statement in statements:
+        transaction_count = len(statement.transactions)
+        if budget is not None and not budget.can_start_statement(statement, settings.UPLOAD_REQUEST_SIZE):
+            break
+        try:
+            if not post_statement(conn, statement, budget=budget):
+                break
+            balance_updater.statement_uploaded(statement)
+            logger.info('Uploaded %d transactions from %s' % (transaction_count, statement.filename))
+            successful_transaction_count += transaction_count
+        except SlumberHttpBaseException as e:
+            log_failed_statement(statement, e)
+    return successful_transaction_count
+
+
+def post_statement(conn, statement: StatementTransactions, budget: RunBudget = None) -> bool:
+    """
+    Posts the statement's transactions in chunks, returning False if the run budget stopped it part-way
+    """
+    resume_count = budget.resume_count(statement) if budget is not None else 0
+    positions = get_new_transaction_positions(statement, skip=resume_count)
+    offset = 0
+    while offset < len(positions):
+        # progress is counted in the statement's order, including transactions skipped as already uploaded
+        if budget is not None and not budget.can_start_chunk(statement, positions[offset]):
+            return False
+        chunk_size = memory_monitor.chunk_size(settings.UPLOAD_REQUEST_SIZE)
+        chunk_start = time.perf_counter()
+        post_transactions(conn, (
+            statement.transactions[position] for position in positions[offset:offset + chunk_size]
+        ))
+        if budget is not None:
+            budget.record_chunk(time.perf_counter() - chunk_start)
+        offset += chunk_size
+    return True
+
+
+def get_new_transactions(statement: StatementTransactions, skip=0):
+    """
+    Returns the statement's transactions after the first `skip` except those which the fingerprint index shows
+    were already uploaded; balances are still calculated from all of the statement's transactions
+    """
+    if not skip and get_fingerprint_index() is None:
+        return statement.transactions
+    return [
+        statement.transactions[position]
+        for position in get_new_transaction_positions(statement, skip=skip)
+    ]
+
+
+def get_new_transaction_positions(statement: StatementTransactions, skip=0):
+    """
+    Returns the positions of the statement's transactions after the first `skip` except those which
+    the fingerprint index shows were already uploaded
+    """
+    fingerprint_index = get_fingerprint_index()
+    if fingerprint_index is None:
+        return range(skip, len(statement.transactions))
+    # the index matches identical transactions in order from the start of the statement
+    positions = fingerprint_index.new_positions(statement.transactions)
+    skipped_count = len(statement.transactions) - len(positions)
+    if skipped_count:
+        logger.info('Skipped %d previously uploaded transactions from %s' % (skipped_count, statement.filename))
+    return [position for position in positions if position >= skip]
+
+
+def upload_packed_statements(conn, statements, balance_updater, budget: RunBudget = None):
+    uploader = PackedStatementUploader(conn, balance_updater, budget=budget)
+    for statement in statements:
+        # with packed chunks, the run budget only stops uploads between statements
+        if budget is not None and not budget.can_start_statement(statement, settings.UPLOAD_REQUEST_SIZE):
+            break
+        uploader.add_statement(statement)
+    uploader.flush()
+    return uploader.successful_transaction_count
+
+
+class PackedStatementUploader:
+    """
+    Packs transactions from consecutive statements into full-size upload chunks;
+    a statement's balance is only updated once all of its transactions have been posted
+    """
+
+    def __init__(self, conn, balance_updater, budget: RunBudget = None):
+        self.conn = conn
+        self.balance_updater = balance_updater
+        self.budget = budget
+        self.chunk_size = memory_monitor.chunk_size(settings.UPLOAD_REQUEST_SIZE)
+        self.successful_transaction_count = 0
+        self.chunk = []
+        self.pending_statements = []
+        self.remaining_counts = {}
+        self.failed_statements = set()
+
+    def add_statement(self, statement: StatementTransactions):
+        index = len(self.remaining_counts)
+        transactions = get_new_transactions(
+            statement, skip=self.budget.resume_count(statement) if self.budget is not None else 0
+        )
+        self.pending_statements.append((index, statement))
+        self.remaining_counts[index] = len(transactions)
+        for transaction in transactions:
+            if index in self.failed_statements:
+                break
+            self.chunk.append((index, transaction))
+            if len(self.chunk) >= self.chunk_size:
+                self.post_chunk()
+
+    def flush(self):
+        if self.chunk:
+            self.post_chunk()
+        else:
+            # statements with no new transactions to post
+            self.complete_statements()
+
+    def post_chunk(self):
+        chunk_start = time.perf_counter()
+        try:
+            post_transactions(self.conn, (transaction for _, transaction in self.chunk))
+        except SlumberHttpBaseException as e:
+            chunk_statements = {index for index, _ in self.chunk}
+            for index, statement in self.pending_statements:
+                if index in chunk_statements and index not in self.failed_statements:
+                    self.failed_statements.add(index)
+                    log_failed_statement(statement, e)
+        else:
+            for index, _ in self.chunk:
+                self.remaining_counts[index] -= 1
+            if self.budget is not None:
+                self.budget.record_chunk(time.perf_counter() - chunk_start)
+        self.chunk = []
+        self.chunk_size = memory_monitor.chunk_size(settings.UPLOAD_REQUEST_SIZE)
+        self.complete_statements()
+
+    def complete_statements(self):
+        while self.pending_statements:
+            index, statement = self.pending_statements[0]
+            if index not in self.failed_statements and self.remaining_counts[index] > 0:
+                break
+            self.pending_statements.pop(0)
+            if index in self.failed_statements:
+                continue
             try:
-                for i in range(math.ceil(transaction_count / settings.UPLOAD_REQUEST_SIZE)):
-                    conn.transactions.post(
-                        clean_request_data(transactions[
-                            i * settings.UPLOAD_REQUEST_SIZE:
-                            (i + 1) * settings.UPLOAD_REQUEST_SIZE
-                        ])
-                    )
-                stmt_date = parse_filename(filename, settings.ACCOUNT_CODE)
-                update_new_balance(transactions, stmt_date)
-                logger.info('Uploaded %d transactions from %s' % (transaction_count, filename))
-                successful_transaction_count += transaction_count
+                self.balance_updater.statement_uploaded(statement)
             except SlumberHttpBaseException as e:
-                logger.error('Failed to upload %d transactions from %s.\n%s' % (
-                    transaction_count,
-                    filename,
-                    getattr(e, 'content', e)
-                ))
-    return successful_transaction_count
+                log_failed_statement(statement, e)
+                continue
+            logger.info('Uploaded %d transactions from %s' % (len(statement.transactions), statement.filename))
+            self.successful_transaction_count += len(statement.transactions)
+
+
+def log_failed_statement(statement, e):
+    logger.error('Failed to upload %d transactions from %s.\n%s' % (
+        len(statement.transactions),
+        statement.filename,
+        getattr(e, 'content', e)
+    ))
+
+
+class BalanceUpdater:
+    """
+    Updates closing balances as statements finish uploading; in chained mode, the previous balance
+    is looked up once and rolled forward locally, and the stored balance is checked once the run is complete
+    """
+
+    def __init__(self, bank_account: BankAccount = None):
+        self.bank_account = bank_account
+        self.verified_balance = None
+        self.chained_balance = None
+        self.last_chained_date = None
+
+    def statement_uploaded(self, statement: StatementTransactions):
+        if settings.CHAIN_BALANCES:
+            try:
+                self.chained_balance = update_new_balance(
+                    statement.transactions, statement.date,
+                    file_balance=statement.file_balance, previous_balance=self.chained_balance,
+                    net_amount=statement.net_amount, bank_account=self.bank_account,
+                )
+            except SlumberHttpBaseException:
+                # the next balance is calculated from the API's balance rather than one that was not stored
+                self.chained_balance = None
+                raise
+            self.last_chained_date = statement.date
+            return
+
+        balance = update_new_balance(
+            statement.transactions, statement.date,
+            file_balance=statement.file_balance, previous_balance=self.verified_balance,
+            net_amount=statement.net_amount, bank_account=self.bank_account,
+        )
+        self.verified_balance = balance if statement.file_balance == balance else None
+
+    def finish(self):
+        if self.last_chained_date is None or self.chained_balance is None:
+            return
+        try:
+            check_stored_balance(
+                get_authenticated_connection(), self.last_chained_date, self.chained_balance,
+                bank_account=self.bank_account,
+            )
+        except SlumberHttpBaseException as e:
+            logger.error('Failed to check closing balance for %s.\n%s' % (
+                self.last_chained_date.isoformat(),
+                getattr(e, 'content', e)
+            ))
+
+
+def post_transactions(conn, transactions):
+    transactions = list(transactions)
+    rate_limiter.wait()
+    with stage_timings.measure('upload', len(transactions)):
+        # streaming bypasses the resource's post method so is not used with sinks
+        if settings.STREAM_UPLOADS and not isinstance(conn, SinkConnection):
+            post_streamed(conn, 'transactions', map(clean_request_item, transactions),
+                          ndjson=settings.STREAM_UPLOAD_FORMAT == 'ndjson')
+        else:
+            conn.transactions.post(clean_request_data(transactions))
+    fingerprint_index = get_fingerprint_index()
+    if fingerprint_index is not None and not isinstance(conn, SinkConnection):
+        fingerprint_index.record(transactions)
 
 
 def clean_request_data(data):
-    cleaned_data = []
-    for item in data:
-        cleaned_item = {}
-        for key in item:
-            if item[key] is not None:
-                cleaned_item[key] = item[key]
-        cleaned_data.append(cleaned_item)
-    return cleaned_data
+    return list(map(clean_request_item, data))
+
+
+def clean_request_item(item):
+    if isinstance(item, Transaction):
+        return item.to_request_data()
+    cleaned_item = {}
+    for key in item:
+        if item[key] is not None:
+            cleaned_item[key] = item[key]
+    return cleaned_item
 
 
-def get_transactions_from_file(data_services_file):
+def get_transactions_from_file(data_services_file, bank_account: BankAccount = None, lines=None):
     if not data_services_file.is_valid():
         logger.error('Errors: %s' % data_services_file.errors)
         return None
 
-    filtered_records = filter_relevant_records_from_all_accounts(data_services_file.accounts)
-
+    filtered_records = filter_relevant_records_from_all_accounts(
+        data_services_file.accounts, bank_account=bank_account
+    )
     if not filtered_records:
         logger.info('No records found.')
         return None
 
+    if lines is None:
+        return classify_records(filtered_records)
+    record_prefix = get_record_prefix(bank_account or get_default_bank_account())
+    return classify_records(filtered_records, record_lines=(line for line in lines if line.startswith(record_prefix)))
+
+
+def get_transactions_from_columns(columns, bank_account: BankAccount = None):
+    if not columns.is_valid():
+        logger.error('Errors: %s' % columns.errors)
+        return None
+
+    bank_account = bank_account or get_default_bank_account()
+    record_lines = columns.transaction_lines(bank_account.sort_code, bank_account.account_number)
+    if not record_lines:
+        logger.info('No records found.')
+        return None
+
+    return classify_record_lines(record_lines)
+
+
+def classify_records(records, record_lines=None):
+    """
+    Converts records into transactions; if the records' lines are given, large files are sharded across
+    the run's worker processes if configured, which are sent the lines as they are much cheaper to send
+    than records. Transactions are returned in record order
+    """
+    worker_pool = get_classification_pool(len(records))
+    if worker_pool is not None and record_lines is not None:
+        return classify_shards(worker_pool, list(record_lines))
+    return get_transactions_from_records(records)
+
+
+def classify_record_lines(record_lines):
+    """
+    Converts the lines of records into transactions, sharding large files across the run's
+    worker processes if configured; transactions are returned in record order
+    """
+    worker_pool = get_classification_pool(len(record_lines))
+    if worker_pool is not None:
+        return classify_shards(worker_pool, record_lines)
+    return get_transactions_from_lines(record_lines)
+
+
+def get_classification_pool(record_count):
+    # there is no pool within a parsing worker, where records are classified serially
+    if settings.CLASSIFY_WORKERS > 1 and record_count > settings.CLASSIFY_SHARD_SIZE:
+        return get_worker_pool()
+    return None
+
+
+def classify_shards(worker_pool, record_lines):
+    shard_size = settings.CLASSIFY_SHARD_SIZE
+    shards = [record_lines[i:i + shard_size] for i in range(0, len(record_lines), shard_size)]
+    return list(itertools.chain.from_iterable(worker_pool.map(get_transactions_from_lines, shards)))
+
+
+def get_transactions_from_lines(record_lines):
+    return get_transactions_from_records(map(parse_record, record_lines))
+
+
+def parse_record(line):
+    if line[15:17] == TransactionCode.balance_record.value:
+        return models.BalanceRecord(line)
+    return models.DataRecord(line)
+
+
+def get_transactions_from_records(records):
     transactions = []
-    for record in filtered_records:
+    for record in records:
         if record.is_total() or record.is_balance():
             continue
+        transactions.append(get_transaction_from_record(record))
+    return transactions
 
-        sender_information = extract_sender_information(record)
-        received_at = datetime.datetime.combine(record.date, datetime.time(12, 0, 0, tzinfo=utc))
-        transaction = {
-            'amount': record.amount,
-            'sender_sort_code': sender_information.sort_code,
-            'sender_account_number': sender_information.account_number,
-            'sender_roll_number': sender_information.roll_number,
-            'blocked': sender_information.anonymous,
-            'incomplete_sender_info': sender_information.incomplete,
-            'sender_name': record.transaction_description,
-            'reference': record.reference_number,
-            'received_at': received_at.isoformat(),
-            'processor_type_code': record.transaction_code.value
-        }
-        # payment credits
-        if ((record.transaction_code == TransactionCode.credit_bacs_credit or
-                record.transaction_code == TransactionCode.credit_sundry_credit) and
-                not sender_information.administrative):
-            transaction['category'] = 'credit'
-            transaction['source'] = 'bank_transfer'
-
-            parsed_ref = extract_prisoner_details(record)
-            if parsed_ref:
-                number, dob, from_description_field = parsed_ref
-                transaction['prisoner_number'] = number
-                transaction['prisoner_dob'] = dob.isoformat()
-                transaction['reference_in_sender_field'] = from_description_field
-
-            if settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED:
-                # makes all credit-type transactions "unidentified" so that they will not be credited or refunded
-                transaction['blocked'] = True
-                transaction['incomplete_sender_info'] = True
-        # other credits (e.g. bacs returned)
-        elif record.is_credit():
-            transaction['category'] = 'credit'
-            transaction['source'] = 'administrative'
-
-            batch_id = get_matching_batch_id_for_settlement(record)
-            if batch_id:
-                transaction['batch'] = batch_id
-        # all debits
-        elif record.is_debit():
-            transaction['category'] = 'debit'
-            transaction['source'] = 'administrative'
-
-        transactions.append(transaction)
 
-    return transactions
+def get_transaction_from_record(record):
+    sender_information = extract_sender_information(record)
+    transaction = Transaction(
+        amount=record.amount,
+        sender_sort_code=intern_value(sender_information.sort_code),
+        sender_account_number=sender_information.account_number,
+        sender_roll_number=sender_information.roll_number,
+        blocked=sender_information.anonymous,
+        incomplete_sender_info=sender_information.incomplete,
+        sender_name=record.transaction_description,
+        reference=record.reference_number,
+        received_at=format_received_at(record.date),
+        processor_type_code=record.transaction_code.value,
+    )
+    # payment credits
+    if ((record.transaction_code == TransactionCode.credit_bacs_credit or
+            record.transaction_code == TransactionCode.credit_sundry_credit) and
+            not sender_information.administrative):
+        transaction['category'] = 'credit'
+        transaction['source'] = 'bank_transfer'
+
+        parsed_ref = extract_prisoner_details(record)
+        if parsed_ref:
+            number, dob, from_description_field = parsed_ref
+            transaction['prisoner_number'] = number
+            transaction['prisoner_dob'] = dob.isoformat()
+            transaction['reference_in_sender_field'] = from_description_field
+
+        if settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED:
+            # makes all credit-type transactions "unidentified" so that they will not be credited or refunded
+            transaction['blocked'] = True
+            transaction['incomplete_sender_info'] = True
+    # other credits (e.g. bacs returned)
+    elif record.is_credit():
+        transaction['category'] = 'credit'
+        transaction['source'] = 'administrative'
+
+        batch_id = get_matching_batch_id_for_settlement(record)
+        if batch_id:
+            transaction['batch'] = batch_id
+    # all debits
+    elif record.is_debit():
+        transaction['category'] = 'debit'
+        transaction['source'] = 'administrative'
+
+    return transaction
+
+
+def get_closing_balance_from_file(data_services_file, bank_account: BankAccount = None) -> typing.Optional[int]:
+    if not data_services_file.is_valid():
+        return None
+
+    return get_closing_balance_from_records(
+        filter_relevant_records_from_all_accounts(data_services_file.accounts, bank_account=bank_account)
+    )
+
 
+def get_closing_balance_from_records(records) -> typing.Optional[int]:
+    closing_balance = None
+    for record in records:
+        if record.is_balance() and record.ledger_balance is not None:
+            closing_balance = record.ledger_balance
+            if record.ledger_balance_type == BalanceType.debit:
+                closing_balance = -closing_balance
+    return closing_balance
 
-def filter_relevant_records_from_all_accounts(accounts):
+
+def filter_relevant_records_from_all_accounts(accounts, bank_account: BankAccount = None):
     # read transactions from all data services file "accounts"
     # to cater for both single-account and multiple-account formats
     records = itertools.chain.from_iterable(account.records for account in accounts)
     # filter out only transactions involving account selected with settings
+    bank_account = bank_account or get_default_bank_account()
+    sort_code = bank_account.sort_code
+    account_number = bank_account.account_number
     records = filter(lambda record: (
-        record.branch_sort_code == settings.NOMS_AGENCY_SORT_CODE and
-        record.branch_account_number == settings.NOMS_AGENCY_ACCOUNT_NUMBER
+        record.branch_sort_code == sort_code and
+        record.branch_account_number == account_number
     ), records)
     return list(records)
 
 
+def get_record_prefix(bank_account: BankAccount):
+    return bank_account.sort_code.rjust(6) + bank_account.account_number.rjust(8)
+
+
+def filter_account_sections(lines, bank_account: BankAccount) -> typing.List[str]:
+    """
+    Returns the lines of a data services file without the "accounts" which have no records for the bank account
+    so that their records are never parsed; nothing is returned if no account has records for it.
+    Accounts whose records do not match their trailer are kept so that the parser rejects the file
+    """
+    record_prefix = get_record_prefix(bank_account)
+    relevant_lines = []
+    section = None
+    kept_sections = skipped_sections = 0
+    for line in lines:
+        if section is None:
+            if not line.startswith('HDR1'):
+                # volume header label, or lines which the parser will reject
+                relevant_lines.append(line)
+                continue
+            section = []
+            is_relevant = False
+        section.append(line)
+        if line.startswith(record_prefix):
+            is_relevant = True
+        elif line.startswith('UTL1'):
+            if is_relevant or not section_matches_trailer(section):
+                relevant_lines.extend(section)
+                kept_sections += 1
+            else:
+                skipped_sections += 1
+            section = None
+    if section is not None:
+        # incomplete account, left for the parser to reject
+        relevant_lines.extend(section)
+    elif skipped_sections and not kept_sections:
+        return []
+    return relevant_lines
+
+
+def section_matches_trailer(section) -> bool:
+    """
+    Checks an account's records against its trailer as bankline_parser validates them, without building records
+    """
+    debit_count = debit_total = credit_count = credit_total = balance_count = 0
+    try:
+        models.FileHeaderLabel(section[0])
+        models.UserHeaderLabel(section[1])
+        user_trailer_label = models.UserTrailerLabel(section[-1])
+        for line in section[2:-1]:
+            transaction_code = TransactionCode(line[15:17])
+            if transaction_code.name.startswith('debit'):
+                debit_count += 1
+                debit_total += int(line[35:46])
+            elif transaction_code.name.startswith('credit'):
+                credit_count += 1
+                credit_total += int(line[35:46])
+            elif transaction_code == TransactionCode.balance_record:
+                balance_count += 1
+    except (IndexError, ParseError, ValueError):
+        return False
+    if user_trailer_label.count_balance_records is None and not balance_count:
+        balance_count = None
+    return (debit_count, debit_total, credit_count, credit_total, balance_count) == (
+        user_trailer_label.count_debit_items, user_trailer_label.monetary_total_debit_items,
+        user_trailer_label.count_credit_items, user_trailer_label.monetary_total_credit_items,
+        user_trailer_label.count_balance_records,
+    )
+
+
 def extract_prisoner_details(record):
     from_description_field = False
     parsed_ref = parse_credit_reference(record.reference_number)
@@ -308,18 +949,29 @@ def extract_sender_information(record):
 
 
 def get_matching_batch_id_for_settlement(record):
-    m = WORLDPAY_SETTLEMENT_REFERENCE_PATTERN.match(record.transaction_description)
+    batch_date = parse_settlement_date(record.transaction_description, record.date.date())
+    if batch_date is None:
+        return
+
+    # get batch id for date if found
+    conn = get_authenticated_connection()
+    response = cached_get(conn, 'batches', date=batch_date.isoformat())
+    if response.get('results'):
+        return response['results'][0]['id']
+
+
+def parse_settlement_date(transaction_description, relative_date: datetime.date) -> typing.Optional[datetime.date]:
+    m = WORLDPAY_SETTLEMENT_REFERENCE_PATTERN.match(transaction_description)
     if not m:
         # not a worldpay settlement
         return
 
-    relative_date = record.date.date()
     batch_date = m.group('date')
     try:
         if len(batch_date) == 4:
-            batch_date = parse_4_digit_date(batch_date, relative_date)
+            return parse_4_digit_date(batch_date, relative_date)
         elif len(batch_date) == 2:
-            batch_date = parse_2_digit_date(batch_date, relative_date)
+            return parse_2_digit_date(batch_date, relative_date)
         else:
             # no date provided so cannot match to a batch
             raise ValueError
@@ -327,12 +979,6 @@ def get_matching_batch_id_for_settlement(record):
         # settlement date cannot be parsed
         return
 
-    # get batch id for date if found
-    conn = get_authenticated_connection()
-    response = conn.batches.get(date=batch_date.isoformat())
-    if response.get('results'):
-        return response['results'][0]['id']
-
 
 def parse_2_digit_date(date_str, relative_date: datetime.date) -> datetime.date:
     batch_date = datetime.datetime.strptime(date_str, '%d').date()
@@ -355,27 +1001,115 @@ def parse_4_digit_date(date_str, relative_date: datetime.date) -> datetime.date:
     return batch_date.replace(year=relative_date.year - 1)
 
 
-def update_new_balance(transactions, date: datetime.date):
-    conn = get_authenticated_connection()
-    response = conn.balances.get(limit=1, date__lt=date.isoformat())
-    if response.get('results'):
-        balance = response['results'][0]['closing_balance']
+def get_previous_balance(conn, date: datetime.date, bank_account: BankAccount = None) -> int:
+    if has_api_balances(bank_account):
+        response = cached_get(conn, 'balances', limit=1, date__lt=date.isoformat())
     else:
-        balance = 0
+        response = get_balances(conn, bank_account).get(limit=1, date__lt=date.isoformat())
+    if response.get('results'):
+        return int(response['results'][0]['closing_balance'])
+    return 0
 
+
+def calculate_closing_balance(opening_balance: int, transactions, net_amount: typing.Optional[int] = None) -> int:
+    if net_amount is not None:
+        return opening_balance + net_amount
+    balance = opening_balance
     for t in transactions:
         if t['category'] == 'credit':
             balance += t['amount']
         elif t['category'] == 'debit':
             balance -= t['amount']
+    return balance
+
+
+def check_file_balance(date: datetime.date, file_balance: typing.Optional[int], balance: int):
+    if file_balance is not None and file_balance != balance:
+        logger.error('Closing balance in file for %s (%d) does not match calculated balance (%d)' % (
+            date.isoformat(), file_balance, balance
+        ))
+
+
+def update_new_balance(transactions, date: datetime.date,
+                       file_balance: typing.Optional[int] = None,
+                       previous_balance: typing.Optional[int] = None,
+                       net_amount: typing.Optional[int] = None,
+                       bank_account: BankAccount = None) -> int:
+    with stage_timings.measure('balances', 1):
+        conn = get_authenticated_connection()
+        if previous_balance is None:
+            previous_balance = get_previous_balance(conn, date, bank_account=bank_account)
+        balance = calculate_closing_balance(previous_balance, transactions, net_amount=net_amount)
+        check_file_balance(date, file_balance, balance)
+
+        get_balances(conn, bank_account).post({'date': date.isoformat(),
+                                               'closing_balance': balance})
+        if has_api_balances(bank_account):
+            invalidate('balances')
+    return balance
+
+
+def update_new_balances(statements: typing.List[StatementTransactions]):
+    """
+    Rolls the closing balance forward through date-ordered statements starting
+    from a single opening balance lookup, posts all closing balances once calculated
+    and then checks that the balance stored by the API matches
+    """
+    statements = sorted(statements, key=lambda statement: statement.date)
+    conn = get_authenticated_connection()
+    balance = get_previous_balance(conn, statements[0].date)
 
-    conn.balances.post({'date': date.isoformat(),
-                        'closing_balance': balance})
+    closing_balances = []
+    for statement in statements:
+        balance = calculate_closing_balance(balance, statement.transactions, net_amount=statement.net_amount)
+        check_file_balance(statement.date, statement.file_balance, balance)
+        closing_balances.append({'date': statement.date.isoformat(),
+                                 'closing_balance': balance})
+    for closing_balance in closing_balances:
+        conn.balances.post(closing_balance)
+    invalidate('balances')
 
+    check_stored_balance(conn, statements[-1].date, balance)
+    return balance
 
-def main():
-    last_date, files = retrieve_data_services_files()
+
+def check_stored_balance(conn, date: datetime.date, balance: int, bank_account: BankAccount = None):
+    if is_dry_run():
+        # balances are not posted in dry runs so the stored balance would not match
+        return
+    stored_balance = get_previous_balance(conn, date + datetime.timedelta(days=1), bank_account=bank_account)
+    if stored_balance != balance:
+        logger.error('Stored closing balance for %s (%d) does not match calculated balance (%d)' % (
+            date.isoformat(), stored_balance, balance
+        ))
+
+
+def get_run_budget() -> RunBudget:
+    if is_dry_run():
+        # dry runs neither resume from nor leave checkpoints, which would make real runs skip transactions
+        return RunBudget(settings.RUN_BUDGET_SECONDS, record_checkpoints=False)
+    return RunBudget(settings.RUN_BUDGET_SECONDS, checkpoint=read_checkpoint())
+
+
+def main(sftp_conn=None, should_stop=None, source=None):
+    bank_accounts = get_bank_accounts()
+    # with leases, files completed by other instances are only passed over once balances are committed
+    use_leases = bool(settings.LEASE_DIR) and len(bank_accounts) == 1
+    budget = get_run_budget()
+    stage_timings.reset()
+    api_cache_stats.reset()
+    compression_stats.reset()
+    memory_monitor.reset()
+    start = time.perf_counter()
+    if len(bank_accounts) > 1:
+        last_date, files = retrieve_files_for_accounts(bank_accounts, sftp_conn=sftp_conn, source=source)
+    else:
+        last_date, files = retrieve_data_services_files(
+            sftp_conn=sftp_conn, source=source, account_codes=[bank_accounts[0].code],
+            after_last_balance=use_leases, resume_date=budget.checkpoint.date if budget.checkpoint else None,
+        )
     file_count = len(files)
+    stage_timings.record('retrieve', time.perf_counter() - start, file_count)
     if file_count == 0:
         logger.info('No new files available to upload', extra={
             'elk_fields': {
@@ -389,7 +1123,17 @@ def main():
             '@fields.file_count': file_count
         }
     })
-    transaction_count = upload_transactions_from_files(files)
+    # worker processes are started once for the whole run
+    with run_worker_pool(get_worker_count()):
+        if len(bank_accounts) > 1:
+            transaction_count = upload_transactions_for_accounts(files, bank_accounts, should_stop=should_stop)
+        elif use_leases:
+            from mtp_transaction_uploader.leases import upload_claimed_files
+
+            transaction_count = upload_claimed_files(files, should_stop=should_stop, bank_account=bank_accounts[0])
+        else:
+            transaction_count = upload_transactions_from_files(files, should_stop=should_stop, budget=budget)
+            budget.finish()
     logger.info(
         'Upload of %d transactions complete' % transaction_count,
         extra={
@@ -398,3 +1142,7 @@ def main():
             }
         }
     )
+    stage_timings.log_report()
+    api_cache_stats.log_report()
+    memory_monitor.log_report()
+    compression_stats.log_report()
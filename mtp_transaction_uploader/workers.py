@@ -0,0 +1,49 @@
+"""
+Worker processes shared by the stages of a run which parse files and classify records
+
+A run starts a single pool which is used both to parse files and to classify large files' records. Workers never
+start pools of their own, so a run uses no more worker processes than the larger of PARSE_WORKERS and
+CLASSIFY_WORKERS. Workers are forked as soon as the pool is started so that they do not inherit locks held by
+threads started later in the run, and they do not reuse the parent process's API connection.
+"""
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from mtp_transaction_uploader import api_client
+
+_worker_pool = None
+_in_worker = False
+
+
+@contextlib.contextmanager
+def run_worker_pool(worker_count):
+    """
+    Within the block, makes get_worker_pool return a pool of `worker_count` processes; nested blocks share
+    the outermost pool. No pool is started for a single worker or within a worker process
+    """
+    global _worker_pool
+
+    if _worker_pool is not None or _in_worker or worker_count <= 1:
+        yield _worker_pool
+        return
+    executor = ProcessPoolExecutor(max_workers=worker_count, initializer=init_worker)
+    try:
+        # forked workers are all started on the first submission
+        executor.submit(int).result()
+        _worker_pool = executor
+        yield executor
+    finally:
+        _worker_pool = None
+        executor.shutdown()
+
+
+def get_worker_pool():
+    return _worker_pool
+
+
+def init_worker():
+    global _worker_pool, _in_worker
+
+    _worker_pool = None
+    _in_worker = True
+    api_client.stop_reusing_connection()
@@ -0,0 +1,50 @@
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import account_balances
+
+
+class AccountBalanceStoreTestCase(TestCase):
+    def setUp(self):
+        self.balances_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.balances_dir.cleanup)
+        patchers = [
+            mock.patch.object(account_balances.settings, 'ACCOUNT_BALANCES_DIR', self.balances_dir.name),
+            mock.patch.dict(account_balances._account_balance_stores, clear=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_balances_are_returned_latest_first(self):
+        store = account_balances.get_account_balance_store('555555')
+        self.addCleanup(store.close)
+        store.post({'date': '2016-03-02', 'closing_balance': 1000})
+        store.post({'date': '2016-03-04', 'closing_balance': 1200})
+        store.post({'date': '2016-03-03', 'closing_balance': 1100})
+
+        self.assertEqual(store.get(limit=1), {
+            'count': 1, 'results': [{'date': '2016-03-04', 'closing_balance': 1200}]
+        })
+        self.assertEqual(store.get(limit=1, date__lt='2016-03-04'), {
+            'count': 1, 'results': [{'date': '2016-03-03', 'closing_balance': 1100}]
+        })
+        self.assertEqual(store.get(date__lt='2016-03-02'), {'count': 0, 'results': []})
+
+    def test_posting_same_date_replaces_balance(self):
+        store = account_balances.get_account_balance_store('555555')
+        self.addCleanup(store.close)
+        store.post({'date': '2016-03-02', 'closing_balance': 1000})
+        store.post({'date': '2016-03-02', 'closing_balance': 900})
+
+        self.assertEqual(store.get()['results'], [{'date': '2016-03-02', 'closing_balance': 900}])
+
+    def test_stores_are_kept_per_account(self):
+        store = account_balances.get_account_balance_store('555555')
+        other_store = account_balances.get_account_balance_store('666666')
+        self.addCleanup(store.close)
+        self.addCleanup(other_store.close)
+        store.post({'date': '2016-03-02', 'closing_balance': 1000})
+
+        self.assertIs(account_balances.get_account_balance_store('555555'), store)
+        self.assertEqual(other_store.get(), {'count': 0, 'results': []})
@@ -0,0 +1,114 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import api_cache, upload
+
+
+class APICacheTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = api_cache.APICache(os.path.join(self.path, 'cache.db'), {'batches': 60, 'balances': 60})
+        self.addCleanup(self.cache.close)
+        api_cache.api_cache_stats.reset()
+        self.conn = mock.MagicMock()
+        self.conn.batches.get.return_value = {'count': 1, 'results': [{'id': 1}]}
+
+    def test_repeated_lookups_are_served_from_cache(self):
+        for _ in range(3):
+            response = self.cache.get(self.conn, 'batches', {'date': '2014-02-05'})
+        self.cache.get(self.conn, 'batches', {'date': '2014-02-06'})
+
+        self.assertEqual(response, {'count': 1, 'results': [{'id': 1}]})
+        self.assertEqual(self.conn.batches.get.call_args_list, [
+            mock.call(date='2014-02-05'), mock.call(date='2014-02-06'),
+        ])
+        self.assertEqual(api_cache.api_cache_stats.hits['batches'], 2)
+        self.assertEqual(api_cache.api_cache_stats.misses['batches'], 2)
+
+    def test_expired_responses_are_fetched_again(self):
+        with mock.patch('mtp_transaction_uploader.api_cache.time.time', side_effect=[1000, 1000, 1030, 1061, 1061]):
+            for _ in range(3):
+                self.cache.get(self.conn, 'batches', {'date': '2014-02-05'})
+
+        self.assertEqual(self.conn.batches.get.call_count, 2)
+
+    def test_empty_results_are_not_cached(self):
+        self.conn.batches.get.side_effect = [
+            {'count': 0, 'results': []},
+            {'count': 1, 'results': [{'id': 1}]},
+        ]
+
+        self.assertEqual(self.cache.get(self.conn, 'batches', {'date': '2016-03-03'})['results'], [])
+        self.assertEqual(self.cache.get(self.conn, 'batches', {'date': '2016-03-03'})['results'], [{'id': 1}])
+        self.assertEqual(self.cache.get(self.conn, 'batches', {'date': '2016-03-03'})['results'], [{'id': 1}])
+
+        self.assertEqual(self.conn.batches.get.call_count, 2)
+
+    def test_endpoints_without_ttl_are_not_cached(self):
+        for _ in range(2):
+            self.cache.get(self.conn, 'transactions', {'limit': 1})
+
+        self.assertEqual(self.conn.transactions.get.call_count, 2)
+        self.assertFalse(api_cache.api_cache_stats.misses)
+
+    @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+    def test_posting_balances_invalidates_cached_balances(self, mock_get_conn):
+        mock_get_conn.return_value = self.conn
+        self.conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 1000}]}
+
+        with mock.patch('mtp_transaction_uploader.api_cache.get_api_cache', return_value=self.cache):
+            upload.get_previous_balance(self.conn, date(2014, 2, 6))
+            upload.update_new_balance([], date(2014, 2, 5), net_amount=100)
+            upload.get_previous_balance(self.conn, date(2014, 2, 6))
+
+        self.assertEqual(self.conn.balances.get.call_count, 3)
+        self.conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 1100})
+
+    def test_only_api_balances_are_cached(self):
+        self.conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 1000}]}
+        account_balance_store = mock.MagicMock()
+        account_balance_store.get.return_value = {'count': 1, 'results': [{'closing_balance': 2000}]}
+        bank_accounts = [
+            upload.BankAccount('444444', '123456', '67175315'), upload.BankAccount('555555', '123456', '87654321'),
+        ]
+
+        with mock.patch('mtp_transaction_uploader.api_cache.get_api_cache', return_value=self.cache), \
+                mock.patch('mtp_transaction_uploader.upload.get_account_balance_store',
+                           return_value=account_balance_store), \
+                mock.patch.object(upload.settings, 'ACCOUNT_CODE', '444444'):
+            previous_balances = [
+                upload.get_previous_balance(self.conn, date(2014, 2, 6), bank_account=bank_account)
+                for bank_account in bank_accounts * 2
+            ]
+
+        self.assertEqual(previous_balances, [1000, 2000, 1000, 2000])
+        self.conn.balances.get.assert_called_once_with(limit=1, date__lt='2014-02-06')
+        self.assertEqual(account_balance_store.get.call_count, 2)
+
+
+@mock.patch('mtp_transaction_uploader.api_cache._api_cache', None)
+@mock.patch('mtp_transaction_uploader.api_cache.settings')
+class GetAPICacheTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def get_api_cache(self, mock_settings, lease_dir):
+        mock_settings.API_CACHE_PATH = os.path.join(self.path, 'cache.db')
+        mock_settings.API_CACHE_TTLS = {'batches': 60, 'balances': 60}
+        mock_settings.LEASE_DIR = lease_dir
+        cache = api_cache.get_api_cache()
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_balances_are_cached_by_a_single_instance(self, mock_settings):
+        self.assertEqual(self.get_api_cache(mock_settings, '').ttls, {'batches': 60, 'balances': 60})
+
+    def test_balances_are_not_cached_when_instances_share_files(self, mock_settings):
+        cache = self.get_api_cache(mock_settings, os.path.join(self.path, 'leases'))
+
+        self.assertEqual(cache.ttls, {'batches': 60})
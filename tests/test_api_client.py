@@ -0,0 +1,177 @@
+import gzip
+import json
+import time
+from unittest import mock, TestCase
+
+from oauthlib.oauth2 import LegacyApplicationClient
+from slumber.exceptions import HttpClientError
+
+from mtp_transaction_uploader import api_client
+
+
+@mock.patch('requests.Session.request')
+class GzipOAuth2SessionTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        api_client.compression_stats = api_client.CompressionStats()
+        self.session = api_client.GzipOAuth2Session(
+            client=LegacyApplicationClient(client_id='bank-admin'),
+            token={'access_token': 'token', 'token_type': 'Bearer'},
+            compression_level=9,
+        )
+
+    def test_request_body_compressed(self, mock_request):
+        body = json.dumps([{'amount': 100, 'category': 'credit', 'source': 'bank_transfer'}] * 100)
+
+        self.session.request('POST', 'https://api.local/transactions/', data=body,
+                             headers={'content-type': 'application/json'})
+
+        sent_kwargs = mock_request.call_args[1]
+        self.assertEqual(sent_kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(sent_kwargs['headers']['content-type'], 'application/json')
+        self.assertEqual(gzip.decompress(sent_kwargs['data']).decode(), body)
+
+        stats = api_client.compression_stats
+        self.assertEqual(stats.request_count, 1)
+        self.assertEqual(stats.uncompressed_bytes, len(body))
+        self.assertEqual(stats.compressed_bytes, len(sent_kwargs['data']))
+        self.assertLess(stats.compressed_bytes, stats.uncompressed_bytes)
+
+    def test_requests_without_body_not_compressed(self, mock_request):
+        self.session.request('GET', 'https://api.local/transactions/', params={'limit': 1})
+
+        sent_kwargs = mock_request.call_args[1]
+        self.assertNotIn('Content-Encoding', sent_kwargs.get('headers') or {})
+        self.assertEqual(api_client.compression_stats.request_count, 0)
+
+    def test_streamed_request_body_compressed(self, mock_request):
+        items = [{'amount': 100, 'category': 'credit'}] * 10
+        self.session.request('POST', 'https://api.local/transactions/',
+                             data=api_client.serialise_stream(items))
+
+        sent_kwargs = mock_request.call_args[1]
+        self.assertEqual(sent_kwargs['headers']['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join(sent_kwargs['data']))
+        self.assertEqual(json.loads(body), items)
+        self.assertEqual(api_client.compression_stats.uncompressed_bytes, len(body))
+
+    def test_stats_reset_between_runs(self, mock_request):
+        self.session.request('POST', 'https://api.local/transactions/', data='[]')
+        api_client.compression_stats.reset()
+
+        self.assertEqual(api_client.compression_stats.request_count, 0)
+        self.assertEqual(api_client.compression_stats.compressed_bytes, 0)
+
+
+class StreamedUploadTestCase(TestCase):
+    items = [
+        {'amount': 100, 'category': 'credit', 'prisoner_number': 'A1234BY'},
+        {'amount': 120, 'category': 'debit'},
+        {'amount': 150, 'category': 'credit'},
+    ]
+
+    def test_serialise_json_array(self):
+        body = b''.join(api_client.serialise_stream(iter(self.items)))
+        self.assertEqual(json.loads(body), self.items)
+
+    def test_serialise_empty_json_array(self):
+        body = b''.join(api_client.serialise_stream(iter([])))
+        self.assertEqual(json.loads(body), [])
+
+    def test_serialise_ndjson(self):
+        body = b''.join(api_client.serialise_stream(iter(self.items), ndjson=True))
+        self.assertEqual([json.loads(line) for line in body.splitlines()], self.items)
+
+    @mock.patch('mtp_transaction_uploader.api_client.STREAM_BUFFER_BYTES', 50)
+    def test_serialise_in_blocks(self):
+        blocks = list(api_client.serialise_stream(iter(self.items * 10)))
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(json.loads(b''.join(blocks)), self.items * 10)
+
+    def get_connection(self):
+        session = mock.MagicMock()
+        return api_client.APIConnection(base_url='https://api.local/', session=session), session
+
+    def test_post_streamed(self):
+        conn, session = self.get_connection()
+        session.request.return_value.status_code = 201
+
+        api_client.post_streamed(conn, 'transactions', iter(self.items), ndjson=True)
+
+        args, kwargs = session.request.call_args
+        self.assertEqual(args, ('POST', 'https://api.local/transactions/'))
+        self.assertEqual(kwargs['headers']['content-type'], 'application/x-ndjson')
+        self.assertEqual(len(b''.join(kwargs['data']).splitlines()), 3)
+
+    def test_post_streamed_raises_on_error_response(self):
+        conn, session = self.get_connection()
+        session.request.return_value.status_code = 400
+
+        with self.assertRaises(HttpClientError):
+            api_client.post_streamed(conn, 'transactions', iter(self.items))
+
+
+@mock.patch('mtp_transaction_uploader.api_client.create_authenticated_connection')
+class ConnectionReuseTestCase(TestCase):
+    def test_new_connection_by_default(self, mock_create_connection):
+        mock_create_connection.side_effect = lambda: mock.MagicMock()
+
+        self.assertIsNot(api_client.get_authenticated_connection(), api_client.get_authenticated_connection())
+
+    def test_connection_reused(self, mock_create_connection):
+        mock_create_connection.side_effect = lambda: mock.MagicMock()
+
+        with api_client.reuse_connection():
+            conn = api_client.get_authenticated_connection()
+            conn.http_session.token = {'expires_at': time.time() + 3600}
+
+            self.assertIs(api_client.get_authenticated_connection(), conn)
+            api_client.reset_connection()
+            self.assertIsNot(api_client.get_authenticated_connection(), conn)
+
+    def test_connection_no_longer_reused_after_block(self, mock_create_connection):
+        mock_create_connection.side_effect = lambda: mock.MagicMock()
+
+        with api_client.reuse_connection():
+            with api_client.reuse_connection():
+                conn = api_client.get_authenticated_connection()
+                conn.http_session.token = {'expires_at': time.time() + 3600}
+            # still reused within the outer block
+            self.assertIs(api_client.get_authenticated_connection(), conn)
+
+        self.assertIsNot(api_client.get_authenticated_connection(), conn)
+        self.assertIsNone(api_client._shared_connection)
+
+    def test_connection_replaced_before_token_expires(self, mock_create_connection):
+        mock_create_connection.side_effect = lambda: mock.MagicMock()
+
+        with api_client.reuse_connection():
+            conn = api_client.get_authenticated_connection()
+            conn.http_session.token = {'expires_at': time.time() + 30}
+
+            self.assertIsNot(api_client.get_authenticated_connection(), conn)
+
+
+class RateLimiterTestCase(TestCase):
+    @mock.patch('mtp_transaction_uploader.api_client.time')
+    @mock.patch('mtp_transaction_uploader.api_client.settings')
+    def test_spaces_out_requests(self, mock_settings, mock_time):
+        mock_settings.API_RATE_LIMIT = 4
+        mock_time.monotonic.return_value = 100
+
+        rate_limiter = api_client.RateLimiter()
+        for _ in range(3):
+            rate_limiter.wait()
+
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [0.25, 0.5])
+
+    @mock.patch('mtp_transaction_uploader.api_client.time')
+    @mock.patch('mtp_transaction_uploader.api_client.settings')
+    def test_unlimited(self, mock_settings, mock_time):
+        mock_settings.API_RATE_LIMIT = 0
+
+        rate_limiter = api_client.RateLimiter()
+        for _ in range(3):
+            rate_limiter.wait()
+
+        self.assertFalse(mock_time.sleep.called)
@@ -0,0 +1,85 @@
+from datetime import date
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from slumber.exceptions import HttpServerError
+
+from mtp_transaction_uploader import backfill
+from mtp_transaction_uploader.sources import LocalDirectoryStatementSource
+from tests.test_upload import setup_settings
+
+
+@mock.patch('mtp_transaction_uploader.backfill.update_new_balances')
+@mock.patch('mtp_transaction_uploader.backfill.post_statement')
+@mock.patch('mtp_transaction_uploader.backfill.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.sources.settings')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class BackfillTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        for filename in ['D040214', 'D050214', 'D060214', 'D070214', 'D100214']:
+            shutil.copy('tests/data/Y01A.CARS.#D.444444.D050214', '%s/Y01A.CARS.#D.444444.%s' % (self.path, filename))
+        self.source = LocalDirectoryStatementSource(self.path, settle_seconds=0)
+
+    def setup_settings(self, mock_upload_settings, mock_source_settings):
+        setup_settings(mock_upload_settings)
+        mock_upload_settings.ACCOUNT_CODE = '444444'
+        mock_upload_settings.PARSE_WORKERS = 1
+        mock_upload_settings.COLUMNAR_RECORDS = False
+        mock_upload_settings.USE_FILE_BALANCES = False
+        mock_source_settings.ACCOUNT_CODE = '444444'
+
+    def test_backfills_date_range_then_updates_balances(
+        self, mock_upload_settings, mock_source_settings, mock_get_conn, mock_post_statement, mock_update_new_balances
+    ):
+        self.setup_settings(mock_upload_settings, mock_source_settings)
+
+        transaction_count = backfill.backfill(date(2014, 2, 5), date(2014, 2, 7), self.source, workers=2)
+
+        self.assertEqual(transaction_count, 9)
+        self.assertEqual(
+            sorted(call[0][1].date for call in mock_post_statement.call_args_list),
+            [date(2014, 2, 5), date(2014, 2, 6), date(2014, 2, 7)]
+        )
+        statements = mock_update_new_balances.call_args[0][0]
+        self.assertEqual(
+            sorted(statement.date for statement in statements),
+            [date(2014, 2, 5), date(2014, 2, 6), date(2014, 2, 7)]
+        )
+        # transactions are released once uploaded, leaving the net amount for balances
+        self.assertEqual({len(statement.transactions) for statement in statements}, {0})
+        self.assertEqual({statement.net_amount for statement in statements}, {-269874})
+
+    def test_balances_stop_at_first_failed_file(
+        self, mock_upload_settings, mock_source_settings, mock_get_conn, mock_post_statement, mock_update_new_balances
+    ):
+        self.setup_settings(mock_upload_settings, mock_source_settings)
+
+        def post_statement(conn, statement):
+            if statement.date == date(2014, 2, 6):
+                raise HttpServerError(content='Server error')
+
+        mock_post_statement.side_effect = post_statement
+
+        with mock.patch('mtp_transaction_uploader.backfill.logger') as mock_logger, \
+                mock.patch('mtp_transaction_uploader.upload.logger'):
+            transaction_count = backfill.backfill(date(2014, 2, 5), date(2014, 2, 7), self.source, workers=2)
+
+        self.assertEqual(transaction_count, 6)
+        statements = mock_update_new_balances.call_args[0][0]
+        self.assertEqual([statement.date for statement in statements], [date(2014, 2, 5)])
+        self.assertTrue(mock_logger.error.called)
+
+    def test_nothing_to_backfill(
+        self, mock_upload_settings, mock_source_settings, mock_get_conn, mock_post_statement, mock_update_new_balances
+    ):
+        self.setup_settings(mock_upload_settings, mock_source_settings)
+
+        with mock.patch('mtp_transaction_uploader.backfill.logger'):
+            transaction_count = backfill.backfill(date(2014, 3, 1), date(2014, 3, 31), self.source)
+
+        self.assertEqual(transaction_count, 0)
+        self.assertFalse(mock_post_statement.called)
+        self.assertFalse(mock_update_new_balances.called)
@@ -0,0 +1,210 @@
+from datetime import date
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from slumber.exceptions import HttpServerError
+
+from mtp_transaction_uploader import batches
+from mtp_transaction_uploader.upload import BankAccount, clean_request_data, DownloadedFile, load_statement
+from tests.test_upload import setup_settings
+
+BANK_ACCOUNT = BankAccount('444444', '123456', '67175315')
+
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.batch_dir = os.path.join(self.path, 'batches')
+        self.files = []
+        for filename in ['D070214', 'D050214', 'D060214']:
+            path = os.path.join(self.path, 'Y01A.CARS.#D.444444.%s' % filename)
+            shutil.copy('tests/data/Y01A.CARS.#D.444444.D050214', path)
+            self.files.append(path)
+
+    def setup_settings(self, mock_settings):
+        setup_settings(mock_settings)
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.PARSE_WORKERS = 1
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_settings.USE_FILE_BALANCES = False
+        mock_settings.CHAIN_BALANCES = False
+        mock_settings.UPLOAD_REQUEST_SIZE = 2
+
+
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class BatchFormatTestCase(BatchTestCase):
+    def test_batch_round_trip(self, mock_settings):
+        self.setup_settings(mock_settings)
+        statement = load_statement(self.files[1], bank_account=BANK_ACCOUNT)
+        path = os.path.join(self.path, 'batch' + batches.BATCH_SUFFIX)
+
+        batches.write_batch(statement, path)
+        batch = batches.read_batch(path)
+
+        self.assertEqual(batch.filename, 'Y01A.CARS.#D.444444.D050214')
+        self.assertEqual(batch.date, date(2014, 2, 5))
+        # batches hold cleaned transactions, as they would be uploaded
+        self.assertEqual(clean_request_data(batch.transactions), clean_request_data(statement.transactions))
+        self.assertEqual(batch.net_amount, -269874)
+        self.assertIsNone(batch.file_balance)
+
+    def test_unknown_versions_are_rejected(self, mock_settings):
+        path = os.path.join(self.path, 'batch' + batches.BATCH_SUFFIX)
+        with gzip.open(path, 'wt') as f:
+            f.write('{"format": "%s", "version": %d}\n' % (batches.BATCH_FORMAT, batches.BATCH_VERSION + 1))
+
+        with self.assertRaises(ValueError):
+            batches.read_batch(path)
+
+    def test_list_dated_files_in_date_order(self, mock_settings):
+        os.mkdir(self.batch_dir)
+        for path in self.files:
+            open(batches.get_batch_path(self.batch_dir, path), 'w').close()
+        open(os.path.join(self.batch_dir, 'unrelated' + batches.BATCH_SUFFIX), 'w').close()
+
+        self.assertEqual(
+            [os.path.basename(path) for path in batches.list_dated_files(
+                self.batch_dir, '444444', suffix=batches.BATCH_SUFFIX
+            )],
+            [
+                'Y01A.CARS.#D.444444.D050214.batch.gz',
+                'Y01A.CARS.#D.444444.D060214.batch.gz',
+                'Y01A.CARS.#D.444444.D070214.batch.gz',
+            ]
+        )
+
+
+@mock.patch('mtp_transaction_uploader.upload.update_new_balance')
+@mock.patch('mtp_transaction_uploader.batches.post_statement')
+@mock.patch('mtp_transaction_uploader.batches.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class TransformAndUploadTestCase(BatchTestCase):
+    def test_upload_stage_can_be_retried_alone(
+        self, mock_settings, mock_get_conn, mock_post_statement, mock_update_new_balance
+    ):
+        self.setup_settings(mock_settings)
+        transaction_count = batches.transform_files(
+            sorted(self.files), bank_account=BANK_ACCOUNT, batch_dir=self.batch_dir
+        )
+        self.assertEqual(transaction_count, 9)
+
+        def post_statement(conn, statement, budget=None):
+            if statement.date == date(2014, 2, 6):
+                raise HttpServerError(content='Server error')
+
+        mock_post_statement.side_effect = post_statement
+        with mock.patch('mtp_transaction_uploader.upload.logger'), \
+                mock.patch('mtp_transaction_uploader.batches.logger'):
+            self.assertEqual(batches.upload_batches(batch_dir=self.batch_dir), 3)
+        # later batches are not uploaded after one fails so that balances are updated in date order
+        self.assertEqual(
+            [call[0][1].date for call in mock_post_statement.call_args_list], [date(2014, 2, 5), date(2014, 2, 6)]
+        )
+        self.assertEqual([call[0][1] for call in mock_update_new_balance.call_args_list], [date(2014, 2, 5)])
+
+        # uploaded batches are skipped when retried
+        mock_post_statement.reset_mock()
+        mock_post_statement.side_effect = None
+        with mock.patch('mtp_transaction_uploader.batches.logger'):
+            self.assertEqual(batches.upload_batches(batch_dir=self.batch_dir), 6)
+        self.assertEqual(
+            [call[0][1].date for call in mock_post_statement.call_args_list], [date(2014, 2, 6), date(2014, 2, 7)]
+        )
+        self.assertEqual(
+            [call[0][1] for call in mock_update_new_balance.call_args_list],
+            [date(2014, 2, 5), date(2014, 2, 6), date(2014, 2, 7)]
+        )
+        self.assertEqual(
+            {call[1]['net_amount'] for call in mock_update_new_balance.call_args_list}, {-269874}
+        )
+
+        # files with uploaded batches are not transformed again
+        self.assertEqual(
+            batches.transform_files(self.files, bank_account=BANK_ACCOUNT, batch_dir=self.batch_dir), 0
+        )
+
+
+class RemoveUploadedBatchesTestCase(BatchTestCase):
+    def test_batches_uploaded_before_retention_are_removed_with_their_files(self):
+        os.makedirs(self.batch_dir)
+        uploaded_paths = []
+        for filename in self.files:
+            path = batches.get_batch_path(self.batch_dir, filename) + batches.UPLOADED_SUFFIX
+            open(path, 'w').close()
+            uploaded_paths.append(path)
+        # the first file's batch was uploaded 8 days ago
+        uploaded_at = time.time() - 8 * 24 * 60 * 60
+        os.utime(uploaded_paths[0], (uploaded_at, uploaded_at))
+
+        with mock.patch('mtp_transaction_uploader.batches.settings') as mock_settings, \
+                mock.patch('mtp_transaction_uploader.batches.logger'):
+            mock_settings.DS_NEW_FILES_DIR = self.path
+            self.assertEqual(batches.remove_uploaded_batches(self.batch_dir, BANK_ACCOUNT, 7), 1)
+
+        self.assertEqual([os.path.exists(path) for path in uploaded_paths], [False, True, True])
+        self.assertEqual([os.path.exists(path) for path in self.files], [False, True, True])
+
+
+@mock.patch('mtp_transaction_uploader.upload.update_new_balance')
+@mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=None)
+@mock.patch('mtp_transaction_uploader.upload.post_transactions')
+@mock.patch('mtp_transaction_uploader.batches.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class ResumeBatchTestCase(BatchTestCase):
+    def test_batch_failing_part_way_is_resumed_after_last_chunk_posted(
+        self, mock_settings, mock_get_conn, mock_post_transactions, mock_get_fingerprint_index,
+        mock_update_new_balance
+    ):
+        self.setup_settings(mock_settings)
+        batches.transform_files(self.files[1:2], bank_account=BANK_ACCOUNT, batch_dir=self.batch_dir)
+        chunk_sizes = []
+
+        def post_transactions(conn, transactions):
+            if chunk_sizes:
+                raise HttpServerError(content='Server error')
+            chunk_sizes.append(len(list(transactions)))
+
+        mock_post_transactions.side_effect = post_transactions
+        with mock.patch('mtp_transaction_uploader.upload.logger'), \
+                mock.patch('mtp_transaction_uploader.batches.logger'):
+            self.assertEqual(batches.upload_batches(batch_dir=self.batch_dir), 0)
+        self.assertFalse(mock_update_new_balance.called)
+
+        mock_post_transactions.side_effect = lambda conn, transactions: chunk_sizes.append(len(list(transactions)))
+        with mock.patch('mtp_transaction_uploader.batches.logger'):
+            self.assertEqual(batches.upload_batches(batch_dir=self.batch_dir), 3)
+        # the first chunk is not posted again
+        self.assertEqual(chunk_sizes, [2, 1])
+        self.assertEqual(mock_update_new_balance.call_args[1]['net_amount'], -269874)
+        self.assertEqual(os.listdir(self.batch_dir), [
+            'Y01A.CARS.#D.444444.D050214' + batches.BATCH_SUFFIX + batches.UPLOADED_SUFFIX,
+        ])
+
+
+@mock.patch('mtp_transaction_uploader.batches.retrieve_data_services_files')
+@mock.patch('mtp_transaction_uploader.batches.settings')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class FetchTestCase(BatchTestCase):
+    def test_files_downloaded_into_memory_are_written_out(
+        self, mock_upload_settings, mock_batch_settings, mock_retrieve
+    ):
+        self.setup_settings(mock_upload_settings)
+        new_files_dir = os.path.join(self.path, 'new')
+        os.mkdir(new_files_dir)
+        mock_batch_settings.DS_NEW_FILES_DIR = new_files_dir
+        with open(self.files[1], 'rb') as f:
+            content = f.read()
+        mock_retrieve.return_value = (date(2014, 2, 5), [
+            DownloadedFile(os.path.join(new_files_dir, 'Y01A.CARS.#D.444444.D050214'), content),
+        ])
+
+        files = batches.fetch_files()
+
+        self.assertEqual(files, [os.path.join(new_files_dir, 'Y01A.CARS.#D.444444.D050214')])
+        with open(files[0], 'rb') as f:
+            self.assertEqual(f.read(), content)
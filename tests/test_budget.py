@@ -0,0 +1,117 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import budget, upload
+from tests.test_upload import setup_settings
+
+
+@mock.patch('mtp_transaction_uploader.upload.settings')
+@mock.patch('mtp_transaction_uploader.budget.settings')
+class RunBudgetTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.statement = upload.StatementTransactions(
+            'Y01A.CARS.#D.444444.D050214', date(2014, 2, 5),
+            [{'amount': amount, 'category': 'credit'} for amount in [100, 200, 300]], None, None,
+        )
+
+    def setup_settings(self, mock_budget_settings, mock_upload_settings):
+        setup_settings(mock_upload_settings)
+        mock_upload_settings.UPLOAD_REQUEST_SIZE = 2
+        mock_budget_settings.RUN_CHECKPOINT_PATH = os.path.join(self.path, 'checkpoint.json')
+
+    def test_stops_part_way_through_statement_and_writes_checkpoint(
+        self, mock_budget_settings, mock_upload_settings
+    ):
+        self.setup_settings(mock_budget_settings, mock_upload_settings)
+        run_budget = budget.RunBudget(60)
+        balance_updater = mock.MagicMock()
+
+        def post_transactions(conn, transactions):
+            # the chunk is measured as far slower than the budget allows
+            run_budget.record_chunk(1000)
+
+        with mock.patch('mtp_transaction_uploader.upload.post_transactions', side_effect=post_transactions) as \
+                mock_post_transactions, mock.patch('mtp_transaction_uploader.budget.logger') as mock_logger, \
+                mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=None):
+            transaction_count = upload.upload_statements(
+                mock.MagicMock(), [self.statement, self.statement], balance_updater, budget=run_budget
+            )
+
+        self.assertEqual(transaction_count, 0)
+        self.assertEqual(mock_post_transactions.call_count, 1)
+        self.assertFalse(balance_updater.statement_uploaded.called)
+        self.assertTrue(mock_logger.warning.called)
+        self.assertEqual(
+            budget.read_checkpoint(), budget.Checkpoint('Y01A.CARS.#D.444444.D050214', date(2014, 2, 5), 2)
+        )
+
+    def test_next_run_resumes_from_checkpoint(self, mock_budget_settings, mock_upload_settings):
+        self.setup_settings(mock_budget_settings, mock_upload_settings)
+        budget.write_checkpoint(budget.Checkpoint('Y01A.CARS.#D.444444.D050214', date(2014, 2, 5), 2))
+        run_budget = budget.RunBudget(checkpoint=budget.read_checkpoint())
+        balance_updater = mock.MagicMock()
+
+        with mock.patch('mtp_transaction_uploader.upload.post_transactions') as mock_post_transactions, \
+                mock.patch('mtp_transaction_uploader.upload.logger'), \
+                mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=None):
+            transaction_count = upload.upload_statements(
+                mock.MagicMock(), [self.statement], balance_updater, budget=run_budget
+            )
+        run_budget.finish()
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(
+            [list(call[0][1]) for call in mock_post_transactions.call_args_list],
+            [[{'amount': 300, 'category': 'credit'}]]
+        )
+        # balances are updated using all of the statement's transactions
+        balance_updater.statement_uploaded.assert_called_once_with(self.statement)
+        self.assertIsNone(budget.read_checkpoint())
+
+    def test_first_statement_is_always_started(self, mock_budget_settings, mock_upload_settings):
+        self.setup_settings(mock_budget_settings, mock_upload_settings)
+        run_budget = budget.RunBudget(60)
+        run_budget.record_chunk(1000)
+
+        with mock.patch('mtp_transaction_uploader.budget.logger'):
+            self.assertTrue(run_budget.can_start_statement(self.statement, 2))
+            self.assertFalse(run_budget.can_start_statement(self.statement, 2))
+
+    def test_dry_runs_neither_read_nor_write_checkpoints(self, mock_budget_settings, mock_upload_settings):
+        self.setup_settings(mock_budget_settings, mock_upload_settings)
+        mock_upload_settings.RUN_BUDGET_SECONDS = 60
+        checkpoint = budget.Checkpoint('Y01A.CARS.#D.444444.D050214', date(2014, 2, 5), 2)
+        budget.write_checkpoint(checkpoint)
+
+        with mock.patch('mtp_transaction_uploader.upload.is_dry_run', return_value=True):
+            run_budget = upload.get_run_budget()
+        self.assertIsNone(run_budget.checkpoint)
+
+        run_budget.record_chunk(1000)
+        with mock.patch('mtp_transaction_uploader.budget.logger'):
+            self.assertFalse(run_budget.can_start_chunk(self.statement, 2))
+        run_budget.finish()
+        self.assertEqual(budget.read_checkpoint(), checkpoint)
+
+        with mock.patch('mtp_transaction_uploader.upload.is_dry_run', return_value=False):
+            self.assertEqual(upload.get_run_budget().checkpoint, checkpoint)
+
+
+@mock.patch('mtp_transaction_uploader.upload.download_new_files')
+@mock.patch('mtp_transaction_uploader.upload.get_last_transaction_date', return_value=date(2014, 2, 6))
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.clear_new_files_dir')
+class ResumeRetrievalTestCase(TestCase):
+    def test_file_stopped_part_way_through_is_retrieved_again(
+        self, mock_clear, mock_get_conn, mock_get_last_transaction_date, mock_download_new_files
+    ):
+        mock_download_new_files.return_value = upload.NewFiles([], [])
+
+        upload.retrieve_data_services_files(resume_date=date(2014, 2, 6))
+
+        self.assertEqual(mock_download_new_files.call_args[0][0], date(2014, 2, 5))
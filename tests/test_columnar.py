@@ -0,0 +1,147 @@
+import glob
+from unittest import mock, skipIf, TestCase
+
+from bankline_parser.data_services import parse
+
+from mtp_transaction_uploader import upload, workers
+
+try:
+    from mtp_transaction_uploader.columnar import RecordColumns
+except ImportError:
+    # NumPy is an optional dependency
+    RecordColumns = None
+
+SORT_CODE = '123456'
+ACCOUNT_NUMBER = '67175315'
+
+
+def load_file(filename):
+    with open(filename) as f:
+        lines = f.readlines()
+    return parse(lines), RecordColumns(lines)
+
+
+@skipIf(RecordColumns is None, 'NumPy is not installed')
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class RecordColumnsTestCase(TestCase):
+    def test_decodes_fields(self, _):
+        _, columns = load_file('tests/data/testfile_1')
+
+        self.assertEqual(len(columns), 4)
+        self.assertEqual(columns.transaction_codes.tolist(), [b'03', b'99', b'93', b'Y1'])
+        self.assertEqual(columns.amounts.tolist(), [288615, 8939, 9802, 0])
+
+    def test_totals(self, _):
+        _, columns = load_file('tests/data/testfile_1')
+
+        self.assertEqual(columns.totals(SORT_CODE, ACCOUNT_NUMBER), {
+            'credit_count': 2,
+            'credit_total': 18741,
+            'debit_count': 1,
+            'debit_total': 288615,
+        })
+        self.assertEqual(columns.net_amount(SORT_CODE, ACCOUNT_NUMBER), 18741 - 288615)
+
+    def test_filters_other_accounts(self, _):
+        _, columns = load_file('tests/data/testfile_multiple_accounts')
+
+        self.assertEqual(columns.totals(SORT_CODE, ACCOUNT_NUMBER)['credit_count'], 1)
+        self.assertEqual(columns.totals(SORT_CODE, '99887766')['credit_count'], 1)
+
+    def test_validates_account_trailers(self, _):
+        data_services_file, columns = load_file('tests/data/testfile_incorrect_totals')
+
+        self.assertFalse(columns.is_valid())
+        self.assertEqual(columns.errors, data_services_file.errors)
+
+    def test_selects_records_of_account(self, _):
+        with open('tests/data/testfile_1') as f:
+            lines = f.readlines()
+        # the same account section with records for another account
+        other_account_lines = [
+            line[:6] + '99887766' + line[14:] if line.startswith(SORT_CODE + ACCOUNT_NUMBER) else line
+            for line in lines[1:]
+        ]
+        columns = RecordColumns(lines + other_account_lines)
+
+        self.assertTrue(columns.is_valid())
+        self.assertEqual(len(columns.transaction_lines(SORT_CODE, ACCOUNT_NUMBER)), 3)
+        self.assertEqual(len(columns.balance_records(SORT_CODE, ACCOUNT_NUMBER)), 1)
+        self.assertEqual(columns.net_amount(SORT_CODE, ACCOUNT_NUMBER), 18741 - 288615)
+        self.assertEqual(columns.net_amount(SORT_CODE, '00000000'), 0)
+
+    def test_matches_record_path(self, mock_get_conn):
+        mock_get_conn().batches.get.return_value = {'count': 1, 'results': [{'id': 10}]}
+        for filename in glob.glob('tests/data/*'):
+            with self.subTest(filename=filename):
+                data_services_file, columns = load_file(filename)
+                self.assertEqual(columns.errors, data_services_file.errors)
+                if not data_services_file.is_valid():
+                    continue
+
+                transactions = upload.get_transactions_from_file(data_services_file)
+                columnar_transactions = upload.get_transactions_from_columns(columns)
+
+                self.assertEqual(columnar_transactions, transactions)
+                self.assertEqual(
+                    upload.get_closing_balance_from_records(columns.balance_records(SORT_CODE, ACCOUNT_NUMBER)),
+                    upload.get_closing_balance_from_file(data_services_file),
+                )
+                if transactions:
+                    self.assertEqual(
+                        upload.calculate_closing_balance(0, [], columns.net_amount(SORT_CODE, ACCOUNT_NUMBER)),
+                        upload.calculate_closing_balance(0, transactions),
+                    )
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_load_statement_with_columnar_records(self, mock_settings, _):
+        mock_settings.NOMS_AGENCY_SORT_CODE = SORT_CODE
+        mock_settings.NOMS_AGENCY_ACCOUNT_NUMBER = ACCOUNT_NUMBER
+        mock_settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED = False
+        mock_settings.CLASSIFY_WORKERS = 1
+        mock_settings.COLUMNAR_RECORDS = True
+        mock_settings.USE_FILE_BALANCES = False
+        mock_settings.ACCOUNT_CODE = '444444'
+
+        statement = upload.load_statement('tests/data/Y01A.CARS.#D.444444.D050214')
+
+        self.assertEqual(len(statement.transactions), 3)
+        self.assertEqual(statement.net_amount, 18741 - 288615)
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_sharded_classification_matches_serial(self, mock_settings, _):
+        mock_settings.NOMS_AGENCY_SORT_CODE = SORT_CODE
+        mock_settings.NOMS_AGENCY_ACCOUNT_NUMBER = ACCOUNT_NUMBER
+        mock_settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED = False
+        mock_settings.CLASSIFY_WORKERS = 1
+        mock_settings.CLASSIFY_SHARD_SIZE = 2
+        _, columns = load_file('tests/data/testfile_roll_number')
+        serial_transactions = upload.get_transactions_from_columns(columns)
+
+        mock_settings.CLASSIFY_WORKERS = 2
+        with workers.run_worker_pool(2):
+            sharded_transactions = upload.get_transactions_from_columns(columns)
+
+        self.assertEqual(len(sharded_transactions), 7)
+        self.assertEqual(
+            upload.clean_request_data(sharded_transactions), upload.clean_request_data(serial_transactions),
+        )
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_load_statement_skips_other_accounts(self, mock_settings, _):
+        mock_settings.NOMS_AGENCY_SORT_CODE = SORT_CODE
+        mock_settings.NOMS_AGENCY_ACCOUNT_NUMBER = ACCOUNT_NUMBER
+        mock_settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED = False
+        mock_settings.CLASSIFY_WORKERS = 1
+        mock_settings.COLUMNAR_RECORDS = True
+        mock_settings.USE_FILE_BALANCES = True
+        mock_settings.ACCOUNT_CODE = '444444'
+
+        with mock.patch('mtp_transaction_uploader.columnar.RecordColumns', wraps=RecordColumns) as mock_columns:
+            statement = upload.load_statement('tests/data/Y01A.CARS.#D.444444.D050214')
+            self.assertEqual(statement.file_balance, 38510000)
+            self.assertIsNone(upload.load_statement(
+                'tests/data/Y01A.CARS.#D.444444.D050214',
+                bank_account=upload.BankAccount('444444', SORT_CODE, '99887766'),
+            ))
+        self.assertEqual(mock_columns.call_count, 1)
@@ -0,0 +1,79 @@
+import signal
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader.daemon import UploaderDaemon
+from mtp_transaction_uploader.sources import SFTPStatementSource
+
+
+@mock.patch('mtp_transaction_uploader.daemon.api_client')
+@mock.patch('mtp_transaction_uploader.daemon.upload')
+@mock.patch('mtp_transaction_uploader.daemon.signal.signal')
+class UploaderDaemonTestCase(TestCase):
+    def make_daemon(self, polls_before_stop):
+        daemon = UploaderDaemon(poll_interval=0, poll_jitter=0, max_backoff=0, source=SFTPStatementSource())
+        poll = daemon.poll
+
+        def poll_then_stop():
+            nonlocal polls_before_stop
+            poll()
+            polls_before_stop -= 1
+            if polls_before_stop == 0:
+                daemon.stop()
+
+        daemon.poll = poll_then_stop
+        return daemon
+
+    @mock.patch('mtp_transaction_uploader.upload.download_new_files')
+    @mock.patch('mtp_transaction_uploader.upload.open_sftp_connection')
+    def test_polls_until_stopped_reusing_connections(self, mock_open_sftp_connection, mock_download_new_files,
+                                                     mock_signal, mock_upload, mock_api_client):
+        daemon = self.make_daemon(3)
+        mock_upload.main.side_effect = lambda source, should_stop: source.retrieve_new_files(None)
+        daemon.run()
+
+        self.assertEqual(mock_upload.main.call_count, 3)
+        self.assertEqual(mock_open_sftp_connection.call_count, 1)
+        mock_api_client.reuse_connection.assert_called_once_with()
+        mock_upload.main.assert_called_with(source=daemon.source, should_stop=daemon.should_stop)
+        mock_download_new_files.assert_called_with(
+            None, sftp_conn=mock_open_sftp_connection(), end_date=None, account_codes=None
+        )
+        mock_open_sftp_connection().close.assert_called_once_with()
+        self.assertEqual(
+            [call[0][0] for call in mock_signal.call_args_list],
+            [signal.SIGTERM, signal.SIGINT],
+        )
+
+    @mock.patch('mtp_transaction_uploader.upload.download_new_files')
+    @mock.patch('mtp_transaction_uploader.upload.open_sftp_connection')
+    def test_reconnects_after_failure(self, mock_open_sftp_connection, mock_download_new_files,
+                                      mock_signal, mock_upload, mock_api_client):
+        mock_download_new_files.side_effect = [OSError('Connection lost'), None]
+        mock_upload.main.side_effect = lambda source, should_stop: source.retrieve_new_files(None)
+
+        daemon = self.make_daemon(2)
+        with mock.patch('mtp_transaction_uploader.daemon.logger'):
+            daemon.run()
+
+        self.assertEqual(mock_upload.main.call_count, 2)
+        self.assertEqual(mock_open_sftp_connection.call_count, 2)
+        self.assertEqual(mock_api_client.reset_connection.call_count, 2)
+        self.assertEqual(daemon.consecutive_failures, 0)
+
+    def test_signal_requests_stop(self, mock_signal, mock_upload, mock_api_client):
+        daemon = UploaderDaemon(poll_interval=0, poll_jitter=0, source=SFTPStatementSource())
+        self.assertFalse(daemon.should_stop())
+
+        with mock.patch('mtp_transaction_uploader.daemon.logger'):
+            daemon.handle_signal(signal.SIGTERM, None)
+
+        self.assertTrue(daemon.should_stop())
+
+    def test_next_delay_backs_off_with_jitter(self, mock_signal, mock_upload, mock_api_client):
+        daemon = UploaderDaemon(poll_interval=60, poll_jitter=10, max_backoff=300, source=SFTPStatementSource())
+
+        self.assertTrue(60 <= daemon.next_delay() <= 70)
+        daemon.consecutive_failures = 1
+        self.assertTrue(120 <= daemon.next_delay() <= 130)
+        daemon.consecutive_failures = 5
+        self.assertTrue(300 <= daemon.next_delay() <= 310)
@@ -0,0 +1,125 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import fingerprints, upload
+from mtp_transaction_uploader.transaction import Transaction
+from tests.test_upload import setup_settings
+
+
+def get_transaction(amount=1000, reference='A1234BC 01/01/1980'):
+    return Transaction(
+        amount=amount, sender_sort_code='112233', sender_account_number='12345678', reference=reference,
+        received_at='2014-02-05T12:00:00+00:00', processor_type_code='99', category='credit',
+    )
+
+
+class FingerprintIndexTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.index = fingerprints.FingerprintIndex(os.path.join(self.path, 'fingerprints.db'))
+        self.addCleanup(self.index.close)
+
+    def test_only_uploaded_copies_of_identical_transactions_are_skipped(self):
+        uploaded = [get_transaction(), get_transaction(amount=2000)]
+        self.index.record(uploaded)
+
+        transactions = [
+            get_transaction(), get_transaction(), get_transaction(amount=2000), get_transaction(amount=3000),
+        ]
+        self.assertEqual(self.index.new_transactions(transactions), [
+            get_transaction(), get_transaction(amount=3000),
+        ])
+
+    def test_seed_from_api(self):
+        conn = mock.MagicMock()
+        api_transaction = dict(get_transaction().items(), received_at='2014-02-05T12:00:00Z')
+        conn.transactions.get.side_effect = [
+            {'count': 3, 'results': [api_transaction, api_transaction]},
+            {'count': 3, 'results': [dict(api_transaction, amount=2000)]},
+        ]
+
+        with mock.patch('mtp_transaction_uploader.fingerprints.logger'):
+            transaction_count = fingerprints.seed_fingerprint_index(
+                conn, self.index, date(2014, 2, 5), date(2014, 2, 6)
+            )
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(conn.transactions.get.call_args_list[1], mock.call(
+            received_at__gte='2014-02-05', received_at__lt='2014-02-07',
+            ordering='received_at', offset=2, limit=fingerprints.SEED_PAGE_SIZE,
+        ))
+        self.assertEqual(self.index.new_transactions([get_transaction()] * 3), [get_transaction()])
+        self.assertEqual(self.index.new_transactions([get_transaction(amount=2000)]), [])
+
+
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class UploadWithFingerprintIndexTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.index = fingerprints.FingerprintIndex(os.path.join(self.path, 'fingerprints.db'))
+        self.addCleanup(self.index.close)
+        patcher = mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def setup_settings(self, mock_settings):
+        setup_settings(mock_settings)
+        mock_settings.UPLOAD_REQUEST_SIZE = 2
+        mock_settings.STREAM_UPLOADS = False
+        mock_settings.API_RATE_LIMIT = 0
+
+    def test_reprocessed_statement_posts_only_new_transactions(self, mock_settings):
+        self.setup_settings(mock_settings)
+        conn = mock.MagicMock()
+        transactions = [get_transaction(reference=str(i)) for i in range(3)]
+        upload.post_statement(conn, upload.StatementTransactions(
+            'file', date(2014, 2, 5), transactions[:2], None, None
+        ))
+        conn.reset_mock()
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            upload.post_statement(conn, upload.StatementTransactions(
+                'file', date(2014, 2, 5), transactions, None, None
+            ))
+
+        conn.transactions.post.assert_called_once_with([transactions[2].to_request_data()])
+
+    def test_resumed_statement_skips_checkpointed_transactions_and_counts_progress_in_statement_order(
+        self, mock_settings
+    ):
+        self.setup_settings(mock_settings)
+        conn = mock.MagicMock()
+        transactions = [get_transaction(reference=str(i)) for i in range(6)]
+        self.index.record([transactions[2]])
+        budget = mock.MagicMock()
+        budget.resume_count.return_value = 1
+        budget.can_start_chunk.return_value = True
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            upload.post_statement(conn, upload.StatementTransactions(
+                'file', date(2014, 2, 5), transactions, None, None
+            ), budget=budget)
+
+        self.assertEqual([call[0][0] for call in conn.transactions.post.call_args_list], [
+            [transactions[1].to_request_data(), transactions[3].to_request_data()],
+            [transactions[4].to_request_data(), transactions[5].to_request_data()],
+        ])
+        self.assertEqual([call[0][1] for call in budget.can_start_chunk.call_args_list], [1, 4])
+
+    def test_packed_statements_with_nothing_new_still_update_balances(self, mock_settings):
+        self.setup_settings(mock_settings)
+        conn = mock.MagicMock()
+        statement = upload.StatementTransactions('file', date(2014, 2, 5), [get_transaction()], None, None)
+        self.index.record(statement.transactions)
+        balance_updater = mock.MagicMock()
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            upload.upload_packed_statements(conn, [statement], balance_updater)
+
+        self.assertFalse(conn.transactions.post.called)
+        balance_updater.statement_uploaded.assert_called_once_with(statement)
@@ -0,0 +1,218 @@
+from datetime import date
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from slumber.exceptions import HttpServerError
+
+from mtp_transaction_uploader import leases
+from mtp_transaction_uploader.sinks import SinkConnection
+from mtp_transaction_uploader.upload import BankAccount
+from tests.test_upload import setup_settings
+
+
+class DirectoryLeaseBackendTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.backend = leases.DirectoryLeaseBackend(self.path)
+
+    def test_lease_is_exclusive_until_released(self):
+        self.assertTrue(self.backend.acquire('file', 'instance-1', 60))
+        self.assertFalse(self.backend.acquire('file', 'instance-2', 60))
+
+        self.backend.release('file', 'instance-2')
+        self.assertFalse(self.backend.acquire('file', 'instance-2', 60))
+
+        self.backend.release('file', 'instance-1')
+        self.assertTrue(self.backend.acquire('file', 'instance-2', 60))
+
+    def test_expired_lease_can_be_taken_over(self):
+        with open(self.backend.lease_path('file'), 'w') as f:
+            json.dump({'owner': 'instance-1', 'expires_at': time.time() - 1}, f)
+
+        self.assertTrue(self.backend.acquire('file', 'instance-2', 60))
+        self.assertFalse(self.backend.renew('file', 'instance-1', 60))
+        self.assertTrue(self.backend.renew('file', 'instance-2', 60))
+        self.assertFalse(os.path.exists(self.backend.lease_path('file') + '.takeover'))
+
+    def test_lease_is_complete_when_it_appears(self):
+        link = os.link
+
+        def check_link(source, destination):
+            with open(source) as f:
+                self.assertEqual(json.load(f)['owner'], 'instance-1')
+            link(source, destination)
+
+        with mock.patch('mtp_transaction_uploader.leases.os.link', side_effect=check_link) as mock_link:
+            self.assertTrue(self.backend.acquire('file', 'instance-1', 60))
+
+        mock_link.assert_called_once()
+        self.assertFalse(self.backend.acquire('file', 'instance-2', 60))
+        self.assertEqual(os.listdir(self.path), ['file.lease'])
+
+    def test_completed_files_are_recorded(self):
+        self.assertIsNone(self.backend.get_completed('file'))
+
+        self.backend.mark_completed('file', {'date': '2014-02-05', 'net_amount': 100, 'file_balance': None})
+
+        self.assertEqual(self.backend.get_completed('file')['net_amount'], 100)
+
+    def test_completed_files_before_date_are_removed(self):
+        self.backend.mark_completed('file-1', {'date': '2014-02-05', 'net_amount': 100, 'file_balance': None})
+        self.backend.mark_completed('file-2', {'date': '2014-02-06', 'net_amount': 100, 'file_balance': None})
+        self.backend.acquire('file-1', 'instance-1', 60)
+
+        self.assertEqual(self.backend.remove_completed_before(date(2014, 2, 6)), 1)
+
+        self.assertIsNone(self.backend.get_completed('file-1'))
+        self.assertIsNotNone(self.backend.get_completed('file-2'))
+        self.assertTrue(os.path.exists(self.backend.lease_path('file-1')))
+
+
+class LeasesTestCase(TestCase):
+    def test_heartbeat_renews_held_leases(self):
+        backend = mock.MagicMock()
+        backend.renew.return_value = False
+
+        with leases.Leases(backend, owner='instance-1', duration=0.03) as held_leases:
+            self.assertTrue(held_leases.claim('file'))
+            time.sleep(0.1)
+            # the lease was lost when it could not be renewed
+            self.assertNotIn('file', held_leases.held)
+
+        backend.renew.assert_called_with('file', 'instance-1', 0.03)
+
+
+@mock.patch('mtp_transaction_uploader.leases.update_new_balances')
+@mock.patch('mtp_transaction_uploader.leases.get_last_balance_date', return_value=None)
+@mock.patch('mtp_transaction_uploader.leases.post_statement')
+@mock.patch('mtp_transaction_uploader.leases.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class UploadClaimedFilesTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.files = []
+        for filename in ['D050214', 'D060214', 'D070214']:
+            path = os.path.join(self.path, 'Y01A.CARS.#D.444444.%s' % filename)
+            shutil.copy('tests/data/Y01A.CARS.#D.444444.D050214', path)
+            self.files.append(path)
+        self.backend = leases.DirectoryLeaseBackend(os.path.join(self.path, 'leases'))
+
+    def test_uploads_unclaimed_files_and_commits_balances_in_order(
+        self, mock_settings, mock_get_conn, mock_post_statement, mock_get_last_balance_date, mock_update_new_balances
+    ):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_settings.USE_FILE_BALANCES = False
+        # the first file was completed and the second is still being processed by other instances
+        self.backend.mark_completed('Y01A.CARS.#D.444444.D050214', {
+            'date': '2014-02-05', 'net_amount': 100, 'file_balance': None,
+        })
+        self.backend.acquire('Y01A.CARS.#D.444444.D060214', 'instance-2', 60)
+
+        with mock.patch('mtp_transaction_uploader.leases.logger'):
+            transaction_count = leases.upload_claimed_files(
+                self.files, bank_account=BankAccount('444444', '123456', '67175315'), backend=self.backend
+            )
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual([call[0][1].date for call in mock_post_statement.call_args_list], [date(2014, 2, 7)])
+        self.assertEqual(
+            self.backend.get_completed('Y01A.CARS.#D.444444.D070214'),
+            {'date': '2014-02-07', 'net_amount': -269874, 'file_balance': None}
+        )
+        # balances stop before the file which is not yet complete
+        statements = mock_update_new_balances.call_args[0][0]
+        self.assertEqual([(statement.date, statement.net_amount) for statement in statements], [
+            (date(2014, 2, 5), 100),
+        ])
+        self.assertFalse(os.path.exists(self.backend.lease_path('Y01A.CARS.#D.444444.D070214')))
+        self.assertFalse(os.path.exists(self.backend.lease_path(leases.BALANCES_LEASE)))
+
+    @mock.patch('mtp_transaction_uploader.leases.settings.LEASE_RETENTION_DAYS', 1)
+    def test_completed_files_long_before_last_balance_are_removed(
+        self, mock_settings, mock_get_conn, mock_post_statement, mock_get_last_balance_date, mock_update_new_balances
+    ):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_get_last_balance_date.return_value = date(2014, 2, 7)
+        for filename in self.files:
+            self.backend.mark_completed(os.path.basename(filename), {
+                'date': '2014-02-%s' % filename[-6:-4], 'net_amount': 100, 'file_balance': None,
+            })
+
+        with mock.patch('mtp_transaction_uploader.leases.logger'):
+            leases.upload_claimed_files(
+                self.files, bank_account=BankAccount('444444', '123456', '67175315'), backend=self.backend
+            )
+
+        self.assertFalse(mock_post_statement.called)
+        self.assertFalse(mock_update_new_balances.called)
+        self.assertEqual([
+            self.backend.get_completed(os.path.basename(filename)) is not None for filename in self.files
+        ], [False, True, True])
+
+    def test_dry_run_leaves_files_incomplete(
+        self, mock_settings, mock_get_conn, mock_post_statement, mock_get_last_balance_date, mock_update_new_balances
+    ):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_get_conn.return_value = SinkConnection(mock.MagicMock(), mock.MagicMock())
+
+        with mock.patch('mtp_transaction_uploader.leases.logger'):
+            transaction_count = leases.upload_claimed_files(
+                self.files, bank_account=BankAccount('444444', '123456', '67175315'), backend=self.backend
+            )
+
+        self.assertEqual(transaction_count, 9)
+        self.assertEqual(mock_post_statement.call_count, 3)
+        for filename in self.files:
+            self.assertIsNone(self.backend.get_completed(os.path.basename(filename)))
+        self.assertFalse(mock_update_new_balances.called)
+
+
+@mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=None)
+@mock.patch('mtp_transaction_uploader.upload.post_transactions')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class ResumeClaimedFileTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.backend = leases.DirectoryLeaseBackend(self.path)
+
+    def test_file_failing_part_way_is_resumed_after_last_chunk_posted(
+        self, mock_settings, mock_post_transactions, mock_get_fingerprint_index
+    ):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_settings.UPLOAD_REQUEST_SIZE = 1
+        filename = 'tests/data/Y01A.CARS.#D.444444.D050214'
+        name = os.path.basename(filename)
+        bank_account = BankAccount('444444', '123456', '67175315')
+        posted = []
+
+        def post_transactions(conn, transactions):
+            transactions = list(transactions)
+            if len(posted) == 2:
+                raise HttpServerError(content='error')
+            posted.append(transactions)
+
+        mock_post_transactions.side_effect = post_transactions
+        with mock.patch('mtp_transaction_uploader.leases.logger'), mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(leases.upload_claimed_file(mock.MagicMock(), self.backend, filename, bank_account), 0)
+        self.assertIsNone(self.backend.get_completed(name))
+        self.assertEqual(self.backend.get_progress(name), 2)
+
+        mock_post_transactions.side_effect = None
+        with mock.patch('mtp_transaction_uploader.leases.logger'):
+            self.assertEqual(leases.upload_claimed_file(mock.MagicMock(), self.backend, filename, bank_account), 3)
+        # only the chunk which failed is posted again
+        self.assertEqual(len(list(mock_post_transactions.call_args[0][1])), 1)
+        self.assertEqual(mock_post_transactions.call_count, 4)
+        self.assertEqual(self.backend.get_completed(name)['net_amount'], -269874)
+        self.assertEqual(self.backend.get_progress(name), 0)
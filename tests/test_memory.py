@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import logging
+import tracemalloc
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import memory, upload
+from tests.test_upload import setup_settings
+
+
+@mock.patch('mtp_transaction_uploader.memory.settings')
+class MemoryMonitorTestCase(TestCase):
+    def setup_settings(self, mock_memory_settings):
+        mock_memory_settings.MEMORY_BUDGET_BYTES = 1000
+        mock_memory_settings.MEMORY_PRESSURE_THRESHOLD = 0.8
+
+    def test_chunks_are_smaller_under_pressure(self, mock_memory_settings):
+        self.setup_settings(mock_memory_settings)
+        monitor = memory.MemoryMonitor()
+
+        with mock.patch('mtp_transaction_uploader.memory.get_rss', return_value=700):
+            self.assertEqual(monitor.chunk_size(100), 100)
+        with mock.patch('mtp_transaction_uploader.memory.get_rss', return_value=900):
+            self.assertEqual(monitor.chunk_size(100), 25)
+            self.assertEqual(monitor.chunk_size(2), 1)
+        self.assertEqual(monitor.pressure_count, 1)
+
+    def test_only_coming_under_pressure_is_counted(self, mock_memory_settings):
+        self.setup_settings(mock_memory_settings)
+        monitor = memory.MemoryMonitor()
+
+        with mock.patch('mtp_transaction_uploader.memory.get_rss', side_effect=[900, 900, 900, 700, 900, 900]):
+            for _ in range(6):
+                monitor.under_pressure()
+
+        self.assertEqual(monitor.pressure_count, 2)
+
+    def test_no_pressure_without_budget(self, mock_memory_settings):
+        mock_memory_settings.MEMORY_BUDGET_BYTES = 0
+
+        with mock.patch('mtp_transaction_uploader.memory.get_rss', return_value=10 ** 12):
+            self.assertFalse(memory.MemoryMonitor().under_pressure())
+
+    def test_report_warns_when_budget_exceeded(self, mock_memory_settings):
+        self.setup_settings(mock_memory_settings)
+
+        with mock.patch('mtp_transaction_uploader.memory.get_peak_rss', return_value=1500), \
+                mock.patch('mtp_transaction_uploader.memory.logger') as mock_logger:
+            memory.MemoryMonitor().log_report()
+
+        self.assertEqual(mock_logger.log.call_args[0][0], logging.WARNING)
+        self.assertEqual(mock_logger.log.call_args[1]['extra']['elk_fields']['@fields.memory_budget_used'], 1.5)
+
+    def test_report_includes_traced_allocations(self, mock_memory_settings):
+        self.setup_settings(mock_memory_settings)
+        mock_memory_settings.MEMORY_TRACE_ALLOCATIONS = True
+        monitor = memory.MemoryMonitor()
+        self.addCleanup(tracemalloc.stop)
+
+        monitor.reset()
+        allocated = [str(number) for number in range(10000)]
+        with mock.patch('mtp_transaction_uploader.memory.logger') as mock_logger:
+            monitor.log_report()
+
+        message = mock_logger.info.call_args_list[0][0][0]
+        self.assertIn('Traced Python allocations', message)
+        self.assertIn('test_memory.py', message)
+        self.assertGreater(mock_logger.info.call_args_list[0][1]['extra']['elk_fields']['@fields.traced_bytes'], 0)
+        self.assertEqual(len(allocated), 10000)
+
+    def test_rss_is_measured(self, mock_memory_settings):
+        self.assertGreater(memory.get_rss(), 0)
+        self.assertGreaterEqual(memory.get_peak_rss(), memory.get_rss())
+
+
+@mock.patch('mtp_transaction_uploader.upload.memory_monitor')
+class BackPressureTestCase(TestCase):
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_statement_posted_in_smaller_chunks_under_pressure(self, mock_settings, mock_memory_monitor):
+        setup_settings(mock_settings)
+        mock_settings.UPLOAD_REQUEST_SIZE = 8
+        mock_memory_monitor.chunk_size.side_effect = [8, 2, 2]
+        statement = upload.StatementTransactions('file', date(2014, 2, 5), list(range(12)), None, None)
+
+        with mock.patch('mtp_transaction_uploader.upload.post_transactions') as mock_post_transactions, \
+                mock.patch('mtp_transaction_uploader.upload.get_fingerprint_index', return_value=None):
+            self.assertTrue(upload.post_statement(mock.MagicMock(), statement))
+
+        self.assertEqual(
+            [list(call[0][1]) for call in mock_post_transactions.call_args_list],
+            [list(range(8)), [8, 9], [10, 11]]
+        )
+
+    def test_files_parsed_one_at_a_time_under_pressure(self, mock_memory_monitor):
+        mock_memory_monitor.under_pressure.return_value = True
+        events = []
+
+        def load(value):
+            events.append('load %d' % value)
+            return value
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for value in upload.map_with_back_pressure(executor, load, range(3), max_pending=4):
+                events.append('upload %d' % value)
+
+        self.assertEqual(events, ['load 0', 'upload 0', 'load 1', 'upload 1', 'load 2', 'upload 2'])
@@ -0,0 +1,130 @@
+"""
+Micro-benchmarks for the functions run for every record, failing when one becomes slower than its budget
+
+Budgets are multiples of the time taken per item by a baseline loop of simple string operations
+so that they hold across machines. Enabled with `./run.py test --performance-tests`
+"""
+import datetime
+import itertools
+import os
+import timeit
+from unittest import mock, skipUnless, TestCase
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.benchmark import generate_records
+from mtp_transaction_uploader.patterns import ADMINISTRATIVE_IDENTIFIERS
+
+REPEAT = 5
+CORPUS_SIZE = 5000
+
+CREDIT_REFERENCES = [
+    'A1234BC 01/01/1980',
+    'a1234bc 1/1/80',
+    'A1234BC01011980',
+    '01/01/1980 A1234BC',
+    'A1234BC 31/02/1980',
+    'PAYMENT REFUND',
+    'INVOICE 12345678',
+    '',
+]
+SETTLEMENT_DESCRIPTIONS = [
+    'TT- GGGGGGGG -0502',
+    'TT- GGGGGGGG -05',
+    'TT- GGGGGGGG -',
+    'TT- GGGGGGGG -3102',
+    'NORTHERN DIY   E',
+]
+FILENAMES = [
+    'Y01A.CARS.#D.444444.D050214',
+    'Y01A.CARS.#D.444444.D311219',
+    'Y01A.CARS.#D.555555.D050214',
+    'Y01A.CARS.#D.444444.D050214.tmp',
+    'README',
+]
+
+
+def make_corpus(values):
+    return list(itertools.islice(itertools.cycle(values), CORPUS_SIZE))
+
+
+def time_per_item(func, corpus):
+    return min(timeit.repeat(lambda: func(corpus), number=1, repeat=REPEAT)) / len(corpus)
+
+
+def baseline(corpus):
+    for value in corpus:
+        value.strip().upper().split(' ')
+
+
+@skipUnless('RUN_PERFORMANCE_TESTS' in os.environ, 'performance tests are disabled')
+@mock.patch.multiple(settings, MARK_TRANSACTIONS_AS_UNIDENTIFIED=False)
+class PerformanceTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.baseline_time = time_per_item(baseline, make_corpus(CREDIT_REFERENCES))
+        cls.records = generate_records(CORPUS_SIZE, date=datetime.date(2014, 2, 5))
+
+    def assertWithinBudget(self, func, corpus, budget):
+        relative_time = time_per_item(func, corpus) / self.baseline_time
+        self.assertLessEqual(
+            relative_time, budget,
+            '%s took %.1f times as long as the baseline per item, its budget is %.1f' % (
+                func.__name__, relative_time, budget
+            )
+        )
+
+    def test_parse_credit_reference(self):
+        def parse_credit_references(references):
+            for reference in references:
+                upload.parse_credit_reference(reference)
+
+        self.assertWithinBudget(parse_credit_references, make_corpus(CREDIT_REFERENCES), 120)
+
+    def test_extract_sender_information(self):
+        def extract_sender_information(records):
+            for record in records:
+                upload.extract_sender_information(record)
+
+        self.assertWithinBudget(extract_sender_information, self.records, 50)
+
+    def test_payment_identifier_matches(self):
+        fields = [
+            (record.originators_account_number, record.originators_sort_code,
+             record.transaction_description, record.reference_number)
+            for record in self.records
+        ]
+
+        def match_identifiers(corpus):
+            for account_number, sort_code, sender_name, reference in corpus:
+                for identifier in ADMINISTRATIVE_IDENTIFIERS:
+                    identifier.matches(account_number, sort_code, sender_name, reference)
+
+        self.assertWithinBudget(match_identifiers, fields, 15)
+
+    def test_parse_settlement_date(self):
+        relative_date = datetime.date(2014, 2, 5)
+
+        def parse_settlement_dates(descriptions):
+            for description in descriptions:
+                upload.parse_settlement_date(description, relative_date)
+
+        self.assertWithinBudget(parse_settlement_dates, make_corpus(SETTLEMENT_DESCRIPTIONS), 75)
+
+    def test_clean_request_data(self):
+        transactions = [upload.get_transaction_from_record(record) for record in self.records]
+        chunks = [transactions[i:i + 100] for i in range(0, len(transactions), 100)]
+
+        def clean_request_data(corpus):
+            for chunk in corpus:
+                upload.clean_request_data(chunk)
+
+        # timed per chunk of 100 transactions
+        self.assertWithinBudget(clean_request_data, chunks, 10000)
+
+    def test_parse_filename(self):
+        def parse_filenames(filenames):
+            for filename in filenames:
+                upload.parse_filename(filename, '444444')
+
+        self.assertWithinBudget(parse_filenames, make_corpus(FILENAMES), 100)
@@ -0,0 +1,45 @@
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader.sftp import SFTPConnection
+
+
+@mock.patch('paramiko.SFTPClient.from_transport')
+@mock.patch('paramiko.PKey.from_path')
+@mock.patch('paramiko.Transport')
+class SFTPConnectionTestCase(TestCase):
+    def test_sftp_channel_opened_with_tuned_sizes(self, mock_transport_class, mock_from_path, mock_from_transport):
+        with SFTPConnection('sftp.local', username='mtp', private_key='/keys/id_rsa', compression=True,
+                            window_size=8388608, max_packet_size=None) as conn:
+            pass
+
+        mock_transport_class.assert_called_once_with(('sftp.local', 22))
+        transport = mock_transport_class.return_value
+        transport.use_compression.assert_called_once_with(True)
+        mock_from_path.assert_called_once_with('/keys/id_rsa')
+        transport.connect.assert_called_once_with(username='mtp', pkey=mock_from_path.return_value)
+        mock_from_transport.assert_called_once_with(transport, window_size=8388608, max_packet_size=None)
+        self.assertIs(conn.sftp_client, mock_from_transport.return_value)
+        conn.sftp_client.close.assert_called_once_with()
+        transport.close.assert_called_once_with()
+
+    def test_transport_closed_if_authentication_fails(
+        self, mock_transport_class, mock_from_path, mock_from_transport
+    ):
+        mock_transport_class.return_value.connect.side_effect = EOFError
+
+        with self.assertRaises(EOFError):
+            SFTPConnection('sftp.local', username='mtp', private_key='/keys/id_rsa')
+
+        mock_transport_class.return_value.close.assert_called_once_with()
+        self.assertFalse(mock_from_transport.called)
+
+    def test_cd_restores_previous_directory(self, mock_transport_class, mock_from_path, mock_from_transport):
+        conn = SFTPConnection('sftp.local', username='mtp', private_key='/keys/id_rsa')
+        sftp_client = mock_from_transport.return_value
+        sftp_client.getcwd.return_value = None
+
+        with conn.cd('/statements'):
+            conn.listdir()
+
+        self.assertEqual(sftp_client.chdir.call_args_list, [mock.call('/statements'), mock.call(None)])
+        sftp_client.listdir.assert_called_once_with('.')
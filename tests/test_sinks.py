@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import api_client, upload
+from mtp_transaction_uploader.sinks import get_sink, NDJSONFileSink, NullSink, SinkConnection
+from tests.test_upload import setup_settings
+
+
+class SinkConnectionTestCase(TestCase):
+    def test_posts_go_to_sink_and_reads_to_api(self):
+        conn = mock.MagicMock()
+        conn.balances.get.return_value = {'results': []}
+        sink = NullSink()
+        sink_conn = SinkConnection(conn, sink)
+
+        self.assertEqual(sink_conn.balances.get(limit=1), {'results': []})
+        sink_conn.transactions.post([{'amount': 1}, {'amount': 2}])
+        sink_conn.balances.post({'date': '2014-02-05', 'closing_balance': 100})
+
+        self.assertFalse(conn.transactions.post.called)
+        self.assertFalse(conn.balances.post.called)
+        self.assertEqual(sink.record_counts, {'transactions': 2, 'balances': 1})
+
+    def test_ndjson_file_sink(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        sink = NDJSONFileSink(os.path.join(path, 'output.ndjson'))
+
+        sink.post('transactions', [{'amount': 1}, {'amount': 2}])
+        sink.post('balances', {'date': '2014-02-05', 'closing_balance': 100})
+        with mock.patch('mtp_transaction_uploader.sinks.logger'):
+            sink.close()
+
+        with open(os.path.join(path, 'output.ndjson')) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines, [
+            {'resource': 'transactions', 'data': {'amount': 1}},
+            {'resource': 'transactions', 'data': {'amount': 2}},
+            {'resource': 'balances', 'data': {'date': '2014-02-05', 'closing_balance': 100}},
+        ])
+
+    def test_api_sink_is_not_wrapped(self):
+        self.assertIsNone(get_sink('api'))
+        self.assertIsInstance(get_sink('noop'), NullSink)
+        with self.assertRaises(ValueError):
+            get_sink('ndjson')
+
+    @mock.patch('mtp_transaction_uploader.api_client.create_authenticated_connection')
+    def test_set_sink_wraps_authenticated_connections(self, mock_create_connection):
+        sink = NullSink()
+        api_client.set_sink(sink)
+        self.addCleanup(api_client.set_sink, None)
+
+        conn = api_client.get_authenticated_connection()
+        self.assertIsInstance(conn, SinkConnection)
+        self.assertIs(conn.conn, mock_create_connection())
+
+        api_client.set_sink(None)
+        self.assertIs(api_client.get_authenticated_connection(), mock_create_connection())
+
+
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class DryRunTestCase(TestCase):
+    def test_dry_run_sends_transactions_and_balances_to_sink(self, mock_settings, mock_get_conn):
+        setup_settings(mock_settings)
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.UPLOAD_REQUEST_SIZE = 2
+        mock_settings.PARSE_WORKERS = 1
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_settings.PACK_UPLOAD_CHUNKS = False
+        mock_settings.STREAM_UPLOADS = True
+        mock_settings.CHAIN_BALANCES = False
+        mock_settings.USE_FILE_BALANCES = False
+        conn = mock.MagicMock()
+        conn.balances.get.return_value = {'results': [{'closing_balance': 1000}]}
+        sink = NullSink()
+        mock_get_conn.return_value = SinkConnection(conn, sink)
+
+        transaction_count = upload.upload_transactions_from_files(['tests/data/Y01A.CARS.#D.444444.D050214'])
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(sink.record_counts, {'transactions': 3, 'balances': 1})
+        self.assertFalse(conn.transactions.post.called)
+        self.assertFalse(conn.balances.post.called)
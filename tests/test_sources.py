@@ -0,0 +1,133 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import sources
+from mtp_transaction_uploader.daemon import UploaderDaemon
+
+
+@mock.patch('mtp_transaction_uploader.sources.settings')
+class LocalDirectoryStatementSourceTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def write_file(self, filename, age=60):
+        path = os.path.join(self.path, filename)
+        with open(path, 'w') as f:
+            f.write('contents')
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_returns_settled_files_in_place_and_in_date_order(self, mock_settings):
+        mock_settings.ACCOUNT_CODE = '444444'
+        path_2 = self.write_file('Y01A.CARS.#D.444444.D131214')
+        path_1 = self.write_file('Y01A.CARS.#D.444444.D121214')
+        self.write_file('Y01A.CARS.#D.444444.D111214')
+        self.write_file('Y01A.CARS.#D.555555.D131214')
+        self.write_file('notes.txt')
+
+        source = sources.LocalDirectoryStatementSource(self.path, settle_seconds=5)
+        new_dates, new_filenames = source.retrieve_new_files(date(2014, 12, 11))
+
+        self.assertFalse(source.downloads_files)
+        self.assertEqual(new_dates, [date(2014, 12, 12), date(2014, 12, 13)])
+        self.assertEqual(new_filenames, [path_1, path_2])
+        self.assertFalse(source.has_unsettled_files)
+
+    def test_waits_for_files_still_being_written(self, mock_settings):
+        mock_settings.ACCOUNT_CODE = '444444'
+        path_1 = self.write_file('Y01A.CARS.#D.444444.D121214')
+        self.write_file('Y01A.CARS.#D.444444.D131214', age=0)
+        self.write_file('Y01A.CARS.#D.444444.D141214')
+
+        source = sources.LocalDirectoryStatementSource(self.path, settle_seconds=5)
+        new_dates, new_filenames = source.retrieve_new_files(None)
+
+        # the later settled file waits for the unsettled one so that files are uploaded in date order
+        self.assertEqual(new_dates, [date(2014, 12, 12)])
+        self.assertEqual(new_filenames, [path_1])
+        self.assertTrue(source.has_unsettled_files)
+
+    @mock.patch('mtp_transaction_uploader.sources.LocalDirectoryStatementSource.start_observer', return_value=False)
+    def test_polling_detects_new_files(self, mock_start_observer, mock_settings):
+        mock_settings.LOCAL_STATEMENT_POLL_INTERVAL = 0.01
+        source = sources.LocalDirectoryStatementSource(self.path, settle_seconds=5)
+        stop_event = threading.Event()
+        source.wait_for_changes(0.02, stop_event)
+
+        timer = threading.Timer(0.05, self.write_file, args=('Y01A.CARS.#D.444444.D121214',))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        source.wait_for_changes(10, stop_event)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIn('Y01A.CARS.#D.444444.D121214', source.snapshot)
+
+    def test_wait_ends_when_stopped(self, mock_settings):
+        mock_settings.LOCAL_STATEMENT_POLL_INTERVAL = 0.01
+        source = sources.LocalDirectoryStatementSource(self.path, settle_seconds=5)
+        stop_event = threading.Event()
+        stop_event.set()
+
+        start = time.monotonic()
+        source.wait_for_changes(10, stop_event)
+        source.close()
+
+        self.assertLess(time.monotonic() - start, 5)
+
+
+@mock.patch('mtp_transaction_uploader.sources.settings')
+class GetStatementSourceTestCase(TestCase):
+    def test_chooses_source_from_settings(self, mock_settings):
+        mock_settings.STATEMENT_SOURCE = 'sftp'
+        self.assertIsInstance(sources.get_statement_source(), sources.SFTPStatementSource)
+        mock_settings.STATEMENT_SOURCE = 'local'
+        mock_settings.LOCAL_STATEMENT_DIR = '/tmp'
+        self.assertIsInstance(sources.get_statement_source(), sources.LocalDirectoryStatementSource)
+        mock_settings.STATEMENT_SOURCE = 'ftp'
+        with self.assertRaises(ValueError):
+            sources.get_statement_source()
+
+
+@mock.patch('mtp_transaction_uploader.daemon.api_client')
+@mock.patch('mtp_transaction_uploader.daemon.upload')
+@mock.patch('mtp_transaction_uploader.daemon.signal.signal')
+class LocalDirectoryNotificationTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_created_file_triggers_upload(self, mock_signal, mock_upload, mock_api_client):
+        source = sources.LocalDirectoryStatementSource(self.path, settle_seconds=0)
+        daemon = UploaderDaemon(poll_interval=60, poll_jitter=0, source=source)
+        uploaded_files = []
+
+        def main(source, should_stop):
+            uploaded_files.append(source.retrieve_new_files(None).new_filenames)
+            if len(uploaded_files) == 1:
+                # written once the daemon is waiting for changes
+                threading.Timer(0.5, self.write_statement).start()
+            else:
+                daemon.stop()
+
+        mock_upload.main.side_effect = main
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        self.addCleanup(daemon.stop)
+        with mock.patch('mtp_transaction_uploader.daemon.logger'):
+            thread.start()
+            thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(source.snapshot, 'changes should be detected with notifications rather than polling')
+        self.assertEqual(uploaded_files, [[], [os.path.join(self.path, 'Y01A.CARS.#D.444444.D121214')]])
+
+    def write_statement(self):
+        with open(os.path.join(self.path, 'Y01A.CARS.#D.444444.D121214'), 'w') as f:
+            f.write('contents')
@@ -0,0 +1,27 @@
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader.timings import StageTimings
+
+
+@mock.patch('mtp_transaction_uploader.timings.time')
+class StageTimingsTestCase(TestCase):
+    def test_measures_stages_and_records(self, mock_time):
+        mock_time.perf_counter.side_effect = [0, 2, 10, 11, 20, 23, 30, 30.5]
+        timings = StageTimings()
+
+        with timings.measure('upload', 100):
+            pass
+        items = list(timings.measure_iterator('transform', [[1, 2], [3]]))
+
+        self.assertEqual(items, [[1, 2], [3]])
+        self.assertEqual(timings.durations, {'upload': 2, 'transform': 4.5})
+        self.assertEqual(timings.record_counts, {'upload': 100, 'transform': 3})
+
+        with mock.patch('mtp_transaction_uploader.timings.logger') as mock_logger:
+            timings.log_report()
+        self.assertEqual(
+            mock_logger.info.call_args_list[0][0][0], 'Stage upload took 2.000s for 100 records (50 records/s)'
+        )
+
+        timings.reset()
+        self.assertEqual(timings.durations, {})
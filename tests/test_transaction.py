@@ -0,0 +1,68 @@
+import datetime
+import pickle
+from unittest import TestCase
+
+from mtp_transaction_uploader.transaction import format_received_at, Transaction
+
+
+class TransactionTestCase(TestCase):
+    def make_transaction(self):
+        return Transaction(
+            amount=100,
+            category='credit',
+            source='bank_transfer',
+            sender_sort_code='608006',
+            sender_roll_number=None,
+            received_at='2004-02-05T12:00:00+00:00',
+        )
+
+    def test_dict_style_access(self):
+        transaction = self.make_transaction()
+
+        self.assertEqual(transaction['amount'], 100)
+        self.assertIsNone(transaction['sender_roll_number'])
+        self.assertIsNone(transaction.get('prisoner_number'))
+        self.assertEqual(transaction.get('prisoner_number', 'missing'), 'missing')
+        self.assertIn('sender_roll_number', transaction)
+        self.assertNotIn('prisoner_number', transaction)
+        with self.assertRaises(KeyError):
+            transaction['prisoner_number']
+
+        transaction['prisoner_number'] = 'A1234BY'
+        self.assertEqual(transaction['prisoner_number'], 'A1234BY')
+
+    def test_unknown_fields_rejected(self):
+        transaction = self.make_transaction()
+
+        with self.assertRaises(KeyError):
+            transaction['unknown'] = 1
+        with self.assertRaises(KeyError):
+            transaction['__class__']
+        self.assertIsNone(transaction.get('__class__'))
+
+    def test_request_data_omits_empty_fields(self):
+        self.assertEqual(self.make_transaction().to_request_data(), {
+            'amount': 100,
+            'category': 'credit',
+            'source': 'bank_transfer',
+            'sender_sort_code': '608006',
+            'received_at': '2004-02-05T12:00:00+00:00',
+        })
+
+    def test_equality_with_dicts(self):
+        transaction = self.make_transaction()
+
+        self.assertEqual(transaction, self.make_transaction())
+        self.assertEqual(transaction, transaction.as_dict())
+        self.assertNotEqual(transaction, transaction.to_request_data())
+
+    def test_pickling(self):
+        transaction = self.make_transaction()
+
+        self.assertEqual(pickle.loads(pickle.dumps(transaction)), transaction)
+
+    def test_received_at_shared_between_transactions(self):
+        received_at = format_received_at(datetime.datetime(2004, 2, 5))
+
+        self.assertEqual(received_at, '2004-02-05T12:00:00+00:00')
+        self.assertIs(format_received_at(datetime.datetime(2004, 2, 5)), received_at)
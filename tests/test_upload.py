@@ -1,10 +1,16 @@
 from datetime import date
+import json
+import os
+import shutil
+import tempfile
+import threading
 from unittest import mock, TestCase
 
 from bankline_parser.data_services import parse
 from bankline_parser.data_services.models import DataRecord
+from slumber.exceptions import HttpClientError
 
-from mtp_transaction_uploader import upload
+from mtp_transaction_uploader import upload, workers
 
 
 class CreditReferenceParsingTestCase(TestCase):
@@ -175,7 +181,7 @@ class FilenameParsingTestCase(TestCase):
 
 
 @mock.patch('mtp_transaction_uploader.upload.settings')
-@mock.patch('mtp_transaction_uploader.upload.Connection')
+@mock.patch('mtp_transaction_uploader.upload.SFTPConnection')
 class FileDownloadTestCase(TestCase):
 
     def _download_new_files(self, mock_connection_class, mock_settings, dirlist, last_date):
@@ -187,9 +193,106 @@ class FileDownloadTestCase(TestCase):
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = False
 
         return upload.download_new_files(last_date)
 
+    def test_download_new_files_with_open_connection(self, mock_connection_class, mock_settings):
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = False
+        sftp_conn = mock.MagicMock()
+        sftp_conn.listdir.return_value = ['Y01A.CARS.#D.444444.D091214']
+        sftp_conn.stat.return_value = type('', (), {'st_size': 1000})()
+        mock_connection_class.reset_mock()
+
+        new_dates, new_filenames = upload.download_new_files(None, sftp_conn=sftp_conn)
+
+        self.assertEqual(new_filenames, ['/Y01A.CARS.#D.444444.D091214'])
+        self.assertFalse(mock_connection_class.called)
+        self.assertFalse(sftp_conn.close.called)
+
+    def test_download_into_memory_spills_large_files(self, mock_connection_class, mock_settings):
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = True
+        mock_settings.DOWNLOAD_MEMORY_LIMIT_BYTES = 2500
+        mock_settings.DOWNLOAD_SPILL_BYTES = 1500
+        sizes = {
+            'Y01A.CARS.#D.444444.D091214': 1000,
+            'Y01A.CARS.#D.444444.D101214': 2000,
+            'Y01A.CARS.#D.444444.D111214': 1000,
+            'Y01A.CARS.#D.444444.D121214': 1000,
+        }
+        sftp_conn = mock.MagicMock()
+        sftp_conn.listdir.return_value = list(sizes)
+        sftp_conn.stat.side_effect = lambda filename: type('', (), {'st_size': sizes[filename]})()
+        sftp_conn.sftp_client.getfo.side_effect = lambda filename, buffer, **kwargs: buffer.write(b'data')
+
+        new_dates, new_filenames = upload.download_new_files(None, sftp_conn=sftp_conn)
+
+        self.assertEqual(new_filenames, [
+            '/Y01A.CARS.#D.444444.D091214',
+            '/Y01A.CARS.#D.444444.D101214',
+            '/Y01A.CARS.#D.444444.D111214',
+            '/Y01A.CARS.#D.444444.D121214',
+        ])
+        # the second file is above the spill threshold and the last would exceed the memory limit
+        self.assertEqual(
+            [isinstance(filename, upload.DownloadedFile) for filename in new_filenames],
+            [True, False, True, False]
+        )
+        self.assertEqual(new_filenames[0].content, b'data')
+        self.assertEqual(sftp_conn.sftp_client.get.call_count, 2)
+
+    def test_download_to_disk_under_memory_pressure(self, mock_connection_class, mock_settings):
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = True
+        mock_settings.DOWNLOAD_MEMORY_LIMIT_BYTES = 2500
+        mock_settings.DOWNLOAD_SPILL_BYTES = 1500
+        filenames = ['Y01A.CARS.#D.444444.D091214', 'Y01A.CARS.#D.444444.D101214', 'Y01A.CARS.#D.444444.D111214']
+        sftp_conn = mock.MagicMock()
+        sftp_conn.listdir.return_value = filenames
+        sftp_conn.stat.return_value = type('', (), {'st_size': 500})()
+        sftp_conn.sftp_client.getfo.side_effect = lambda filename, buffer, **kwargs: buffer.write(b'data')
+
+        with mock.patch('mtp_transaction_uploader.upload.memory_monitor') as mock_memory_monitor:
+            mock_memory_monitor.under_pressure.side_effect = [False, True, False]
+            new_dates, new_filenames = upload.download_new_files(None, sftp_conn=sftp_conn)
+
+        self.assertEqual(
+            [isinstance(filename, upload.DownloadedFile) for filename in new_filenames],
+            [True, False, True]
+        )
+
+    def test_download_uses_transfer_settings(self, mock_connection_class, mock_settings):
+        mock_settings.SFTP_PREFETCH = False
+        mock_settings.SFTP_MAX_PREFETCH_REQUESTS = 0
+        self._download_new_files(mock_connection_class, mock_settings, ['Y01A.CARS.#D.444444.D091214'], None)
+
+        mock_connection_class().__enter__().sftp_client.get.assert_called_once_with(
+            'Y01A.CARS.#D.444444.D091214', '/Y01A.CARS.#D.444444.D091214',
+            prefetch=False, max_concurrent_prefetch_requests=None,
+        )
+
+    def test_open_connection_with_tuned_transport(self, mock_connection_class, mock_settings):
+        mock_settings.SFTP_HOST = 'sftp.local'
+        mock_settings.SFTP_USER = 'mtp'
+        mock_settings.SFTP_PRIVATE_KEY = '~/.ssh/id_rsa'
+        mock_settings.SFTP_COMPRESSION = True
+        mock_settings.SFTP_WINDOW_SIZE = 8388608
+        mock_settings.SFTP_MAX_PACKET_SIZE = 0
+        mock_connection_class.reset_mock()
+
+        conn = upload.open_sftp_connection()
+
+        self.assertIs(conn, mock_connection_class.return_value)
+        mock_connection_class.assert_called_once_with(
+            'sftp.local', username='mtp', private_key='~/.ssh/id_rsa', compression=True,
+            window_size=8388608, max_packet_size=None,
+        )
+
     def test_download_new_files(self, mock_connection_class, mock_settings):
         dirlist = [
             'Y01A.CARS.#D.444444.D091214',
@@ -334,6 +437,7 @@ class FileDownloadTestCase(TestCase):
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = False
 
         new_dates, new_filenames = upload.download_new_files(None)
 
@@ -355,7 +459,7 @@ class FileDownloadTestCase(TestCase):
 
 class RetrieveNewFilesTestCase(TestCase):
 
-    @mock.patch('mtp_transaction_uploader.upload.Connection')
+    @mock.patch('mtp_transaction_uploader.upload.SFTPConnection')
     @mock.patch('mtp_transaction_uploader.upload.settings')
     @mock.patch('mtp_transaction_uploader.upload.os')
     @mock.patch('mtp_transaction_uploader.upload.shutil')
@@ -389,6 +493,7 @@ class RetrieveNewFilesTestCase(TestCase):
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = False
         mock_os.path.join = lambda a, b: a + b
 
         new_last_date, new_filenames = upload.retrieve_data_services_files()
@@ -402,7 +507,7 @@ class RetrieveNewFilesTestCase(TestCase):
         ], new_filenames)
         self.assertEqual(date(2014, 12, 14), new_last_date)
 
-    @mock.patch('mtp_transaction_uploader.upload.Connection')
+    @mock.patch('mtp_transaction_uploader.upload.SFTPConnection')
     @mock.patch('mtp_transaction_uploader.upload.settings')
     @mock.patch('mtp_transaction_uploader.upload.os')
     @mock.patch('mtp_transaction_uploader.upload.shutil')
@@ -429,6 +534,7 @@ class RetrieveNewFilesTestCase(TestCase):
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.DOWNLOAD_TO_MEMORY = False
         mock_os.path.join = lambda a, b: a + b
 
         new_last_date, new_filenames = upload.retrieve_data_services_files()
@@ -443,6 +549,9 @@ def setup_settings(mock_settings, mark_transactions_as_unidentified=False):
     mock_settings.NOMS_AGENCY_ACCOUNT_NUMBER = '67175315'
     mock_settings.NOMS_AGENCY_SORT_CODE = '123456'
     mock_settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED = mark_transactions_as_unidentified
+    mock_settings.PARSE_WORKERS = 1
+    mock_settings.CLASSIFY_WORKERS = 1
+    mock_settings.CLASSIFY_SHARD_SIZE = 5000
 
 
 class TransactionsFromFileTestCase(TestCase):
@@ -718,6 +827,29 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[2]['blocked'], False)
         self.assertEqual(transactions[2]['incomplete_sender_info'], False)
 
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_sharded_classification_matches_serial(self, mock_settings):
+        setup_settings(mock_settings)
+        with open('tests/data/testfile_roll_number') as f:
+            lines = f.readlines()
+        data_services_file = parse(lines)
+        serial_transactions = upload.get_transactions_from_file(data_services_file, lines=lines)
+
+        mock_settings.CLASSIFY_WORKERS = 2
+        mock_settings.CLASSIFY_SHARD_SIZE = 2
+        with workers.run_worker_pool(2) as worker_pool:
+            with mock.patch.object(worker_pool, 'map', wraps=worker_pool.map) as mock_map:
+                sharded_transactions = upload.get_transactions_from_file(data_services_file, lines=lines)
+
+        # workers are sent the records' lines
+        shards = list(mock_map.call_args[0][1])
+        self.assertTrue(all(isinstance(line, str) for shard in shards for line in shard))
+        self.assertEqual(len(sharded_transactions), 7)
+        self.assertEqual(
+            json.dumps(upload.clean_request_data(sharded_transactions)),
+            json.dumps(upload.clean_request_data(serial_transactions)),
+        )
+
     @mock.patch('mtp_transaction_uploader.upload.logger')
     def test_get_transactions_no_records(self, mock_logger):
         with open('tests/data/testfile_no_records') as f:
@@ -768,6 +900,101 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[1]['received_at'], '2004-02-07T12:00:00+00:00')
 
 
+class ClosingBalanceFromFileTestCase(TestCase):
+    def test_closing_balance_from_file(self):
+        with open('tests/data/testfile_1') as f:
+            data_services_file = parse(f)
+
+        self.assertEqual(upload.get_closing_balance_from_file(data_services_file), 38510000)
+
+    def test_no_closing_balance_in_file(self):
+        with open('tests/data/testfile_roll_number') as f:
+            data_services_file = parse(f)
+
+        self.assertIsNone(upload.get_closing_balance_from_file(data_services_file))
+
+
+class FilterAccountSectionsTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open('tests/data/testfile_1') as f:
+            self.lines = f.readlines()
+        # the same account section with records for another account
+        self.other_account_lines = [
+            line[:6] + '99887766' + line[14:] if line.startswith('12345667175315') else line
+            for line in self.lines[1:]
+        ]
+        self.bank_account = upload.BankAccount('444444', '123456', '67175315')
+
+    def test_accounts_with_records_kept(self):
+        lines = upload.filter_account_sections(self.lines, self.bank_account)
+
+        self.assertEqual(lines, self.lines)
+
+    def test_accounts_without_records_skipped(self):
+        lines = upload.filter_account_sections(
+            self.lines[:1] + self.other_account_lines + self.lines[1:] + self.other_account_lines,
+            self.bank_account,
+        )
+
+        self.assertEqual(lines, self.lines)
+        self.assertEqual(len(parse(lines).accounts), 1)
+
+    def test_nothing_returned_without_records(self):
+        lines = upload.filter_account_sections(self.lines[:1] + self.other_account_lines, self.bank_account)
+
+        self.assertEqual(lines, [])
+
+    def test_accounts_without_records_not_matching_trailer_kept(self):
+        invalid_account_lines = self.other_account_lines[:-1] + [
+            self.other_account_lines[-1][:4] + '9' + self.other_account_lines[-1][5:]
+        ]
+        lines = self.lines[:1] + invalid_account_lines + self.lines[1:]
+
+        self.assertEqual(upload.filter_account_sections(lines, self.bank_account), lines)
+        self.assertEqual(upload.filter_account_sections(
+            self.lines[:1] + invalid_account_lines, self.bank_account
+        ), self.lines[:1] + invalid_account_lines)
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_load_statement_rejects_file_with_invalid_account_without_records(self, mock_settings, mock_logger):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+        with open('tests/data/testfile_incorrect_totals') as f:
+            invalid_lines = f.readlines()
+        self.assertTrue(any(line.startswith('12345667175315') for line in invalid_lines))
+        invalid_account_lines = [
+            line[:6] + '99887766' + line[14:] if line.startswith('12345667175315') else line
+            for line in invalid_lines[1:]
+        ]
+        path = os.path.join(tempfile.mkdtemp(), 'Y01A.CARS.#D.444444.D050214')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.writelines(self.lines + invalid_account_lines)
+
+        self.assertIsNone(upload.load_statement(path, bank_account=self.bank_account))
+        self.assertTrue(mock_logger.error.call_args[0][0].startswith('Errors: '))
+
+    def test_incomplete_account_kept(self):
+        lines = upload.filter_account_sections(self.other_account_lines[:-1], self.bank_account)
+
+        self.assertEqual(lines, self.other_account_lines[:-1])
+
+    @mock.patch('mtp_transaction_uploader.upload.parse')
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_load_statement_does_not_parse_files_without_records(self, mock_settings, mock_parse):
+        setup_settings(mock_settings)
+        mock_settings.COLUMNAR_RECORDS = False
+
+        statement = upload.load_statement(
+            'tests/data/testfile_1', bank_account=upload.BankAccount('444444', '123456', '99887766'),
+        )
+
+        self.assertIsNone(statement)
+        mock_parse.assert_not_called()
+
+
 @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
 class UpdateNewBalanceTestCase(TestCase):
 
@@ -815,6 +1042,414 @@ class UpdateNewBalanceTestCase(TestCase):
             'closing_balance': 330,
         })
 
+    def test_update_new_balance_for_other_account_uses_its_own_store(self, mock_get_connection):
+        bank_account = upload.BankAccount('555555', '123456', '87654321')
+        conn = mock_get_connection()
+        account_balance_store = mock.MagicMock()
+        account_balance_store.get.return_value = {
+            'count': 1,
+            'results': [{'closing_balance': 1000}]
+        }
+
+        with mock.patch.object(upload.settings, 'ACCOUNT_CODE', '444444'), \
+                mock.patch('mtp_transaction_uploader.upload.get_account_balance_store',
+                           return_value=account_balance_store) as mock_get_store:
+            upload.update_new_balance([], date(2016, 3, 3), net_amount=100, bank_account=bank_account)
+
+        mock_get_store.assert_called_with('555555')
+        account_balance_store.get.assert_called_with(limit=1, date__lt='2016-03-03')
+        account_balance_store.post.assert_called_with({
+            'date': '2016-03-03',
+            'closing_balance': 1100,
+        })
+        self.assertFalse(conn.balances.get.called)
+        self.assertFalse(conn.balances.post.called)
+
+    def test_update_new_balance_with_known_previous_balance(self, mock_get_connection):
+        transactions = [
+            {'amount': 100, 'category': 'credit'},
+            {'amount': 120, 'category': 'debit'},
+        ]
+        stmt_date = date(2016, 3, 3)
+
+        conn = mock_get_connection()
+        balance = upload.update_new_balance(transactions, stmt_date, file_balance=980, previous_balance=1000)
+
+        self.assertEqual(balance, 980)
+        self.assertFalse(conn.balances.get.called)
+        conn.balances.post.assert_called_with({
+            'date': stmt_date.isoformat(),
+            'closing_balance': 980,
+        })
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    def test_update_new_balance_reports_mismatched_file_balance(self, mock_logger, mock_get_connection):
+        transactions = [
+            {'amount': 100, 'category': 'credit'},
+        ]
+        stmt_date = date(2016, 3, 3)
+
+        conn = mock_get_connection()
+        conn.balances.get.return_value = {
+            'count': 1,
+            'results': [{'closing_balance': 1000}]
+        }
+
+        balance = upload.update_new_balance(transactions, stmt_date, file_balance=1200)
+
+        self.assertEqual(balance, 1100)
+        mock_logger.error.assert_called_with(
+            'Closing balance in file for 2016-03-03 (1200) does not match calculated balance (1100)'
+        )
+        conn.balances.post.assert_called_with({
+            'date': stmt_date.isoformat(),
+            'closing_balance': 1100,
+        })
+
+    def test_update_new_balances_rolls_forward_from_single_lookup(self, mock_get_connection):
+        statements = [
+            upload.StatementTransactions('statement', date(2016, 3, 4), [
+                {'amount': 50, 'category': 'debit'},
+            ], None, None),
+            upload.StatementTransactions('statement', date(2016, 3, 3), [
+                {'amount': 100, 'category': 'credit'},
+                {'amount': 120, 'category': 'debit'},
+            ], None, None),
+            upload.StatementTransactions('statement', date(2016, 3, 5), [
+                {'amount': 200, 'category': 'credit'},
+            ], None, None),
+        ]
+
+        conn = mock_get_connection()
+        conn.balances.get.side_effect = [
+            {'count': 1, 'results': [{'closing_balance': 1000}]},
+            {'count': 1, 'results': [{'closing_balance': 1130}]},
+        ]
+
+        closing_balance = upload.update_new_balances(statements)
+
+        self.assertEqual(closing_balance, 1130)
+        self.assertEqual(conn.balances.get.call_args_list, [
+            mock.call(limit=1, date__lt='2016-03-03'),
+            mock.call(limit=1, date__lt='2016-03-06'),
+        ])
+        self.assertEqual(conn.balances.post.call_args_list, [
+            mock.call({'date': '2016-03-03', 'closing_balance': 980}),
+            mock.call({'date': '2016-03-04', 'closing_balance': 930}),
+            mock.call({'date': '2016-03-05', 'closing_balance': 1130}),
+        ])
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    def test_update_new_balances_reports_mismatched_stored_balance(self, mock_logger, mock_get_connection):
+        statements = [
+            upload.StatementTransactions('statement', date(2016, 3, 3), [
+                {'amount': 100, 'category': 'credit'},
+            ], None, None),
+        ]
+
+        conn = mock_get_connection()
+        conn.balances.get.side_effect = [
+            {'count': 0, 'results': []},
+            {'count': 1, 'results': [{'closing_balance': 90}]},
+        ]
+
+        upload.update_new_balances(statements)
+
+        mock_logger.error.assert_called_with(
+            'Stored closing balance for 2016-03-03 (90) does not match calculated balance (100)'
+        )
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    def test_update_new_balances_skips_stored_balance_check_in_dry_run(self, mock_logger, mock_get_connection):
+        statements = [
+            upload.StatementTransactions('statement', date(2016, 3, 3), [
+                {'amount': 100, 'category': 'credit'},
+            ], None, None),
+        ]
+
+        conn = mock_get_connection()
+        conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 90}]}
+
+        with mock.patch('mtp_transaction_uploader.upload.is_dry_run', return_value=True):
+            upload.update_new_balances(statements)
+
+        conn.balances.get.assert_called_once_with(limit=1, date__lt='2016-03-03')
+        self.assertFalse(mock_logger.error.called)
+
+
+@mock.patch('mtp_transaction_uploader.upload.update_new_balance')
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.upload.settings')
+class UploadTransactionsFromFilesTestCase(TestCase):
+    files = [
+        'tests/data/Y01A.CARS.#D.444444.D050214',
+        'tests/data/Y01A.CARS.#D.444444.D050214',
+    ]
+
+    def _setup_settings(self, mock_settings, **kwargs):
+        setup_settings(mock_settings)
+        mock_settings.ACCOUNT_CODE = '444444'
+        mock_settings.UPLOAD_REQUEST_SIZE = 2
+        mock_settings.PARSE_WORKERS = 1
+        mock_settings.COLUMNAR_RECORDS = False
+        mock_settings.PACK_UPLOAD_CHUNKS = False
+        mock_settings.STREAM_UPLOADS = False
+        mock_settings.CHAIN_BALANCES = False
+        mock_settings.USE_FILE_BALANCES = False
+        for key, value in kwargs.items():
+            setattr(mock_settings, key, value)
+
+    def test_upload_updates_balance_per_file(self, mock_settings, mock_get_conn, mock_update_new_balance):
+        self._setup_settings(mock_settings)
+
+        transaction_count = upload.upload_transactions_from_files(self.files)
+
+        self.assertEqual(transaction_count, 6)
+        self.assertEqual(mock_get_conn().transactions.post.call_count, 4)
+        self.assertEqual(mock_update_new_balance.call_count, 2)
+
+    def test_load_statements_downloaded_into_memory(
+        self, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, PARSE_WORKERS=2)
+        with open('tests/data/Y01A.CARS.#D.444444.D050214', 'rb') as f:
+            content = f.read()
+        files = [
+            upload.DownloadedFile('/missing/Y01A.CARS.#D.444444.D050214', content),
+            upload.DownloadedFile('/missing/Y01A.CARS.#D.444444.D060214', content),
+        ]
+
+        statements = list(upload.load_statements(files))
+
+        self.assertEqual([statement.date for statement in statements], [date(2014, 2, 5), date(2014, 2, 6)])
+        self.assertEqual([len(statement.transactions) for statement in statements], [3, 3])
+
+    def test_load_statements_in_worker_processes(
+        self, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, PARSE_WORKERS=2)
+        files = [
+            'tests/data/testfile_1',
+            'tests/data/testfile_no_records',
+            'tests/data/Y01A.CARS.#D.444444.D050214',
+        ]
+
+        statements = list(upload.load_statements(files))
+
+        self.assertEqual([statement.filename for statement in statements], [
+            'tests/data/testfile_1',
+            'tests/data/Y01A.CARS.#D.444444.D050214',
+        ])
+        self.assertEqual([len(statement.transactions) for statement in statements], [3, 3])
+        self.assertEqual(statements[1].date, date(2014, 2, 5))
+
+    def test_upload_stops_between_files(self, mock_settings, mock_get_conn, mock_update_new_balance):
+        self._setup_settings(mock_settings)
+        stop_requests = iter([False, True])
+
+        transaction_count = upload.upload_transactions_from_files(
+            self.files, should_stop=lambda: next(stop_requests)
+        )
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(mock_get_conn().transactions.post.call_count, 2)
+        self.assertEqual(mock_update_new_balance.call_count, 1)
+
+    @mock.patch('mtp_transaction_uploader.upload.get_previous_balance')
+    def test_upload_chains_balances(
+        self, mock_get_previous_balance, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, CHAIN_BALANCES=True)
+        mock_update_new_balance.side_effect = [1000, 2000]
+        mock_get_previous_balance.return_value = 2000
+        balance_counts = []
+
+        def post_transactions(transactions):
+            # each balance is posted as soon as its statement is uploaded
+            balance_counts.append(mock_update_new_balance.call_count)
+
+        mock_get_conn().transactions.post.side_effect = post_transactions
+        with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            transaction_count = upload.upload_transactions_from_files(self.files)
+
+        self.assertEqual(transaction_count, 6)
+        self.assertEqual(balance_counts, [0, 0, 1, 1])
+        self.assertEqual(mock_update_new_balance.call_args_list, [
+            mock.call(mock.ANY, date(2014, 2, 5), file_balance=None, previous_balance=None, net_amount=None,
+                      bank_account=None),
+            mock.call(mock.ANY, date(2014, 2, 5), file_balance=None, previous_balance=1000, net_amount=None,
+                      bank_account=None),
+        ])
+        # the stored balance is checked once
+        mock_get_previous_balance.assert_called_once_with(mock.ANY, date(2014, 2, 6), bank_account=None)
+        self.assertFalse(mock_logger.error.called)
+
+    def test_upload_skips_previous_balance_lookup_once_file_balance_confirmed(
+        self, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, USE_FILE_BALANCES=True)
+        mock_update_new_balance.return_value = 38510000
+
+        upload.upload_transactions_from_files(self.files)
+
+        self.assertEqual(mock_update_new_balance.call_args_list, [
+            mock.call(mock.ANY, date(2014, 2, 5), file_balance=38510000, previous_balance=None,
+                      net_amount=None, bank_account=None),
+            mock.call(mock.ANY, date(2014, 2, 5), file_balance=38510000, previous_balance=38510000,
+                      net_amount=None, bank_account=None),
+        ])
+
+    def test_upload_packs_chunks_across_files(self, mock_settings, mock_get_conn, mock_update_new_balance):
+        self._setup_settings(mock_settings, PACK_UPLOAD_CHUNKS=True, UPLOAD_REQUEST_SIZE=4)
+
+        transaction_count = upload.upload_transactions_from_files(self.files)
+
+        self.assertEqual(transaction_count, 6)
+        posted_chunks = mock_get_conn().transactions.post.call_args_list
+        self.assertEqual([len(chunk[0][0]) for chunk in posted_chunks], [4, 2])
+        self.assertEqual(mock_update_new_balance.call_count, 2)
+
+    @mock.patch('mtp_transaction_uploader.upload.post_streamed')
+    def test_upload_streams_chunks(
+        self, mock_post_streamed, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, STREAM_UPLOADS=True, STREAM_UPLOAD_FORMAT='ndjson')
+        streamed_chunks = []
+        mock_post_streamed.side_effect = lambda conn, endpoint, items, ndjson: streamed_chunks.append(list(items))
+
+        transaction_count = upload.upload_transactions_from_files(self.files[:1])
+
+        self.assertEqual(transaction_count, 3)
+        self.assertFalse(mock_get_conn().transactions.post.called)
+        self.assertEqual(mock_post_streamed.call_args[1], {'ndjson': True})
+        self.assertEqual([len(chunk) for chunk in streamed_chunks], [2, 1])
+        self.assertNotIn('prisoner_number', streamed_chunks[0][0])
+        self.assertEqual(streamed_chunks[0][1]['prisoner_number'], 'A1234BY')
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    def test_packed_upload_skips_files_in_failed_chunk(
+        self, mock_logger, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings, PACK_UPLOAD_CHUNKS=True, UPLOAD_REQUEST_SIZE=4)
+        mock_get_conn().transactions.post.side_effect = [HttpClientError(content='error'), None]
+
+        transaction_count = upload.upload_transactions_from_files(self.files + self.files[:1])
+
+        self.assertEqual(transaction_count, 3)
+        posted_chunks = mock_get_conn().transactions.post.call_args_list
+        self.assertEqual([len(chunk[0][0]) for chunk in posted_chunks], [4, 3])
+        self.assertEqual(mock_update_new_balance.call_count, 1)
+        self.assertEqual(mock_logger.error.call_count, 2)
+
+    @mock.patch('mtp_transaction_uploader.upload.reuse_connection')
+    def test_upload_for_multiple_accounts(
+        self, mock_reuse_connection, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        other_file = os.path.join(path, 'Y01A.CARS.#D.555555.D060214')
+        shutil.copy(self.files[0], other_file)
+        bank_accounts = [
+            upload.BankAccount('444444', '123456', '67175315'),
+            upload.BankAccount('555555', '123456', '67175315'),
+            upload.BankAccount('666666', '654321', '12345678'),
+        ]
+
+        transaction_count = upload.upload_transactions_for_accounts(self.files[:1] + [other_file], bank_accounts)
+
+        self.assertEqual(transaction_count, 6)
+        mock_reuse_connection.assert_called_once_with()
+        # each account with files keeps its own balance
+        self.assertEqual(
+            sorted(call[0][1] for call in mock_update_new_balance.call_args_list),
+            [date(2014, 2, 5), date(2014, 2, 6)]
+        )
+
+    def test_accounts_with_interleaved_dates_keep_their_own_last_dates_and_balances(
+        self, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        self._setup_settings(mock_settings)
+        mock_settings.ACCOUNTS = [('444444', '123456', '67175315'), ('555555', '123456', '67175315')]
+        bank_accounts = upload.get_bank_accounts()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        available_files = []
+        for name in ['444444.D050214', '555555.D060214', '444444.D070214', '555555.D080214']:
+            available_files.append(os.path.join(path, 'Y01A.CARS.#D.%s' % name))
+            shutil.copy(self.files[0], available_files[-1])
+        # the second account's files have been uploaded to a later date than the first account's latest file
+        mock_get_conn().balances.get.return_value = {'results': [{'date': '2014-02-04'}]}
+        account_balance_store = mock.MagicMock()
+        account_balance_store.get.return_value = {'results': [{'date': '2014-02-06'}]}
+        patcher = mock.patch('mtp_transaction_uploader.upload.get_account_balance_store',
+                             return_value=account_balance_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def retrieve_new_files(last_date, account_codes):
+            new_files = [
+                (upload.parse_filename(filename, account_codes[0]), filename) for filename in available_files
+            ]
+            return upload.NewFiles(*zip(*(
+                (date, filename) for date, filename in new_files if date and date > last_date
+            )))
+
+        source = mock.MagicMock(downloads_files=False)
+        source.retrieve_new_files.side_effect = retrieve_new_files
+        last_date, files = upload.retrieve_files_for_accounts(bank_accounts, source=source)
+
+        self.assertEqual(last_date, date(2014, 2, 8))
+        self.assertEqual(files, [available_files[0], available_files[2], available_files[3]])
+
+        with mock.patch('mtp_transaction_uploader.upload.reuse_connection'):
+            transaction_count = upload.upload_transactions_for_accounts(files, bank_accounts)
+
+        self.assertEqual(transaction_count, 9)
+        self.assertEqual(
+            sorted((call[0][1], call[1]['bank_account'].code) for call in mock_update_new_balance.call_args_list),
+            [(date(2014, 2, 5), '444444'), (date(2014, 2, 7), '444444'), (date(2014, 2, 8), '555555')]
+        )
+
+    @mock.patch('mtp_transaction_uploader.upload.upload_transactions_from_files')
+    def test_accounts_are_uploaded_concurrently(
+        self, mock_upload_transactions_from_files, mock_settings, mock_get_conn, mock_update_new_balance
+    ):
+        bank_accounts = [
+            upload.BankAccount('444444', '123456', '67175315'),
+            upload.BankAccount('555555', '123456', '87654321'),
+        ]
+        # each account's upload waits for the other to start
+        barrier = threading.Barrier(2, timeout=5)
+
+        def upload_transactions_from_files(files, should_stop=None, bank_account=None):
+            barrier.wait()
+            return len(files)
+
+        mock_upload_transactions_from_files.side_effect = upload_transactions_from_files
+        transaction_count = upload.upload_transactions_for_accounts([
+            '/tmp/Y01A.CARS.#D.444444.D050214', '/tmp/Y01A.CARS.#D.555555.D050214', '/tmp/Y01A.CARS.#D.555555.D060214',
+        ], bank_accounts)
+
+        self.assertEqual(transaction_count, 3)
+
+    def test_route_files_to_accounts(self, mock_settings, mock_get_conn, mock_update_new_balance):
+        bank_accounts = [
+            upload.BankAccount('444444', '123456', '67175315'),
+            upload.BankAccount('555555', '123456', '87654321'),
+        ]
+        files = [
+            '/tmp/Y01A.CARS.#D.444444.D050214',
+            '/tmp/Y01A.CARS.#D.555555.D050214',
+            '/tmp/Y01A.CARS.#D.444444.D060214',
+            '/tmp/Y01A.CARS.#D.666666.D060214',
+        ]
+
+        self.assertEqual(upload.route_files(files, bank_accounts), {
+            bank_accounts[0]: ['/tmp/Y01A.CARS.#D.444444.D050214', '/tmp/Y01A.CARS.#D.444444.D060214'],
+            bank_accounts[1]: ['/tmp/Y01A.CARS.#D.555555.D050214'],
+        })
+
 
 class SettlementDateParsingTestCase(TestCase):
     def test_parsable_settlement_2_digit_dates(self):
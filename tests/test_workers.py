@@ -0,0 +1,31 @@
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import api_client, workers
+
+
+def get_worker_state():
+    with workers.run_worker_pool(2) as nested_pool:
+        return api_client._reuse_connection, api_client._shared_connection, nested_pool
+
+
+class RunWorkerPoolTestCase(TestCase):
+    def test_workers_do_not_reuse_parent_connection_or_start_pools(self):
+        with api_client.reuse_connection():
+            api_client._shared_connection = 'parent connection'
+            with workers.run_worker_pool(2) as worker_pool:
+                worker_state = worker_pool.submit(get_worker_state).result()
+
+        self.assertEqual(worker_state, (False, None, None))
+
+    def test_nested_blocks_share_pool(self):
+        with workers.run_worker_pool(2) as worker_pool:
+            with workers.run_worker_pool(3) as nested_pool:
+                self.assertIs(nested_pool, worker_pool)
+            self.assertIs(workers.get_worker_pool(), worker_pool)
+        self.assertIsNone(workers.get_worker_pool())
+
+    @mock.patch('mtp_transaction_uploader.workers.ProcessPoolExecutor')
+    def test_no_pool_for_single_worker(self, mock_executor):
+        with workers.run_worker_pool(1) as worker_pool:
+            self.assertIsNone(worker_pool)
+        self.assertFalse(mock_executor.called)